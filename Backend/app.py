@@ -1,207 +1,266 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import re
+from transformers import StoppingCriteriaList
+import asyncio
+import hmac
 import os
 import random
+import time
+from typing import List, Literal, Optional, Sequence, Tuple, Union
+
+from cancellation import (
+    CancellationCriteria,
+    CancellationGroup,
+    CancellationToken,
+    GenerationCancelled,
+    watch_disconnect,
+)
+from capture import TrafficRecorder
+from cascade import Cascade
+from clients import TrustedProxies
+from coalescing import SingleFlight, request_key
+from crisis import detect_crisis, CRISIS_RESPONSE
+from hotswap import ModelHandle
+from kv_cache import BackgroundPrefill, DiskTier, PrefixCache
+from latency import DeadlineCriteria, DeadlineExceeded, StepTimer
+from lora import AdapterBatcher, BatchRowCriteria, LoraRow, MultiLoraModel, adapter_base, parse_adapters
+from memory import MemoryTracker
+from metrics import metrics
+from paged_kv import KVCacheFull, PagedGPTNeo, supports as paged_supported
+from model_loader import LoadedModel, load_model
+from profiling import Profiler
+from prompting import ChatMessage, extract_last_user_message, extract_user_messages, format_chat
+from responses import clean_response, is_valid_response
+from sampling import generate_kwargs
+from static_decode import StaticDecoder
+from retrieval import load_intent_index
+from stopping import StopMarkerCriteria, find_stop
+from scheduler import InferenceScheduler, QuotaExceeded, SessionQuotas
+from shadow import ShadowEvaluator
 
 app = FastAPI()
 
-MODEL_NAME = "Dalton-Khatri/freud-mental-health-assistant"
+MODEL_NAME = os.environ.get("FREUD_MODEL", "Dalton-Khatri/freud-mental-health-assistant")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CASCADE = os.environ.get("FREUD_CASCADE", "0") == "1"
+SMALL_MODEL_NAME = os.environ.get(
+    "FREUD_SMALL_MODEL",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model", "freud_model_neo_gpt")
+)
+CRISIS_FAST_PATH = os.environ.get("FREUD_CRISIS_FAST_PATH", "1") == "1"
+# Diff tracemalloc snapshots every N model requests from startup, 0 = off
+TRACEMALLOC_EVERY = int(os.environ.get("FREUD_TRACEMALLOC_EVERY", 0))
+# Reserved for cleanup and the network hop back to the client
+DEADLINE_MARGIN = float(os.environ.get("FREUD_DEADLINE_MARGIN_MS", 300)) / 1000
+# Below this many affordable tokens a reply is not worth starting
+DEADLINE_MIN_TOKENS = int(os.environ.get("FREUD_DEADLINE_MIN_TOKENS", 16))
+# Concurrent generations; the rest wait in the priority scheduler
+DECODE_SLOTS = int(os.environ.get("FREUD_DECODE_SLOTS", 2))
+SMALL_DECODE_SLOTS = int(os.environ.get("FREUD_SMALL_DECODE_SLOTS", DECODE_SLOTS))
+# Seconds of queueing that lift a waiter by one priority class
+PRIORITY_AGING = float(os.environ.get("FREUD_PRIORITY_AGING_S", 10))
+# Tokens a client is credited per round of fair queueing
+FAIR_QUANTUM = int(os.environ.get("FREUD_FAIR_QUANTUM", 256))
+# Per-client token budget (prompt + max_tokens) per minute, 0 = unlimited
+SESSION_TOKENS_PER_MIN = float(os.environ.get("FREUD_SESSION_TOKENS_PER_MIN", 0))
+SESSION_TOKEN_BURST = float(os.environ.get("FREUD_SESSION_TOKEN_BURST", 0)) or None
+# Addresses/CIDRs of proxies (router.py) whose X-Forwarded-For and
+# X-Session-Id are believed; quotas and fair queueing are per client address
+TRUSTED_PROXIES = TrustedProxies(os.environ.get("FREUD_TRUSTED_PROXIES", "").split(","))
+# Shared secret for /admin and /debug endpoints (X-Admin-Token); unset =
+# those endpoints are disabled
+ADMIN_TOKEN = os.environ.get("FREUD_ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("FREUD_PROFILE_DIR", "/tmp/freud-profiles")
+PROFILE_MAX_WAIT = float(os.environ.get("FREUD_PROFILE_MAX_WAIT_S", 300))
+# Opt-in traffic capture for replay.py; prompt mode is hash, anonymised or raw
+CAPTURE_PATH = os.environ.get("FREUD_CAPTURE_PATH")
+CAPTURE_PROMPTS = os.environ.get("FREUD_CAPTURE_PROMPTS", "hash")
+# Hot-swap: how long to wait for in-flight requests on the old checkpoint
+SWAP_DRAIN_TIMEOUT = float(os.environ.get("FREUD_SWAP_DRAIN_TIMEOUT_S", 300))
+# Checkpoints a swap may load: these hub ids or paths, or directories under
+# FREUD_SWAP_DIR; swapped checkpoints never run repository code
+SWAP_MODELS = {name for name in os.environ.get("FREUD_SWAP_MODELS", "").split(",") if name}
+SWAP_DIR = os.environ.get(
+    "FREUD_SWAP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model")
+)
+# Shadow evaluation: mirror this fraction of answered requests to a
+# candidate checkpoint when the serving models are idle
+SHADOW_MODEL = os.environ.get("FREUD_SHADOW_MODEL")
+SHADOW_FRACTION = float(os.environ.get("FREUD_SHADOW_FRACTION", 0.1))
+# Multi-LoRA: "name=path,..." peft adapters or compress_deltas.py variants
+# served on one shared base model (FREUD_LORA_BASE, default the base the
+# first adapter was made from)
+ADAPTERS = parse_adapters(os.environ.get("FREUD_ADAPTERS", ""))
+LORA_BASE = os.environ.get("FREUD_LORA_BASE")
+LORA_MAX_BATCH = int(os.environ.get("FREUD_LORA_MAX_BATCH", 8))
+LORA_BATCH_WINDOW = float(os.environ.get("FREUD_LORA_BATCH_WINDOW_MS", 15)) / 1000
+# Adapter batches decode from a paged KV pool (GPT-Neo bases; 0 disables)
+PAGED_KV_MB = int(os.environ.get("FREUD_PAGED_KV_MB", 256))
+PAGED_KV_BLOCK = int(os.environ.get("FREUD_PAGED_KV_BLOCK", 16))
+# Per-session prefix KV cache, filled by background prefill of the next
+# turn's prefix while the user is typing; 0 disables both
+KV_CACHE_MB = int(os.environ.get("FREUD_KV_CACHE_MB", 256))
+# Keep cached sessions as int8 (~4x more per MB; check_kv_quantization.py)
+KV_CACHE_INT8 = os.environ.get("FREUD_KV_CACHE_INT8", "0") == "1"
+PREFILL_CHUNK = int(os.environ.get("FREUD_PREFILL_CHUNK", 64))
+# Sessions idle this long (or evicted from memory) move to a disk tier and
+# are read back when their next request arrives; FREUD_KV_DISK_MB=0 disables
+KV_DISK_DIR = os.environ.get("FREUD_KV_DISK_DIR", "/tmp/freud-kv")
+KV_DISK_MB = int(os.environ.get("FREUD_KV_DISK_MB", 2048))
+KV_SPILL_AFTER = float(os.environ.get("FREUD_KV_SPILL_AFTER_S", 60))
+# GPT-Neo checkpoints decode from a static KV cache with torch.compile'd
+# steps, compiled at load for prompts padded to these bucket lengths
+STATIC_DECODE = os.environ.get("FREUD_STATIC_DECODE", "0") == "1"
+STATIC_BUCKETS = [int(b) for b in os.environ.get("FREUD_STATIC_BUCKETS", "64,128,256,512").split(",")]
+STATIC_MAX_LENGTH = int(os.environ.get("FREUD_STATIC_MAX_LENGTH", 1024))
+# Request size limits (prompts are cut to 512 tokens anyway)
+MAX_NEW_TOKENS = int(os.environ.get("FREUD_MAX_NEW_TOKENS", 1024))
+MAX_PROMPT_CHARS = int(os.environ.get("FREUD_MAX_PROMPT_CHARS", 32000))
+MAX_CHAT_MESSAGES = int(os.environ.get("FREUD_MAX_CHAT_MESSAGES", 100))
+WARMUP_PROMPT = "<|system|>: You are Freud, a calm, empathetic therapeutic AI assistant.\n<|user|>:\n[emotion: neutral]\nHello\n<|assistant|>:\n"
+
+def load_serving_model(name: str, slots: int, trust_remote_code: bool = True) -> LoadedModel:
+    """load_model plus, with FREUD_STATIC_DECODE, a compiled static-cache decoder per slot"""
+    loaded = load_model(name, DEVICE, trust_remote_code)
+    if STATIC_DECODE:
+        if paged_supported(loaded.model):
+            try:
+                loaded.static = StaticDecoder(loaded.model, STATIC_BUCKETS, STATIC_MAX_LENGTH, slots)
+                loaded.static.warm_up()
+            except Exception as e:
+                # e.g. inductor on CPU without a C++ compiler; its errors run long
+                reason = (str(e).splitlines() or [type(e).__name__])[0]
+                print(f"Static decode disabled for {name}, compile failed: {reason}")
+                loaded.static = None
+        else:
+            print(f"Static decode skipped for {name}: only GPT-Neo is supported")
+    return loaded
 
-print(f"Loading model: {MODEL_NAME}")
-print(f"Device: {DEVICE}")
+memory = MemoryTracker()
+if TRACEMALLOC_EVERY:
+    memory.start_tracing(TRACEMALLOC_EVERY)
 
 try:
-    print("Step 1: Loading tokenizer...")
-    
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_NAME,
-            use_fast=False,
-            trust_remote_code=True
-        )
-        print("Loaded slow tokenizer successfully")
-    except Exception as e:
-        print(f"Slow tokenizer failed: {e}")
-        print("Trying fast tokenizer...")
-        
-        tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_NAME,
-            use_fast=True,
-            trust_remote_code=True
-        )
-        print("Loaded fast tokenizer successfully")
-    
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        print("Set pad_token = eos_token")
-    
-    print("\nStep 2: Loading model...")
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
-        low_cpu_mem_usage=True,
-        trust_remote_code=True
-    )
-    
-    model.to(DEVICE)
-    model.eval()
-    
-    print("Model loaded successfully!")
-    print(f"Model parameters: {sum(p.numel() for p in model.parameters()):,}")
-    
+    with memory.stage("load"):
+        primary = ModelHandle("primary", load_serving_model(MODEL_NAME, DECODE_SLOTS), os.environ.get("FREUD_MODEL_VERSION"))
 except Exception as e:
     print(f"CRITICAL ERROR loading model: {e}")
     raise
 
+intent_index = load_intent_index() if os.environ.get("FREUD_RETRIEVAL", "1") == "1" else None
+inflight = SingleFlight()
+scheduler = InferenceScheduler(slots=DECODE_SLOTS, aging=PRIORITY_AGING, quantum=FAIR_QUANTUM)
+quotas = SessionQuotas(SESSION_TOKENS_PER_MIN, SESSION_TOKEN_BURST)
+profiler = Profiler(PROFILE_DIR)
+recorder = TrafficRecorder(CAPTURE_PATH, CAPTURE_PROMPTS) if CAPTURE_PATH else None
+
+# Cascade: the fine-tuned GPT-Neo 125M answers first, the primary model
+# (phi-2 fine-tune) takes escalations and whatever it has idle capacity for
+cascade = None
+if CASCADE:
+    with memory.stage("load"):
+        small_model = ModelHandle("small", load_serving_model(SMALL_MODEL_NAME, SMALL_DECODE_SLOTS))
+    small_scheduler = InferenceScheduler(slots=SMALL_DECODE_SLOTS, aging=PRIORITY_AGING, quantum=FAIR_QUANTUM)
+    cascade = Cascade(small_model, small_scheduler, primary, scheduler)
+
+# Adapter requests get their own scheduler (one slot per batch row) and are
+# batched across adapters into shared forward passes
+lora = None
+paged = None
+if ADAPTERS:
+    base_name = LORA_BASE or adapter_base(next(iter(ADAPTERS.values())))
+    if base_name == MODEL_NAME:
+        lora = MultiLoraModel(primary.current)
+    else:
+        with memory.stage("load"):
+            lora = MultiLoraModel(load_model(base_name, DEVICE))
+    for adapter_name, adapter_path in ADAPTERS.items():
+        lora.add_adapter(adapter_name, adapter_path)
+    lora_scheduler = InferenceScheduler(slots=LORA_MAX_BATCH, aging=PRIORITY_AGING, quantum=FAIR_QUANTUM)
+    if PAGED_KV_MB > 0 and paged_supported(lora.base.model):
+        # Room in the local-layer pool for up to two full batches at once
+        paged = PagedGPTNeo(lora.base.model, PAGED_KV_MB * 1024 * 1024, PAGED_KV_BLOCK, 2 * LORA_MAX_BATCH)
+        print(f"Paged KV cache: {paged.pool.num_blocks} blocks of {PAGED_KV_BLOCK} tokens, "
+              f"local windows for {paged.max_sequences} sequences")
+    # run_lora_batch is defined below; resolved when the first batch runs
+    lora_batcher = AdapterBatcher(lambda rows: run_lora_batch(rows), LORA_BATCH_WINDOW, LORA_MAX_BATCH)
+
+def serving_schedulers() -> List[InferenceScheduler]:
+    schedulers = [scheduler]
+    if cascade is not None:
+        schedulers.append(small_scheduler)
+    if lora is not None:
+        schedulers.append(lora_scheduler)
+    return schedulers
+
+def serving_idle() -> bool:
+    return all(s.idle() for s in serving_schedulers())
+
+kv_cache = None
+prefiller = None
+if KV_CACHE_MB > 0:
+    disk = DiskTier(KV_DISK_DIR, KV_DISK_MB * 1024 * 1024) if KV_DISK_MB > 0 else None
+    kv_cache = PrefixCache(KV_CACHE_MB * 1024 * 1024, quantize=KV_CACHE_INT8, disk=disk)
+    prefiller = BackgroundPrefill(kv_cache, serving_idle, max_tokens=512, chunk=PREFILL_CHUNK)
+
+async def spill_idle_sessions():
+    while True:
+        await asyncio.sleep(min(KV_SPILL_AFTER, 10))
+        try:
+            await run_in_threadpool(kv_cache.spill_idle, KV_SPILL_AFTER)
+        except Exception as e:
+            print(f"Spilling idle sessions failed: {e}")
+
+@app.on_event("startup")
+async def start_spilling():
+    if kv_cache is not None and kv_cache.disk is not None:
+        asyncio.create_task(spill_idle_sessions())
+
+shadow = None
+if SHADOW_MODEL:
+    with memory.stage("load"):
+        candidate = ModelHandle("candidate", load_serving_model(SHADOW_MODEL, 1))
+    # run_model is defined below; resolved when the first shadow runs
+    shadow = ShadowEvaluator(candidate, lambda *args: run_model(*args), serving_schedulers(), SHADOW_FRACTION)
+
 class GenerateRequest(BaseModel):
-    prompt: str
-    max_tokens: int = 150
+    prompt: str = Field(max_length=MAX_PROMPT_CHARS)
+    max_tokens: int = Field(150, ge=1, le=MAX_NEW_TOKENS)
     temperature: float = 0.7
+    # Set False to always sample independently instead of sharing the
+    # result of an identical in-flight request
+    coalesce: bool = True
+    # Time budget in ms from arrival (also accepted as X-Deadline-Ms header)
+    deadline_ms: Optional[int] = None
+    # Fair-queueing identity (also accepted as X-Session-Id header);
+    # defaults to the client address (X-Forwarded-For first)
+    session_id: Optional[str] = None
+    # LoRA adapter (FREUD_ADAPTERS) to generate with, on the shared base model
+    adapter: Optional[str] = None
+
+class ChatMessageIn(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str = Field(max_length=MAX_PROMPT_CHARS)
+    # Emotion tag for user turns (the client's _detectEmotion), default neutral
+    emotion: Optional[str] = None
+
+class ChatRequest(BaseModel):
+    # Conversation so far, oldest first; the system prompt is added server-side
+    messages: List[ChatMessageIn] = Field(max_length=MAX_CHAT_MESSAGES)
+    max_tokens: int = Field(150, ge=1, le=MAX_NEW_TOKENS)
+    temperature: float = 0.7
+    coalesce: bool = True
+    deadline_ms: Optional[int] = None
+    session_id: Optional[str] = None
+    adapter: Optional[str] = None
 
 class GenerateResponse(BaseModel):
     response: str
     model_used: str = MODEL_NAME
     device: str = DEVICE
-
-def clean_response(text: str, original_prompt: str = "") -> str:
-    """
-    ULTRA-AGGRESSIVE cleaning to remove ALL tags and artifacts
-    """
-    
-    # Step 1: Remove the original prompt
-    if original_prompt:
-        text = text.replace(original_prompt, "").strip()
-    
-    # Step 2: CRITICAL - Extract ONLY content after final <|assistant|>:
-    if "<|assistant|>:" in text:
-        parts = text.split("<|assistant|>:")
-        if len(parts) > 1:
-            text = parts[-1].strip()
-    
-    # Step 3: STOP at ANY indication of user tag
-    stop_patterns = [
-        r'<\|user\|>',
-        r'<\^user\|>',
-        r'<user>',
-        r'<\/\|user\|>',
-        r'\n<\|',
-        r'<\|user',
-        r'\[emotion:',
-    ]
-    
-    for pattern in stop_patterns:
-        if re.search(pattern, text, re.IGNORECASE):
-            text = re.split(pattern, text, maxsplit=1)[0].strip()
-            break
-    
-    # Step 4: Remove ALL special markers
-    text = re.sub(r'\[emotion:\s*\w+\]', '', text, flags=re.IGNORECASE)
-    text = re.sub(r'<\|[^>]*\|>:?', '', text)
-    text = re.sub(r'<\^[^>]*\|>:?', '', text)
-    text = re.sub(r'<\/\|[^>]*\|>:?', '', text)
-    text = re.sub(r'\*\|[a-z0-9]+\|', '', text)
-    text = re.sub(r'</?[a-zA-Z][^>]*>', '', text)
-    text = re.sub(r'^(User:|Assistant:|Human:|AI:|System:|Freud:)\s*', '', text, flags=re.MULTILINE)
-    text = re.sub(r'(User:|Assistant:|Human:|AI:|System:|Freud:)', '', text)
-    
-    # Step 5: Remove arrow annotations
-    text = re.sub(r'←[^.!?]*[.!?]', '', text)
-    text = re.sub(r'→[^.!?]*[.!?]', '', text)
-    text = re.sub(r'<-[^.!?]*[.!?]', '', text)
-    text = re.sub(r'->[^.!?]*[.!?]', '', text)
-    
-    # Step 6: Clean formatting artifacts
-    text = re.sub(r'[<>]{2,}', '', text)
-    text = re.sub(r'[#*]{3,}', '', text)
-    text = re.sub(r'!{4,}', '!', text)
-    text = re.sub(r'\*{2,}', '', text)
-    
-    # Step 7: Remove "Your Name:" artifacts
-    text = re.sub(r'Your Name:\s*\w*', '', text, flags=re.IGNORECASE)
-    text = re.sub(r'Name:\s*\w*', '', text)
-    
-    # Step 8: Clean whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    text = re.sub(r'\n+', '\n', text).strip()
-    
-    # Step 9: Remove leading/trailing punctuation artifacts
-    text = re.sub(r'^[.,;:!?\s]+', '', text)
-    text = re.sub(r'[.,;:\s]+$', '', text)
-    
-    # Step 10: Limit to 2-3 sentences
-    sentences = re.split(r'[.!?]+\s+', text)
-    sentences = [s.strip() for s in sentences if s.strip() and len(s.strip()) > 3]
-    
-    if len(sentences) > 3:
-        text = '. '.join(sentences[:3])
-        if not text.endswith(('.', '!', '?')):
-            text += '.'
-    elif sentences:
-        text = '. '.join(sentences)
-        if not text.endswith(('.', '!', '?')):
-            text += '.'
-    
-    return text.strip()
-
-def is_valid_response(response: str) -> bool:
-    """
-    STRICT validation - reject anything suspicious
-    """
-    if not response or len(response.strip()) < 10:
-        print(f"Too short: {len(response)} chars")
-        return False
-    
-    tag_patterns = [
-        r'<\|.*?\|>',
-        r'<\^.*?\|>',
-        r'</?user>',
-        r'</?assistant>',
-        r'</?system>',
-        r'\[emotion:',
-        r'\*\|[a-z]+\d*\|',
-        r'←',
-        r'→',
-        r'Your Name:',
-    ]
-    
-    for pattern in tag_patterns:
-        if re.search(pattern, response, re.IGNORECASE):
-            print(f"Tag leakage: Found {pattern}")
-            return False
-    
-    if response.lower().startswith('error'):
-        print(f"Error message")
-        return False
-    
-    special_chars = len(re.findall(r'[^a-zA-Z0-9\s.,!?\'-]', response))
-    if special_chars > len(response) * 0.2:
-        print(f"Too many special characters: {special_chars}")
-        return False
-    
-    if response.count('!') > 5 or response.count('?') > 3:
-        print(f"Excessive punctuation")
-        return False
-    
-    words = response.split()
-    for i in range(len(words) - 3):
-        if len(words) > i+3 and words[i] == words[i+1] == words[i+2] == words[i+3]:
-            print(f"Repetition detected: {words[i]}")
-            return False
-    
-    word_count = len(words)
-    if word_count < 5:
-        print(f"Too few words: {word_count}")
-        return False
-    
-    if len(set(response.replace(' ', ''))) < 8:
-        print(f"Not enough unique characters")
-        return False
-    
-    return True
+    route: str = "model"
 
 def get_fallback_response() -> str:
     """
@@ -222,10 +281,11 @@ def read_root():
     """Health check"""
     return {
         "status": "Freud AI is running",
-        "model": MODEL_NAME,
+        "model": primary.name,
+        "model_version": primary.version,
         "device": DEVICE,
         "version": "4.0 (Ultra-Clean)",
-        "tokenizer_type": type(tokenizer).__name__
+        "tokenizer_type": type(primary.current.tokenizer).__name__
     }
 
 @app.get("/health")
@@ -233,89 +293,617 @@ def health_check():
     """Detailed health check"""
     return {
         "status": "healthy",
-        "model_loaded": model is not None,
-        "tokenizer_loaded": tokenizer is not None,
+        "model_loaded": primary.current.model is not None,
+        "tokenizer_loaded": primary.current.tokenizer is not None,
         "device": DEVICE,
         "cuda_available": torch.cuda.is_available(),
-        "model_parameters": sum(p.numel() for p in model.parameters())
+        "model_parameters": primary.current.parameters,
+        "model_version": primary.version
     }
 
+def respond(text: str, route: str, started: float, model_used: str = MODEL_NAME) -> GenerateResponse:
+    """
+    Build the response and record per-route latency
+    """
+    metrics.incr(f"route.{route}")
+    metrics.observe(f"route.{route}", time.perf_counter() - started)
+    return GenerateResponse(
+        response=text,
+        model_used=model_used,
+        device=DEVICE,
+        route=route
+    )
+
+@app.get("/metrics")
+def get_metrics():
+    """Counters, per-route latency and retrieval hit rate"""
+    snapshot = metrics.snapshot()
+    snapshot["retrieval_hit_rate"] = metrics.ratio("retrieval.hits", "retrieval.lookups")
+    snapshot["inflight_generations"] = len(inflight)
+    snapshot["decode_latency"] = {primary.name: primary.current.latency.snapshot()}
+    snapshot["scheduler"] = scheduler.snapshot()
+    snapshot["memory"] = memory.summary()
+    if cascade is not None:
+        snapshot["decode_latency"][small_model.name] = small_model.current.latency.snapshot()
+        snapshot["small_scheduler"] = small_scheduler.snapshot()
+        snapshot["cascade_escalation_rate"] = metrics.ratio("cascade.escalated", "cascade.small")
+    if shadow is not None:
+        snapshot["shadow"] = shadow.snapshot()
+    if kv_cache is not None:
+        snapshot["cache"] = kv_cache.snapshot()
+    if lora is not None:
+        snapshot["lora"] = lora.snapshot()
+        if paged is not None:
+            snapshot["paged_kv"] = paged.snapshot()
+        snapshot["lora_scheduler"] = lora_scheduler.snapshot()
+        snapshot["decode_latency"][lora.name] = lora.base.latency.snapshot()
+    return snapshot
+
+def require_admin(http_request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(http_request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+class ProfileRequest(BaseModel):
+    # Profile the next N model requests and/or the next T seconds
+    requests: Optional[int] = None
+    seconds: Optional[float] = None
+    # Wait for the session to finish and return the file paths
+    wait: bool = True
+
+@app.post("/admin/profile")
+async def start_profile(body: ProfileRequest, http_request: Request):
+    """Enable torch.profiler + stack sampling; returns trace file paths"""
+    require_admin(http_request)
+    if not body.requests and not body.seconds:
+        raise HTTPException(status_code=400, detail="Set requests and/or seconds")
+    
+    try:
+        session = profiler.start(body.requests, body.seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if body.wait:
+        await run_in_threadpool(session.done.wait, PROFILE_MAX_WAIT)
+    return session.status()
+
+@app.get("/admin/profile")
+def profile_status(http_request: Request):
+    """Current or last profiling session"""
+    require_admin(http_request)
+    return profiler.status()
+
+class SwapRequest(BaseModel):
+    # Checkpoint to load: a FREUD_SWAP_MODELS entry or a directory under FREUD_SWAP_DIR
+    model: str
+    # "primary", "small" (cascade) or "candidate" (shadow evaluation)
+    target: str = "primary"
+    # Reported version label; defaults to the checkpoint name
+    version: Optional[str] = None
+    # Wait for the swap to finish and return its report
+    wait: bool = False
+
+def model_handles() -> dict:
+    handles = {"primary": primary}
+    if cascade is not None:
+        handles["small"] = small_model
+    if shadow is not None:
+        handles["candidate"] = shadow.candidate
+    return handles
+
+def swap_allowed(model: str) -> bool:
+    """Listed in FREUD_SWAP_MODELS, or a local checkpoint directory under FREUD_SWAP_DIR"""
+    if model in SWAP_MODELS:
+        return True
+    path = os.path.realpath(model)
+    root = os.path.realpath(SWAP_DIR)
+    return os.path.isdir(path) and os.path.commonpath([path, root]) == root
+
+def warm_up(loaded: LoadedModel):
+    """One short generation so the first real request doesn't pay for it"""
+    run_model(loaded, WARMUP_PROMPT, 8, 0.7, CancellationToken())
+
+def release_model(loaded: LoadedModel):
+    """Drop the prefix cache entries and pending prefills of a swapped-out model"""
+    if kv_cache is not None:
+        dropped = kv_cache.drop_model(loaded)
+        print(f"Hot-swap: dropped {dropped} cached prefixes of {loaded.name}")
+    if prefiller is not None:
+        prefiller.drop_model(loaded)
+
+# Background swaps (wait=false): the event loop only keeps weak references
+# to tasks, so an unreferenced swap could be collected mid-drain
+swap_tasks = set()
+
+def swap_finished(task: asyncio.Task):
+    swap_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Hot-swap task failed: {task.exception()}")
+        metrics.incr("hotswap.task_errors")
+
+@app.post("/admin/models/swap")
+async def swap_model(body: SwapRequest, http_request: Request):
+    """Load, warm up and swap in a new checkpoint without downtime"""
+    require_admin(http_request)
+    handle = model_handles().get(body.target)
+    if handle is None:
+        raise HTTPException(status_code=400, detail=f"Unknown target {body.target}")
+    if not swap_allowed(body.model):
+        raise HTTPException(status_code=403, detail=f"{body.model} is not an allowed swap checkpoint")
+    if handle.swapping is not None:
+        raise HTTPException(status_code=409, detail=f"Swap to {handle.swapping['to']} already in progress")
+    # Adapters were trained against (and hook into) the primary checkpoint
+    if lora is not None and lora.base is handle.current:
+        raise HTTPException(status_code=409, detail=f"LoRA adapters are bound to {handle.name}; "
+                                                    f"restart with the new base to change it")
+    
+    def load():
+        with memory.stage("load"):
+            slots = {"small": SMALL_DECODE_SLOTS, "candidate": 1}.get(body.target, DECODE_SLOTS)
+            return load_serving_model(body.model, slots, trust_remote_code=False)
+    
+    swap = handle.swap(load, warm_up, body.model, body.version, SWAP_DRAIN_TIMEOUT, release_model)
+    if body.wait:
+        return await swap
+    task = asyncio.create_task(swap)
+    swap_tasks.add(task)
+    task.add_done_callback(swap_finished)
+    await asyncio.sleep(0)
+    return handle.status()
+
+@app.get("/admin/models")
+def model_status(http_request: Request):
+    """Active checkpoint and version per role, and swap progress"""
+    require_admin(http_request)
+    return {role: handle.status() for role, handle in model_handles().items()}
+
+class TracemallocRequest(BaseModel):
+    # Snapshot every N model requests; 0 stops tracing
+    every: int
+    top: int = 20
+
+@app.get("/debug/memory")
+def memory_debug(http_request: Request):
+    """RSS per stage and the last tracemalloc diff"""
+    require_admin(http_request)
+    return memory.debug()
+
+@app.post("/debug/memory/tracemalloc")
+def memory_tracemalloc(body: TracemallocRequest, http_request: Request):
+    """Start (every > 0) or stop (every = 0) tracemalloc snapshot diffs"""
+    require_admin(http_request)
+    memory.start_tracing(body.every, body.top)
+    return memory.debug()["tracemalloc"]
+
+def run_model(loaded: LoadedModel, prompt: str, max_tokens: int, temperature: float,
+              cancellation: CancellationGroup, deadline: Optional[float] = None,
+              stats: Optional[dict] = None,
+              messages: Optional[Sequence[ChatMessage]] = None) -> Tuple[str, str]:
+    """
+    Tokenize, generate, clean and validate; returns (text, route).
+    Token counts are written into stats when given. With messages (/chat)
+    the ids come from the model's pre-tokenized template fragments.
+    """
+    # Client left while this request was still queued
+    if cancellation.cancelled:
+        raise GenerationCancelled(cancellation.reason or "cancelled")
+    
+    try:
+        with profiler.capture("generate"):
+            return _run_model(loaded, prompt, max_tokens, temperature, cancellation, deadline,
+                              stats if stats is not None else {}, messages)
+    finally:
+        memory.request_done()
+
+def _run_model(loaded: LoadedModel, prompt: str, max_tokens: int, temperature: float,
+               cancellation: CancellationGroup, deadline: Optional[float], stats: dict,
+               messages: Optional[Sequence[ChatMessage]]) -> Tuple[str, str]:
+    tokenizer = loaded.tokenizer
+    with profiler.section("tokenize"), memory.stage("tokenize"):
+        if messages is not None:
+            input_ids = torch.tensor([loaded.chat.encode(messages, 512)], device=loaded.device)
+        else:
+            input_ids = tokenizer(
+                prompt,
+                return_tensors="pt",
+                truncation=True,
+                max_length=512,
+                padding=False
+            ).input_ids.to(loaded.device)
+    
+    print(f"Tokenization complete: {input_ids.shape}")
+    
+    prompt_tokens = input_ids.shape[-1]
+    stats["prompt_tokens"] = prompt_tokens
+    
+    # Prefix already prefilled for this session (background prefill): only
+    # the new tokens go through the model
+    past = None
+    cached = 0
+    session = stats.get("session")
+    if kv_cache is not None and session is not None:
+        reusable = kv_cache.lookup(session, loaded, input_ids[0].tolist())
+        if reusable is not None:
+            past, cached = reusable
+            print(f"KV cache hit: {cached} of {prompt_tokens} prompt tokens cached")
+    stats["cached_tokens"] = cached
+    timer = StepTimer()
+    stopping_criteria = StoppingCriteriaList([
+        CancellationCriteria(cancellation),
+        StopMarkerCriteria(loaded.token_texts, prompt_tokens),
+        timer
+    ])
+    deadline_criteria = None
+    
+    # Fit the reply into the client's deadline using live decode latency
+    if deadline is not None:
+        budget = deadline - time.perf_counter() - DEADLINE_MARGIN
+        affordable = loaded.latency.affordable_tokens(prompt_tokens - cached, budget)
+        if budget <= 0 or (affordable is not None and affordable < DEADLINE_MIN_TOKENS):
+            raise DeadlineExceeded(f"{budget * 1000:.0f}ms left, {affordable} tokens affordable")
+        if affordable is not None and affordable < max_tokens:
+            print(f"Deadline caps max_new_tokens {max_tokens} -> {affordable}")
+            metrics.incr("deadline.capped")
+            max_tokens = affordable
+        deadline_criteria = DeadlineCriteria(deadline - DEADLINE_MARGIN)
+        stopping_criteria.append(deadline_criteria)
+    
+    generation_started = time.perf_counter()
+    
+    with torch.no_grad(), profiler.section("model.generate"), memory.stage("generate"):
+        outputs = None
+        if loaded.static is not None:
+            outputs = loaded.static.generate(input_ids, past, cached, max_tokens, temperature,
+                                             tokenizer.pad_token_id, tokenizer.eos_token_id, stopping_criteria)
+        if outputs is None:
+            outputs = loaded.model.generate(
+                input_ids,
+                past_key_values=past,
+                max_new_tokens=max_tokens,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                early_stopping=True,
+                stopping_criteria=stopping_criteria,
+                **generate_kwargs(temperature)
+            )
+    
+    stats["generate_s"] = time.perf_counter() - generation_started
+    loaded.latency.record(prompt_tokens - cached, timer.step_times, generation_started)
+    
+    if deadline_criteria is not None and deadline_criteria.triggered:
+        metrics.incr("deadline.truncated")
+    
+    if cancellation.cancelled:
+        abandoned = outputs.shape[-1] - prompt_tokens
+        raise GenerationCancelled(cancellation.reason or "cancelled", abandoned)
+    
+    print(f"Generation complete")
+    return finish_response(loaded, outputs[0, prompt_tokens:].tolist(), stats)
+
+def finish_response(loaded: LoadedModel, generated: List[int], stats: dict) -> Tuple[str, str]:
+    """
+    Decode, clean and validate the generated ids; returns (text, route)
+    """
+    tokenizer = loaded.tokenizer
+    # Only the generated ids, cut at the first stop marker: the prompt is
+    # never decoded and never has to be matched back out of the text
+    with profiler.section("decode"), memory.stage("decode"):
+        stats["generated_tokens"] = len(generated)
+        stop = find_stop(generated, loaded.token_texts)
+        full_response = tokenizer.decode(generated[:stop], skip_special_tokens=True)
+    print(f"Generated {len(generated)} tokens, reply is {stop}")
+    print(f"Raw output preview: {full_response[:200]}...")
+    
+    with profiler.section("clean_response"):
+        cleaned_response = clean_response(full_response)
+    print(f"Cleaned output length: {len(cleaned_response)} chars")
+    print(f"Cleaned output: {cleaned_response}")
+    
+    with profiler.section("is_valid_response"):
+        valid = is_valid_response(cleaned_response)
+    
+    if not valid:
+        print(f"Quality check failed!")
+        print(f" Using fallback response")
+        return get_fallback_response(), "fallback"
+    
+    print(f"Quality check passed")
+    return cleaned_response, "model"
+
+def run_lora_batch(rows: List[LoraRow]) -> List[Union[Tuple[str, str], Exception]]:
+    """
+    One generate call for requests using different adapters (or none) on
+    the shared LoRA base; returns (text, route) or the exception per row
+    """
+    loaded = lora.base
+    tokenizer = loaded.tokenizer
+    results: List[Union[Tuple[str, str], Exception, None]] = [None] * len(rows)
+    
+    live = []
+    for i, row in enumerate(rows):
+        if row.cancellation.cancelled:
+            results[i] = GenerationCancelled(row.cancellation.reason or "cancelled")
+        elif row.deadline is not None and row.deadline - DEADLINE_MARGIN <= time.perf_counter():
+            results[i] = DeadlineExceeded("deadline passed while batching")
+        else:
+            live.append(i)
+    if not live:
+        return results
+    batch = [rows[i] for i in live]
+    
+    with profiler.capture("generate_batch"):
+        with profiler.section("tokenize"), memory.stage("tokenize"):
+            ids = [
+                loaded.chat.encode(row.messages, 512) if row.messages is not None
+                else tokenizer(row.prompt, truncation=True, max_length=512)["input_ids"]
+                for row in batch
+            ]
+            # Left padding so every row's next token is in the last column
+            width = max(len(row_ids) for row_ids in ids)
+            input_ids = torch.full((len(ids), width), tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(ids), width), dtype=torch.long)
+            for j, row_ids in enumerate(ids):
+                input_ids[j, width - len(row_ids):] = torch.tensor(row_ids)
+                attention_mask[j, width - len(row_ids):] = 1
+        
+        print(f"Adapter batch: {len(batch)} rows, adapters {[row.adapter for row in batch]}, width {width}")
+        criteria = BatchRowCriteria(batch, loaded.token_texts, width, tokenizer.eos_token_id)
+        timer = StepTimer()
+        generation_started = time.perf_counter()
+        
+        max_new_tokens = max(row.max_tokens for row in batch)
+        with torch.no_grad(), profiler.section("model.generate"), memory.stage("generate"):
+            if paged is not None:
+                outputs = paged.generate(
+                    ids, [row.adapter for row in batch], max_new_tokens, batch[0].temperature,
+                    tokenizer.pad_token_id, criteria, [timer], lora.rows
+                )
+            else:
+                with lora.rows([row.adapter for row in batch]):
+                    padded = loaded.model.generate(
+                        input_ids.to(loaded.device),
+                        attention_mask=attention_mask.to(loaded.device),
+                        max_new_tokens=max_new_tokens,
+                        pad_token_id=tokenizer.pad_token_id,
+                        eos_token_id=tokenizer.eos_token_id,
+                        early_stopping=True,
+                        stopping_criteria=StoppingCriteriaList([criteria, timer]),
+                        **generate_kwargs(batch[0].temperature)
+                    )
+                outputs = [padded[j, width:].tolist() for j in range(len(batch))]
+        
+        generate_s = time.perf_counter() - generation_started
+        loaded.latency.record(width, timer.step_times, generation_started)
+        metrics.incr("lora.batches")
+        metrics.incr("lora.rows", len(batch))
+        
+        for j, (i, row) in enumerate(zip(live, batch)):
+            if isinstance(outputs[j], KVCacheFull):
+                results[i] = outputs[j]
+                continue
+            generated = outputs[j][:row.max_tokens]
+            # Rows that finished early are padded with eos up to the longest
+            if tokenizer.eos_token_id in generated:
+                generated = generated[:generated.index(tokenizer.eos_token_id)]
+            row.stats["prompt_tokens"] = len(ids[j])
+            row.stats["generate_s"] = generate_s
+            if row.cancellation.cancelled:
+                results[i] = GenerationCancelled(row.cancellation.reason or "cancelled", len(generated))
+                continue
+            if criteria.deadline_hit[j]:
+                metrics.incr("deadline.truncated")
+            results[i] = finish_response(loaded, generated, row.stats)
+            memory.request_done()
+    
+    return results
+
 @app.post("/generate", response_model=GenerateResponse)
-def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request):
     """
     Main generation endpoint with ULTRA-CLEAN response processing
     """
+    return await serve(request, http_request)
+
+@app.post("/chat", response_model=GenerateResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """
+    Structured conversation instead of a pre-formatted prompt; tokenized
+    from cached template fragments, same ids as the equivalent /generate
+    """
+    messages = [(m.role, m.content, m.emotion) for m in request.messages]
+    # Already validated as a ChatRequest; the formatted conversation may be
+    # longer than a single /generate prompt is allowed to be
+    generate_request = GenerateRequest.model_construct(
+        prompt=format_chat(messages),
+        **request.model_dump(exclude={"messages"})
+    )
+    return await serve(generate_request, http_request, messages)
+
+async def serve(request: GenerateRequest, http_request: Request,
+                messages: Optional[List[ChatMessage]] = None) -> GenerateResponse:
+    """
+    handle_generate, plus traffic capture when enabled
+    """
+    if recorder is None:
+        return await handle_generate(request, http_request, {}, messages)
+    
+    arrived = time.time()
+    started = time.perf_counter()
+    stats = {}
+    route = "error"
+    try:
+        response = await handle_generate(request, http_request, stats, messages)
+        route = response.route
+        return response
+    except HTTPException as e:
+        route = f"http_{e.status_code}"
+        raise
+    finally:
+        recorder.record(
+            arrived,
+            request.prompt,
+            {
+                "max_tokens": request.max_tokens,
+                "temperature": request.temperature,
+                "coalesce": request.coalesce,
+                "deadline_ms": request.deadline_ms,
+                "adapter": request.adapter,
+            },
+            time.perf_counter() - started,
+            route,
+            stats,
+            stats.get("session")
+        )
+
+async def handle_generate(request: GenerateRequest, http_request: Request, stats: dict,
+                          messages: Optional[List[ChatMessage]] = None) -> GenerateResponse:
+    started = time.perf_counter()
+    token = CancellationToken()
+    watcher = None
+    
+    if request.adapter is not None and (lora is None or request.adapter not in lora.adapters):
+        raise HTTPException(status_code=400, detail=f"Unknown adapter {request.adapter}")
     
     try:
         print(f"\n{'='*60}")
         print(f"New Request")
         print(f"Prompt length: {len(request.prompt)} chars")
         
-        inputs = tokenizer(
-            request.prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=512,
-            padding=False
-        ).to(DEVICE)
+        user_message = extract_last_user_message(request.prompt)
         
-        print(f"Tokenization complete: {inputs.input_ids.shape}")
+        # Crisis fast path: answer before tokenization, never wait on the model
+        if CRISIS_FAST_PATH and detect_crisis(user_message):
+            print(f"Crisis detected, skipping generation")
+            return respond(CRISIS_RESPONSE, "crisis", started)
         
-        with torch.no_grad():
-            outputs = model.generate(
-                inputs.input_ids,
-                max_new_tokens=request.max_tokens,
-                temperature=request.temperature,
-                top_p=0.9,
-                top_k=50,
-                do_sample=True,
-                pad_token_id=tokenizer.pad_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-                repetition_penalty=1.2,
-                no_repeat_ngram_size=3,
-                early_stopping=True
-            )
+        # Conversations that mentioned crisis anywhere jump the queue, and
+        # never get a canned small-talk reply
+        crisis_flagged = any(detect_crisis(message) for message in extract_user_messages(request.prompt))
+        priority_class = "crisis" if crisis_flagged else "normal"
+        
+        # Retrieval: curated dataset responses for simple intents
+        if intent_index is not None and not crisis_flagged:
+            metrics.incr("retrieval.lookups")
+            answer = intent_index.answer(user_message)
+            if answer:
+                intent, text = answer
+                metrics.incr("retrieval.hits")
+                metrics.incr(f"retrieval.intent.{intent}")
+                print(f"Retrieval hit: {intent}")
+                return respond(text, "retrieval", started)
+        
+        deadline = None
+        deadline_ms = request.deadline_ms
+        header = http_request.headers.get("x-deadline-ms")
+        if header and header.isdigit():
+            deadline_ms = min(deadline_ms, int(header)) if deadline_ms is not None else int(header)
+        if deadline_ms is not None:
+            deadline = started + deadline_ms / 1000
+        
+        # Quotas and fair queueing follow the client address, which a client
+        # cannot choose per request; the session (KV cache, prefill) may be
+        # its own id or, behind router.py, the router's affinity key
+        client = TRUSTED_PROXIES.client_address(http_request)
+        session = request.session_id or TRUSTED_PROXIES.forwarded_session(http_request) or client
+        stats["session"] = session
         
-        print(f"Generation complete")
+        # Session spilled to disk while idle: read it back while queued
+        restoring = None
+        if kv_cache is not None and kv_cache.spilled(session):
+            restoring = asyncio.create_task(run_in_threadpool(kv_cache.restore, session))
         
-        full_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        print(f"Raw output length: {len(full_response)} chars")
-        print(f"Raw output preview: {full_response[:200]}...")
+        # Rough token cost (~4 chars per token) for fair queueing and quotas
+        cost = len(request.prompt) // 4 + request.max_tokens
         
-        cleaned_response = clean_response(full_response, request.prompt)
-        print(f"Cleaned output length: {len(cleaned_response)} chars")
-        print(f"Cleaned output: {cleaned_response}")
+        # Crisis-flagged conversations are never throttled
+        if priority_class != "crisis":
+            quotas.charge(client, cost)
         
-        if not is_valid_response(cleaned_response):
-            print(f"Quality check failed!")
-            print(f" Using fallback response")
-            cleaned_response = get_fallback_response()
+        # Stop decoding for clients that have hung up
+        watcher = asyncio.create_task(watch_disconnect(http_request, token))
+        
+        async def work(cancellation: CancellationGroup):
+            async def attempt(handle: ModelHandle, model_scheduler: InferenceScheduler):
+                async with model_scheduler.slot(priority_class, client, cost, cancellation):
+                    # Lease after admission so a queued request runs on
+                    # whichever checkpoint is current when it starts
+                    if restoring is not None:
+                        await restoring
+                    with handle.lease() as loaded:
+                        text, route = await run_in_threadpool(
+                            run_model, loaded, request.prompt, request.max_tokens, request.temperature,
+                            cancellation, deadline, stats, messages
+                        )
+                # Next turn starts with prompt + reply: prefill it while the
+                # user is reading and typing
+                if prefiller is not None and route == "model":
+                    prefiller.schedule(session, loaded, request.prompt, text)
+                return text, route, loaded.name
+            
+            if request.adapter is not None:
+                async with lora_scheduler.slot(priority_class, client, cost, cancellation):
+                    text, route = await lora_batcher.submit(LoraRow(
+                        request.adapter, request.prompt, messages, request.max_tokens,
+                        request.temperature, cancellation, deadline, stats
+                    ))
+                result = (text, route, f"{lora.name}:{request.adapter}")
+            elif cascade is not None:
+                result = await cascade.run(attempt)
+            else:
+                result = await attempt(primary, scheduler)
+            metrics.observe(f"priority.{priority_class}", time.perf_counter() - started)
+            return result
+        
+        # Identical prompt+parameters already generating: share that result
+        if request.coalesce:
+            key = request_key(request.prompt, request.max_tokens, request.temperature, request.adapter)
+            timeout = deadline - time.perf_counter() if deadline is not None else None
+            (text, route, model_used), shared = await inflight.do(key, work, token, timeout)
+            metrics.incr("coalesce.shared" if shared else "coalesce.leader")
+            stats["shared"] = shared
+            if shared:
+                print(f"Coalesced with in-flight generation")
         else:
-            print(f"Quality check passed")
+            text, route, model_used = await work(CancellationGroup(token))
+        
+        if shadow is not None and request.adapter is None and not stats.get("shared"):
+            shadow.mirror(request.prompt, request.max_tokens, request.temperature, model_used, route, stats)
         
         print(f"Returning response")
+        return respond(text, route, started, model_used)
         
-        return GenerateResponse(
-            response=cleaned_response,
-            model_used=MODEL_NAME,
-            device=DEVICE
+    except QuotaExceeded as e:
+        print(f"Client {client} over quota")
+        metrics.incr("quota.rejected")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please slow down",
+            headers={"Retry-After": str(int(e.retry_after) + 1)}
         )
         
-    except torch.cuda.OutOfMemoryError:
-        print(f"CUDA Out of Memory")
-        return GenerateResponse(
-            response="I'm experiencing high load. Please try again in a moment.",
-            model_used=MODEL_NAME,
-            device=DEVICE
-        )
+    except (DeadlineExceeded, asyncio.TimeoutError) as e:
+        print(f"Deadline exceeded: {e}")
+        metrics.incr("deadline.rejected")
+        return respond(get_fallback_response(), "deadline", started)
+        
+    except GenerationCancelled as e:
+        print(f"Generation cancelled ({e.reason}), {e.tokens} tokens abandoned")
+        metrics.incr("cancel.generations")
+        metrics.incr("cancel.tokens_abandoned", e.tokens)
+        return respond(get_fallback_response(), "cancelled", started)
+        
+    except (torch.cuda.OutOfMemoryError, KVCacheFull) as e:
+        print(f"Out of memory: {e}")
+        return respond("I'm experiencing high load. Please try again in a moment.", "error", started)
         
     except Exception as e:
         print(f"Error: {str(e)}")
-        return GenerateResponse(
-            response=get_fallback_response(),
-            model_used=MODEL_NAME,
-            device=DEVICE
-        )
+        return respond(get_fallback_response(), "error", started)
+        
+    finally:
+        if watcher is not None:
+            watcher.cancel()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,112 @@
+"""
+Benchmark static-cache decoding (FREUD_STATIC_DECODE=1) against the eager
+generate() path before turning it on.
+
+    python bench_static_decode.py --model ../model/freud_model_neo_gpt
+
+Validation prompts (up to the last assistant header) are decoded for a
+fixed number of tokens with the backend's sampling settings by eager
+generate(), by the static cache without compilation and by the compiled
+static cache. Reports tokens/s per path and compile time. All three
+sample through sampling.Sampler; check_sampling.py covers its
+equivalence with generate()'s processors.
+"""
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import torch
+from transformers import StoppingCriteriaList
+
+from check_kv_quantization import split_reply
+from compress_deltas import DEFAULT_VALIDATION, load_prompts
+from model_loader import load_model
+from sampling import generate_kwargs
+from static_decode import StaticDecoder
+
+
+def eager(loaded, prompt_ids: List[int], max_new_tokens: int, temperature: float) -> torch.Tensor:
+    return loaded.model.generate(
+        torch.tensor([prompt_ids], device=loaded.device),
+        max_new_tokens=max_new_tokens,
+        pad_token_id=loaded.tokenizer.pad_token_id,
+        # Fixed-length replies on every path
+        eos_token_id=None,
+        **generate_kwargs(temperature)
+    )
+
+
+def static(decoder: StaticDecoder, loaded, prompt_ids: List[int], max_new_tokens: int,
+           temperature: float) -> torch.Tensor:
+    return decoder.generate(torch.tensor([prompt_ids], device=loaded.device), None, 0, max_new_tokens,
+                            temperature, loaded.tokenizer.pad_token_id, None, StoppingCriteriaList())
+
+
+def run(generate, prompts: List[List[int]], seed: int) -> Dict:
+    tokens = 0
+    started = time.perf_counter()
+    with torch.no_grad():
+        for index, prompt_ids in enumerate(prompts):
+            torch.manual_seed(seed + index)
+            tokens += generate(prompt_ids).shape[-1] - len(prompt_ids)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - started
+    return {"tokens": tokens, "tokens_per_s": round(tokens / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare static-cache and eager decoding throughput")
+    parser.add_argument("--model", required=True, help="GPT-Neo checkpoint the backend serves")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--validation", default=DEFAULT_VALIDATION, help="JSON list of training-format prompts")
+    parser.add_argument("--prompts", type=int, default=32, help="Validation prompts to decode")
+    parser.add_argument("--buckets", default="64,128,256,512", help="Prompt bucket lengths (FREUD_STATIC_BUCKETS)")
+    parser.add_argument("--max-length", type=int, default=1024, help="Static cache length (FREUD_STATIC_MAX_LENGTH)")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="Tokens decoded per prompt")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    loaded = load_model(args.model, args.device)
+    buckets = [int(b) for b in args.buckets.split(",")]
+    prompts = []
+    for text in load_prompts(args.validation, args.prompts):
+        split = split_reply(text, loaded.tokenizer)
+        if split is not None and len(split[0]) <= buckets[-1] \
+                and len(split[0]) + args.max_new_tokens <= args.max_length:
+            prompts.append(split[0])
+    if not prompts:
+        raise SystemExit("No usable validation prompts")
+
+    decoders = {}
+    compile_s = {}
+    for name, compile in (("static", False), ("compiled", True)):
+        started = time.perf_counter()
+        decoders[name] = StaticDecoder(loaded.model, buckets, args.max_length, 1, compile=compile)
+        decoders[name].warm_up()
+        compile_s[name] = round(time.perf_counter() - started, 1)
+
+    # Untimed pass so eager generate() is measured warm as well
+    run(lambda ids: eager(loaded, ids, 4, args.temperature), prompts[:2], args.seed)
+
+    results = {"eager": run(lambda ids: eager(loaded, ids, args.max_new_tokens, args.temperature),
+                            prompts, args.seed)}
+    for name, decoder in decoders.items():
+        results[name] = run(lambda ids: static(decoder, loaded, ids, args.max_new_tokens, args.temperature),
+                            prompts, args.seed)
+
+    report = {
+        "prompts": len(prompts),
+        "max_new_tokens": args.max_new_tokens,
+        "tokens_per_s": {name: result["tokens_per_s"] for name, result in results.items()},
+        "speedup": {name: round(result["tokens_per_s"] / results["eager"]["tokens_per_s"], 2)
+                    for name, result in results.items() if name != "eager"},
+        "warm_up_s": compile_s,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
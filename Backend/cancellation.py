@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from typing import Optional
+
+from transformers import StoppingCriteria
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised when a generation is aborted; tokens is the decode work thrown away
+    """
+
+    def __init__(self, reason: str, tokens: int = 0):
+        super().__init__(reason)
+        self.reason = reason
+        self.tokens = tokens
+
+
+class CancellationToken:
+    """
+    Thread-safe flag set from the event loop, read by the decode thread
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class CancellationGroup:
+    """
+    Tokens of every request sharing one generation; the generation is only
+    cancelled once all of them are (a coalesced follower may still be waiting)
+    """
+
+    def __init__(self, *tokens: CancellationToken):
+        self._tokens = list(tokens)
+
+    def add(self, token: CancellationToken):
+        self._tokens.append(token)
+
+    @property
+    def cancelled(self) -> bool:
+        tokens = self._tokens
+        return bool(tokens) and all(token.cancelled for token in tokens)
+
+    @property
+    def reason(self) -> Optional[str]:
+        for token in self._tokens:
+            if token.reason:
+                return token.reason
+        return None
+
+
+class CancellationCriteria(StoppingCriteria):
+    """
+    Checked by model.generate after every decode step
+    """
+
+    def __init__(self, cancellation: CancellationGroup):
+        self.cancellation = cancellation
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.cancellation.cancelled
+
+
+async def watch_disconnect(http_request, token: CancellationToken, interval: float = 0.25):
+    """
+    Poll the client connection and cancel the token once it is gone
+    """
+    while not token.cancelled:
+        if await http_request.is_disconnected():
+            token.cancel("client disconnected")
+            return
+        await asyncio.sleep(interval)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import re
+import threading
+from typing import Dict, Optional
+
+# Replacement vocabulary for anonymised prompts: common words that are one
+# GPT-2 token each, so anonymised prompts keep roughly the original length
+FILLER_WORDS = (
+    "the be to of and a in that have it for not on with he as you do at "
+    "this but his by from they we say her she or an will my one all would "
+    "there their what so up out if about who get which go me when make can "
+    "like time no just him know take people into year your good some could "
+    "them see other than then now look only come its over think also back "
+    "after use two how our work first well way even new want because any"
+).split()
+
+# Structure that is kept verbatim: role tags and emotion annotations
+STRUCTURE_PATTERN = re.compile(r"(<\|\w+\|>:|\[emotion:\s*\w+\])")
+WORD_PATTERN = re.compile(r"[A-Za-z0-9']+")
+
+PROMPT_MODES = ("hash", "anonymised", "raw")
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def anonymise(prompt: str) -> str:
+    """
+    Keep the chat structure, replace every word with a deterministic filler
+    word chosen by hash (same prompt -> same anonymised prompt)
+    """
+    def replace(match):
+        word = match.group(0)
+        index = int(hashlib.md5(word.lower().encode("utf-8")).hexdigest(), 16) % len(FILLER_WORDS)
+        return FILLER_WORDS[index]
+
+    parts = STRUCTURE_PATTERN.split(prompt)
+    return "".join(
+        part if STRUCTURE_PATTERN.fullmatch(part) else WORD_PATTERN.sub(replace, part)
+        for part in parts
+    )
+
+
+class TrafficRecorder:
+    """
+    Append-only JSON-lines log of served requests, for replay.py.
+
+    prompt_mode: "hash" stores only a digest, "anonymised" stores the prompt
+    with its words replaced, "raw" stores it verbatim.
+    """
+
+    def __init__(self, path: str, prompt_mode: str = "hash"):
+        if prompt_mode not in PROMPT_MODES:
+            raise ValueError(f"prompt_mode must be one of {PROMPT_MODES}")
+        self.path = path
+        self.prompt_mode = prompt_mode
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+        print(f"Capturing traffic to {path} (prompts: {prompt_mode})")
+
+    def record(self, arrived: float, prompt: str, params: Dict, latency: float,
+               route: str, stats: Dict, session: Optional[str] = None):
+        entry = {
+            "ts": round(arrived, 4),
+            "prompt_hash": digest(prompt),
+            "prompt_chars": len(prompt),
+            "prompt_tokens": stats.get("prompt_tokens"),
+            "generated_tokens": stats.get("generated_tokens"),
+            "params": params,
+            "session": digest(session) if session else None,
+            "route": route,
+            "valid": route not in ("fallback", "error", "cancelled", "deadline") and not route.startswith("http_"),
+            "shared": stats.get("shared", False),
+            "latency_ms": round(latency * 1000, 2),
+        }
+        if self.prompt_mode == "anonymised":
+            entry["prompt"] = anonymise(prompt)
+        elif self.prompt_mode == "raw":
+            entry["prompt"] = prompt
+
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
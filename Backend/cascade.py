@@ -0,0 +1,51 @@
+import time
+from typing import Awaitable, Callable, Tuple
+
+from metrics import metrics
+from hotswap import ModelHandle
+from scheduler import InferenceScheduler
+
+# attempt(model, scheduler) -> (text, route, name of the model that ran);
+# route "fallback" means the output failed is_valid_response
+Attempt = Callable[[ModelHandle, InferenceScheduler], Awaitable[Tuple[str, str, str]]]
+
+
+class Cascade:
+    """
+    Small model first, large model only when it is needed or free.
+
+    A turn goes straight to the large model when it has an idle slot (its
+    capacity would otherwise be wasted); otherwise the small model answers
+    and the turn is escalated only if that answer fails validation.
+    """
+
+    def __init__(self, small: ModelHandle, small_scheduler: InferenceScheduler,
+                 large: ModelHandle, large_scheduler: InferenceScheduler):
+        self.small = small
+        self.small_scheduler = small_scheduler
+        self.large = large
+        self.large_scheduler = large_scheduler
+
+    async def _timed(self, path: str, attempt: Attempt, model: ModelHandle,
+                     scheduler: InferenceScheduler) -> Tuple[str, str, str]:
+        started = time.perf_counter()
+        result = await attempt(model, scheduler)
+        metrics.observe(f"cascade.{path}", time.perf_counter() - started)
+        return result
+
+    async def run(self, attempt: Attempt) -> Tuple[str, str, str]:
+        """
+        Returns (text, route, name of the model that produced it)
+        """
+        if self.large_scheduler.has_capacity():
+            metrics.incr("cascade.large_direct")
+            return await self._timed("large_direct", attempt, self.large, self.large_scheduler)
+
+        metrics.incr("cascade.small")
+        text, route, model_used = await self._timed("small", attempt, self.small, self.small_scheduler)
+        if route != "fallback":
+            return text, route, model_used
+
+        print(f"Small model output rejected, escalating to {self.large.name}")
+        metrics.incr("cascade.escalated")
+        return await self._timed("escalated", attempt, self.large, self.large_scheduler)
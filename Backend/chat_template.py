@@ -0,0 +1,82 @@
+import threading
+from typing import Dict, List, Sequence
+
+from prompting import (
+    ASSISTANT_HEADER,
+    EMOTIONS,
+    GENERATION_HEADER,
+    SYSTEM_PROMPT,
+    ChatMessage,
+    chat_segments,
+    format_chat,
+    user_header,
+)
+
+# Free-form emotion tags are cached too, up to this many fragments
+MAX_FRAGMENTS = 256
+
+# Conversations whose joined-string tokenization the fragments must
+# reproduce before they are trusted: trailing/leading whitespace, blank
+# and multi-line messages, contractions and tag-like text
+SELF_CHECK = [
+    [("user", "Hello", "neutral")],
+    [("user", "I'm tired.  ", "stressed"), ("assistant", " That sounds hard.", None),
+     ("user", "\nit's  been\n\na long week\n", "sad")],
+    [("user", "", None), ("assistant", "", None), ("user", "  ", "angry")],
+    [("user", "[emotion: happy] <|user|>: 123 's", "happy"), ("assistant", "Okay\n", None),
+     ("user", "\t\tpanic\t", "anxious")],
+]
+
+
+class ChatTemplate:
+    """
+    Token ids for /chat messages built from pre-tokenized template fragments
+    (system prompt, role headers, one per emotion tag), tokenizing only the
+    message text.
+
+    `exact` is False when this tokenizer does not reproduce the joined
+    string's tokenization piecewise (e.g. whitespace-stripping added tokens);
+    encode() then tokenizes the joined string instead.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._lock = threading.Lock()
+        self._fragments: Dict[str, List[int]] = {}
+        for fragment in [SYSTEM_PROMPT, ASSISTANT_HEADER, GENERATION_HEADER] + [user_header(e) for e in EMOTIONS]:
+            self._fragment(fragment)
+
+        self.exact = all(self._encode_pieces(m) == self._encode_joined(m) for m in SELF_CHECK)
+        if not self.exact:
+            print(f"Chat template fragments do not match joined tokenization for "
+                  f"{type(tokenizer).__name__}, /chat will tokenize the full prompt")
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _fragment(self, text: str) -> List[int]:
+        ids = self._fragments.get(text)
+        if ids is None:
+            ids = self._tokenize(text)
+            with self._lock:
+                if len(self._fragments) < MAX_FRAGMENTS:
+                    self._fragments[text] = ids
+        return ids
+
+    def _encode_pieces(self, messages: Sequence[ChatMessage]) -> List[int]:
+        ids = []
+        for is_template, text in chat_segments(messages):
+            ids.extend(self._fragment(text) if is_template else self._tokenize(text))
+        return self.tokenizer.build_inputs_with_special_tokens(ids)
+
+    def _encode_joined(self, messages: Sequence[ChatMessage]) -> List[int]:
+        return self.tokenizer(format_chat(messages))["input_ids"]
+
+    def encode(self, messages: Sequence[ChatMessage], max_length: int) -> List[int]:
+        """
+        Same ids as tokenizer(format_chat(messages), truncation=True, max_length=max_length)
+        """
+        ids = self._encode_pieces(messages) if self.exact else self._encode_joined(messages)
+        if len(ids) > max_length:
+            ids = ids[-max_length:] if self.tokenizer.truncation_side == "left" else ids[:max_length]
+        return ids
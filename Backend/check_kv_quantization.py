@@ -0,0 +1,160 @@
+"""
+Check int8 session KV caching (FREUD_KV_CACHE_INT8=1) against fp caching
+on validation conversations before turning it on.
+
+    python check_kv_quantization.py --model Dalton-Khatri/freud-mental-health-assistant
+
+For each conversation the prompt up to the last assistant header is
+prefilled, the cache is stored as fp and as int8, and the reply is scored
+on top of both: perplexity of the reference reply, next-token agreement and
+KL, and the backend's own validity check on a greedy reply. Memory per
+session and sessions per GB are reported for both.
+"""
+import argparse
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from compress_deltas import DEFAULT_VALIDATION, load_prompts
+from kv_cache import QuantizedPast, legacy_past, past_bytes
+from model_loader import load_model
+from prompting import ASSISTANT_HEADER
+from responses import clean_response, is_valid_response
+from stopping import find_stop
+
+GB = 1024 ** 3
+
+
+def split_reply(text: str, tokenizer) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    (prompt ids through the last assistant header, reference reply ids)
+    """
+    cut = text.rfind(ASSISTANT_HEADER)
+    if cut < 0:
+        return None
+    prompt = text[:cut + len(ASSISTANT_HEADER) + 1]
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    ids = tokenizer(text)["input_ids"]
+    if ids[:len(prompt_ids)] != prompt_ids or len(ids) == len(prompt_ids):
+        return None
+    return prompt_ids, ids[len(prompt_ids):]
+
+
+def reply(loaded, prompt_ids: List[int], past, max_new_tokens: int) -> str:
+    """
+    Greedy reply on top of a cached prefix, decoded, cut and cleaned the way
+    the backend does
+    """
+    tokenizer = loaded.tokenizer
+    outputs = loaded.model.generate(
+        torch.tensor([prompt_ids], device=loaded.device),
+        past_key_values=past,
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        repetition_penalty=1.2,
+        no_repeat_ngram_size=3,
+    )
+    generated = outputs[0, len(prompt_ids):].tolist()
+    stop = find_stop(generated, loaded.token_texts)
+    return clean_response(tokenizer.decode(generated[:stop], skip_special_tokens=True))
+
+
+def evaluate(loaded, conversations: List[Tuple[List[int], List[int]]], max_new_tokens: int) -> Dict:
+    device = loaded.device
+    totals = {"fp": {"nll": 0.0, "valid": 0}, "int8": {"nll": 0.0, "valid": 0}}
+    tokens = agree = same_reply = 0
+    kl = 0.0
+    fp_bytes = int8_bytes = 0
+    dequantize_s = 0.0
+
+    with torch.no_grad():
+        for prompt_ids, reply_ids in conversations:
+            prefix = torch.tensor([prompt_ids[:-1]], device=device)
+            fp_past = legacy_past(loaded.model(prefix, use_cache=True).past_key_values)
+            quantized = QuantizedPast.from_past(fp_past)
+            started = time.perf_counter()
+            int8_past = quantized.dequantize()
+            dequantize_s += time.perf_counter() - started
+            fp_bytes += past_bytes(fp_past)
+            int8_bytes += quantized.bytes
+
+            # Last prompt token plus the reference reply, scored on each cache
+            rest = torch.tensor([prompt_ids[-1:] + reply_ids[:-1]], device=device)
+            target = torch.tensor(reply_ids, device=device)
+            logits = {}
+            for name, past in (("fp", fp_past), ("int8", int8_past)):
+                logits[name] = loaded.model(rest, past_key_values=past).logits[0].float()
+                totals[name]["nll"] += F.cross_entropy(logits[name], target, reduction="sum").item()
+            tokens += len(reply_ids)
+            agree += (logits["fp"].argmax(-1) == logits["int8"].argmax(-1)).sum().item()
+            kl += F.kl_div(logits["int8"].log_softmax(-1), logits["fp"].log_softmax(-1),
+                           log_target=True, reduction="sum").item()
+
+            texts = {}
+            for name, past in (("fp", fp_past), ("int8", int8_past)):
+                texts[name] = reply(loaded, prompt_ids, past, max_new_tokens)
+                totals[name]["valid"] += is_valid_response(texts[name])
+            same_reply += texts["fp"] == texts["int8"]
+
+    count = len(conversations)
+    perplexity = {name: round(float(torch.exp(torch.tensor(total["nll"] / tokens))), 4)
+                  for name, total in totals.items()}
+    return {
+        "conversations": count,
+        "reply_tokens": tokens,
+        "perplexity": perplexity,
+        "perplexity_increase": round(perplexity["int8"] / perplexity["fp"] - 1, 5),
+        "top1_agreement": round(agree / tokens, 4),
+        "mean_kl": round(kl / tokens, 6),
+        "valid_rate": {name: round(total["valid"] / count, 3) for name, total in totals.items()},
+        "identical_greedy_replies": round(same_reply / count, 3),
+        "mb_per_session": {
+            "fp": round(fp_bytes / count / (1024 * 1024), 2),
+            "int8": round(int8_bytes / count / (1024 * 1024), 2),
+        },
+        "sessions_per_gb": {
+            "fp": int(GB / (fp_bytes / count)),
+            "int8": int(GB / (int8_bytes / count)),
+        },
+        "dequantize_ms_per_session": round(dequantize_s / count * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8 and fp session KV caches")
+    parser.add_argument("--model", required=True, help="Checkpoint the backend serves")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--validation", default=DEFAULT_VALIDATION, help="JSON list of training-format prompts")
+    parser.add_argument("--prompts", type=int, default=64, help="Validation conversations to score")
+    parser.add_argument("--max-length", type=int, default=512, help="Skip longer conversations")
+    parser.add_argument("--max-new-tokens", type=int, default=48, help="Greedy reply length for validity")
+    parser.add_argument("--max-perplexity-increase", type=float, default=0.01,
+                        help="Fail if int8 perplexity is higher than fp by more than this fraction")
+    parser.add_argument("--max-valid-drop", type=float, default=0.02,
+                        help="Fail if the int8 valid rate is lower than fp by more than this")
+    args = parser.parse_args()
+
+    loaded = load_model(args.model, args.device)
+    conversations = []
+    for text in load_prompts(args.validation, args.prompts):
+        split = split_reply(text, loaded.tokenizer)
+        if split is not None and len(split[0]) + len(split[1]) <= args.max_length:
+            conversations.append(split)
+    if not conversations:
+        raise SystemExit("No usable validation conversations")
+
+    report = evaluate(loaded, conversations, args.max_new_tokens)
+    print(json.dumps(report, indent=2))
+
+    if report["perplexity_increase"] > args.max_perplexity_increase \
+            or report["valid_rate"]["fp"] - report["valid_rate"]["int8"] > args.max_valid_drop:
+        raise SystemExit("int8 KV cache degrades quality beyond the limits; keep FREUD_KV_CACHE_INT8 off")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Check the fused sampler (sampling.py) against generate()'s own logits
+processors for the backend's settings.
+
+    python check_sampling.py --model Dalton-Khatri/freud-mental-health-assistant
+
+Validation prompts are decoded with the Sampler. At every step both
+pipelines score the same ids and logits, and the report gives the total
+variation distance between their next-token distributions, how often
+they keep different token sets, and the time per step of each.
+"""
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from check_kv_quantization import split_reply
+from compress_deltas import DEFAULT_VALIDATION, load_prompts
+from model_loader import load_model
+from sampling import NO_REPEAT_NGRAM_SIZE, REPETITION_PENALTY, TOP_K, TOP_P, Sampler
+
+
+def reference_processors(temperature: float) -> LogitsProcessorList:
+    """The processors generate() builds for the backend's settings, in its order"""
+    return LogitsProcessorList([
+        RepetitionPenaltyLogitsProcessor(REPETITION_PENALTY),
+        NoRepeatNGramLogitsProcessor(NO_REPEAT_NGRAM_SIZE),
+        TemperatureLogitsWarper(temperature),
+        TopKLogitsWarper(TOP_K),
+        TopPLogitsWarper(TOP_P),
+    ])
+
+
+def timed(function, *args):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    started = time.perf_counter()
+    result = function(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - started
+
+
+def compare(loaded, prompts: List[List[int]], max_new_tokens: int, temperature: float) -> Dict:
+    steps = different_sets = 0
+    total_tv = max_tv = 0.0
+    reference_s = sampler_s = 0.0
+
+    with torch.no_grad():
+        for prompt_ids in prompts:
+            sampler = Sampler(temperature)
+            processors = reference_processors(temperature)
+            ids = torch.tensor([prompt_ids], device=loaded.device)
+            past = None
+            for _ in range(max_new_tokens):
+                output = loaded.model(ids if past is None else ids[:, -1:], past_key_values=past, use_cache=True)
+                past = output.past_key_values
+                logits = output.logits[:, -1].float()
+
+                expected, seconds = timed(processors, ids, logits.clone())
+                reference_s += seconds
+                (values, indices), seconds = timed(sampler.filter, ids, logits)
+                sampler_s += seconds
+
+                expected = expected.softmax(dim=-1)[0]
+                probs = torch.zeros_like(expected).scatter(0, indices[0], values.softmax(dim=-1)[0])
+                tv = 0.5 * (expected - probs).abs().sum().item()
+                total_tv += tv
+                max_tv = max(max_tv, tv)
+                different_sets += not torch.equal(expected > 0, probs > 0)
+                steps += 1
+
+                choice = torch.multinomial(values.softmax(dim=-1), num_samples=1)
+                token = indices.gather(1, choice)
+                if token.item() == loaded.tokenizer.eos_token_id:
+                    break
+                ids = torch.cat([ids, token], dim=-1)
+
+    return {
+        "prompts": len(prompts),
+        "steps": steps,
+        "mean_total_variation": round(total_tv / steps, 8),
+        "max_total_variation": round(max_tv, 8),
+        "different_kept_sets": round(different_sets / steps, 5),
+        "ms_per_step": {
+            "generate_processors": round(reference_s / steps * 1000, 3),
+            "sampler": round(sampler_s / steps * 1000, 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fused sampler with generate()'s processors")
+    parser.add_argument("--model", required=True, help="Checkpoint the backend serves")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--validation", default=DEFAULT_VALIDATION, help="JSON list of training-format prompts")
+    parser.add_argument("--prompts", type=int, default=32, help="Validation prompts to decode")
+    parser.add_argument("--max-length", type=int, default=512, help="Skip longer prompts")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="Steps compared per prompt")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--max-total-variation", type=float, default=1e-3,
+                        help="Fail if any step's distributions differ by more than this")
+    args = parser.parse_args()
+
+    loaded = load_model(args.model, args.device)
+    prompts = []
+    for text in load_prompts(args.validation, args.prompts):
+        split = split_reply(text, loaded.tokenizer)
+        if split is not None and len(split[0]) <= args.max_length:
+            prompts.append(split[0])
+    if not prompts:
+        raise SystemExit("No usable validation prompts")
+
+    report = compare(loaded, prompts, args.max_new_tokens, args.temperature)
+    print(json.dumps(report, indent=2))
+
+    if report["max_total_variation"] > args.max_total_variation:
+        raise SystemExit("Sampler distributions differ from generate()'s processors beyond the limit")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import ipaddress
+from typing import List, Optional
+
+from starlette.requests import Request
+
+
+class TrustedProxies:
+    """
+    Proxies (router.py, a load balancer) whose X-Forwarded-For and
+    X-Session-Id headers are believed.
+
+    Quotas and fair queueing are keyed on client_address(): session ids and
+    headers from anyone else are chosen by the client, so a client could
+    pick a new one per request and get a fresh bucket and queue each time.
+    """
+
+    def __init__(self, networks: List[str]):
+        self.networks = [ipaddress.ip_network(network.strip(), strict=False) for network in networks if network.strip()]
+
+    def trusted(self, host: Optional[str]) -> bool:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def client_address(self, http_request: Request) -> str:
+        """
+        The peer, or behind trusted proxies the last X-Forwarded-For hop
+        they did not add (hops in front of it are the client's own claims)
+        """
+        # uvicorn may already have resolved X-Forwarded-For for its own
+        # --forwarded-allow-ips, leaving no host when every hop was trusted
+        peer = http_request.client.host if http_request.client and http_request.client.host else "anonymous"
+        if not self.trusted(peer):
+            return peer
+        hops = [hop.strip() for hop in http_request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not self.trusted(hop):
+                return hop
+        return peer
+
+    def forwarded_session(self, http_request: Request) -> Optional[str]:
+        """X-Session-Id, only when a trusted proxy set it"""
+        if http_request.client is None or not self.trusted(http_request.client.host):
+            return None
+        return http_request.headers.get("x-session-id")
@@ -0,0 +1,65 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from cancellation import CancellationGroup, CancellationToken
+
+
+def request_key(prompt: str, max_tokens: int, temperature: float, adapter: Optional[str] = None) -> str:
+    """
+    Identity of a generation: same prompt, sampling parameters and adapter
+    """
+    raw = f"{max_tokens}\x00{temperature:.4f}\x00{prompt}"
+    if adapter is not None:
+        raw = f"{adapter}\x00{raw}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: the first caller for a key runs the
+    work, callers arriving while it is in flight await the same result.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, Tuple[asyncio.Future, CancellationGroup]] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: str, fn: Callable[[CancellationGroup], Awaitable[Any]],
+                 token: CancellationToken, timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Return (result, shared); shared is True if another caller did the work.
+
+        fn receives the group of every caller's token, so the shared work is
+        only cancelled once all callers have gone away. timeout bounds how long
+        a follower waits on someone else's work (asyncio.TimeoutError).
+        """
+        flight = self._inflight.get(key)
+        if flight is not None:
+            future, group = flight
+            group.add(token)
+            # Shield so one follower going away does not cancel the leader
+            return await asyncio.wait_for(asyncio.shield(future), timeout), True
+
+        future = asyncio.get_running_loop().create_future()
+        group = CancellationGroup(token)
+        self._inflight[key] = (future, group)
+
+        try:
+            result = await fn(group)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._inflight.pop(key, None)
+
+        return result, False
@@ -0,0 +1,255 @@
+"""
+Compress full fine-tunes of one base model into small per-layer deltas,
+so the backend can serve every variant from a single copy of the base.
+
+    python compress_deltas.py --base EleutherAI/gpt-neo-125m \
+        --variant freud=../model/freud_model --variant neo=../model/freud_model_neo_gpt \
+        --output ../model/deltas
+
+Each weight matrix's delta from the base is factorized as a rank-r SVD
+term plus the largest-magnitude entries of the residual (sparse), then the
+reconstructed model is checked against the full fine-tune on validation
+prompts. Serve the result with FREUD_ADAPTERS=freud=../model/deltas/freud,...
+and the `adapter` request field.
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from delta import DELTA_CONFIG, DELTA_WEIGHTS
+
+DEFAULT_VALIDATION = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "tokenizer", "freud_training_data", "validation.json"
+)
+
+
+def factorize(delta: torch.Tensor, rank: int, density: float) -> Tuple[torch.Tensor, torch.Tensor,
+                                                                        torch.Tensor, torch.Tensor]:
+    """
+    delta ~= a @ b + sparse; returns (a, b, sparse indices, sparse values)
+    """
+    u, s, vh = torch.linalg.svd(delta, full_matrices=False)
+    rank = min(rank, s.numel())
+    a = u[:, :rank] * s[:rank]
+    b = vh[:rank]
+    residual = delta - a @ b
+
+    keep = int(density * residual.numel())
+    if keep == 0:
+        return a, b, torch.zeros((2, 0), dtype=torch.int32), torch.zeros(0)
+    flat = residual.abs().flatten()
+    positions = torch.topk(flat, keep).indices.sort().values
+    rows = positions // residual.shape[1]
+    cols = positions % residual.shape[1]
+    indices = torch.stack([rows, cols]).to(torch.int32)
+    return a, b, indices, residual[rows, cols]
+
+
+def reconstruct(a: torch.Tensor, b: torch.Tensor, indices: torch.Tensor, values: torch.Tensor) -> torch.Tensor:
+    approx = a @ b
+    approx[indices[0].long(), indices[1].long()] += values
+    return approx
+
+
+def compress(base, variant, rank: int, density: float) -> Tuple[Dict[str, torch.Tensor], Dict, Dict]:
+    """
+    Returns (tensors to save, per-module config, per-module relative error)
+    """
+    base_modules = dict(base.named_modules())
+    variant_modules = dict(variant.named_modules())
+    base_head = base.get_output_embeddings()
+    tensors, modules, errors = {}, {}, {}
+
+    for name, module in base_modules.items():
+        tuned = variant_modules.get(name)
+        if module is base_head and base_head.weight is base.get_input_embeddings().weight:
+            # Tied to the input embedding; its delta is carried there
+            continue
+
+        if isinstance(module, torch.nn.LayerNorm):
+            if torch.equal(module.weight, tuned.weight) and torch.equal(module.bias, tuned.bias):
+                continue
+            tensors[f"{name}.weight"] = tuned.weight.detach().clone()
+            tensors[f"{name}.bias"] = tuned.bias.detach().clone()
+            modules[name] = {"kind": "layernorm", "eps": module.eps}
+            continue
+
+        if not isinstance(module, (torch.nn.Linear, torch.nn.Embedding)):
+            if any(True for _ in module.parameters(recurse=False)):
+                raise ValueError(f"{name} ({type(module).__name__}) has parameters this tool does not handle")
+            continue
+
+        delta = (tuned.weight - module.weight).detach().float()
+        bias_delta = None
+        if isinstance(module, torch.nn.Linear) and module.bias is not None:
+            bias_delta = (tuned.bias - module.bias).detach().float()
+            if not bias_delta.any():
+                bias_delta = None
+        if not delta.any() and bias_delta is None:
+            continue
+
+        a, b, indices, values = factorize(delta, rank, density)
+        tensors[f"{name}.a"] = a.contiguous()
+        tensors[f"{name}.b"] = b.contiguous()
+        if values.numel():
+            tensors[f"{name}.sparse_indices"] = indices
+            tensors[f"{name}.sparse_values"] = values
+        if bias_delta is not None:
+            tensors[f"{name}.bias"] = bias_delta
+
+        entry = {"kind": "linear" if isinstance(module, torch.nn.Linear) else "embedding",
+                 "shape": list(delta.shape), "rank": a.shape[1], "nnz": values.numel()}
+        if isinstance(module, torch.nn.Embedding) and base_head is not None \
+                and base_head.weight is module.weight:
+            entry["tied"] = next(n for n, m in base_modules.items() if m is base_head)
+        modules[name] = entry
+
+        norm = delta.norm().item()
+        error = (delta - reconstruct(a, b, indices, values)).norm().item()
+        errors[name] = round(error / norm, 4) if norm else 0.0
+
+    return tensors, modules, errors
+
+
+def apply_dense(model, tensors: Dict[str, torch.Tensor], modules: Dict):
+    """
+    Add the reconstructed deltas into `model`'s weights (accuracy check only)
+    """
+    named = dict(model.named_modules())
+    with torch.no_grad():
+        for name, entry in modules.items():
+            module = named[name]
+            if entry["kind"] == "layernorm":
+                module.weight.copy_(tensors[f"{name}.weight"])
+                module.bias.copy_(tensors[f"{name}.bias"])
+                continue
+            indices = tensors.get(f"{name}.sparse_indices", torch.zeros((2, 0), dtype=torch.int32))
+            values = tensors.get(f"{name}.sparse_values", torch.zeros(0))
+            module.weight += reconstruct(tensors[f"{name}.a"], tensors[f"{name}.b"], indices, values).to(module.weight.dtype)
+            if f"{name}.bias" in tensors:
+                module.bias += tensors[f"{name}.bias"].to(module.bias.dtype)
+
+
+def load_prompts(path: str, count: int) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return [entry["text"] if isinstance(entry, dict) else entry for entry in data[:count]]
+
+
+def accuracy(reference, approx, tokenizer, prompts: List[str], max_length: int) -> Dict:
+    """
+    Next-token agreement and KL(reference || approx) over every position
+    """
+    agree = total = 0
+    kl = 0.0
+    max_diff = 0.0
+    with torch.no_grad():
+        for prompt in prompts:
+            ids = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=max_length).input_ids
+            ref = reference(ids).logits[0].float()
+            out = approx(ids).logits[0].float()
+            agree += (ref.argmax(-1) == out.argmax(-1)).sum().item()
+            total += ids.shape[-1]
+            kl += F.kl_div(out.log_softmax(-1), ref.log_softmax(-1), log_target=True, reduction="sum").item()
+            max_diff = max(max_diff, (ref - out).abs().max().item())
+    return {
+        "prompts": len(prompts),
+        "positions": total,
+        "top1_agreement": round(agree / total, 4) if total else None,
+        "mean_kl": round(kl / total, 6) if total else None,
+        "max_logit_diff": round(max_diff, 4),
+    }
+
+
+def size_mb(tensors: Dict[str, torch.Tensor]) -> float:
+    return round(sum(t.numel() * t.element_size() for t in tensors.values()) / (1024 * 1024), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delta-compress fine-tunes of a shared base model")
+    parser.add_argument("--base", required=True, help="Base checkpoint the variants were fine-tuned from")
+    parser.add_argument("--variant", action="append", required=True, help="name=path of a full fine-tune")
+    parser.add_argument("--output", required=True, help="Directory to write one sub-directory per variant")
+    parser.add_argument("--rank", type=int, default=64, help="Rank of the low-rank term per matrix")
+    parser.add_argument("--density", type=float, default=0.005, help="Fraction of residual entries kept")
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"], default="float16",
+                        help="Storage dtype of the factors")
+    parser.add_argument("--validation", default=DEFAULT_VALIDATION, help="JSON list of training-format prompts")
+    parser.add_argument("--prompts", type=int, default=32, help="Validation prompts for the accuracy check")
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--min-agreement", type=float, default=0.97,
+                        help="Fail a variant whose top-1 agreement with the fine-tune is lower")
+    parser.add_argument("--max-kl", type=float, default=0.02,
+                        help="Fail a variant whose mean KL from the fine-tune is higher")
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    base = AutoModelForCausalLM.from_pretrained(args.base, torch_dtype=torch.float32).eval()
+    base_tokenizer = AutoTokenizer.from_pretrained(args.base, use_fast=False)
+    prompts = load_prompts(args.validation, args.prompts)
+    base_mb = round(sum(p.numel() * p.element_size() for p in base.parameters()) / (1024 * 1024) / 2, 1)
+
+    failed = []
+    for spec in args.variant:
+        name, _, path = spec.partition("=")
+        print(f"\nVariant {name}: {path}")
+        started = time.perf_counter()
+
+        variant = AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32).eval()
+        tokenizer = AutoTokenizer.from_pretrained(path, use_fast=False)
+        if tokenizer.get_vocab() != base_tokenizer.get_vocab():
+            raise SystemExit(f"{name}: tokenizer differs from the base, cannot be served on it")
+
+        tensors, modules, errors = compress(base, variant, args.rank, args.density)
+        tensors = {key: t if key.endswith("sparse_indices") else t.to(dtype) for key, t in tensors.items()}
+
+        approx = AutoModelForCausalLM.from_pretrained(args.base, torch_dtype=torch.float32).eval()
+        apply_dense(approx, {key: t.float() if t.is_floating_point() else t for key, t in tensors.items()}, modules)
+        check = accuracy(variant, approx, tokenizer, prompts, args.max_length)
+
+        worst = sorted(errors.items(), key=lambda item: -item[1])[:5]
+        report = {
+            "delta_mb": size_mb(tensors),
+            "full_fp16_mb": base_mb,
+            "modules": len(modules),
+            "worst_relative_error": dict(worst),
+            "accuracy": check,
+            "seconds": round(time.perf_counter() - started, 1),
+        }
+        print(json.dumps(report, indent=2))
+
+        if check["positions"] and (check["top1_agreement"] < args.min_agreement or check["mean_kl"] > args.max_kl):
+            print(f"{name}: top-1 agreement {check['top1_agreement']} / mean KL {check['mean_kl']} "
+                  f"outside limits ({args.min_agreement} / {args.max_kl}), not written")
+            failed.append(name)
+            continue
+
+        from safetensors.torch import save_file
+
+        directory = os.path.join(args.output, name)
+        os.makedirs(directory, exist_ok=True)
+        save_file(tensors, os.path.join(directory, DELTA_WEIGHTS))
+        with open(os.path.join(directory, DELTA_CONFIG), "w") as f:
+            json.dump({
+                "base": args.base,
+                "source": path,
+                "rank": args.rank,
+                "density": args.density,
+                "dtype": args.dtype,
+                "modules": modules,
+                "report": report,
+            }, f, indent=2)
+        print(f"{name}: written to {directory}")
+
+    if failed:
+        raise SystemExit(f"Accuracy check failed for {', '.join(failed)}; raise --rank or --density")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import re
+
+# Union of the keyword lists used by the Flutter client (detectCrisis),
+# HierarchicalEmotionClassifier.check_crisis and the keyword IntentClassifier
+CRISIS_KEYWORDS = [
+    "suicide",
+    "suicidal",
+    "kill myself",
+    "end it all",
+    "want to die",
+    "self harm",
+    "self-harm",
+    "hurt myself",
+    "no reason to live",
+    "better off dead",
+    "better off without me",
+    "end my life",
+    "take my life",
+    "i am a burden",
+    "life is not worth living",
+    "nothing to live for",
+    "aatmahatya",
+    "marnu",
+    "jeevan sakaunu",
+]
+
+# Compiled once at import: a single alternation scans the message in one pass
+# instead of one substring search per keyword
+CRISIS_PATTERN = re.compile(
+    r"\b(?:" + "|".join(re.escape(k) for k in sorted(CRISIS_KEYWORDS, key=len, reverse=True)) + r")",
+    re.IGNORECASE
+)
+
+# Self-reference rule from check_crisis, extended with Nepali first person
+# pronouns so the romanized keywords are not filtered out
+SELF_REFERENCE_PATTERN = re.compile(r"\b(?:i|me|my|myself|i'm|im|ma|mero|malai)\b", re.IGNORECASE)
+
+CRISIS_RESPONSE = """I'm concerned about what you're sharing. Please know that you're not alone, and there are people who can help immediately.
+
+Nepal Crisis Helplines:
+• National Mental Health Helpline: 1660 0102005
+• Transcultural Psychosocial Organization (TPO): 9840021600
+• Centre for Mental Health and Counselling (CMC): 01-4102037
+
+If you're in immediate danger, please:
+• Call Police: 100
+• Call Ambulance: 102
+• Reach out to a trusted friend or family member
+
+I'm here to support you, but professional help is crucial right now. Please consider calling one of these numbers."""
+
+
+def detect_crisis(text: str) -> bool:
+    """
+    Crisis keywords with self-reference (same rule as check_crisis)
+    """
+    if not text:
+        return False
+
+    if not CRISIS_PATTERN.search(text):
+        return False
+
+    return SELF_REFERENCE_PATTERN.search(text) is not None
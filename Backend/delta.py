@@ -0,0 +1,162 @@
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+DELTA_CONFIG = "delta.json"
+DELTA_WEIGHTS = "delta.safetensors"
+
+
+class LowRankDelta:
+    """
+    Update to a Linear layer's output: x @ A.T @ B.T, plus an optional
+    sparse (CSR) residual and bias delta. A LoRA adapter is the low-rank
+    part alone, with its scaling folded into B.
+    """
+
+    def __init__(self, a: torch.Tensor, b: torch.Tensor, sparse: Optional[torch.Tensor] = None,
+                 bias: Optional[torch.Tensor] = None):
+        self.a = a
+        self.b = b
+        self.sparse = sparse
+        self.bias = bias
+
+    @property
+    def parameters(self) -> int:
+        count = self.a.numel() + self.b.numel()
+        if self.sparse is not None:
+            count += self.sparse.values().numel()
+        if self.bias is not None:
+            count += self.bias.numel()
+        return count
+
+    def apply(self, x: torch.Tensor, output: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        if rows is not None:
+            x = x.index_select(0, rows)
+        update = (x @ self.a.t()) @ self.b.t()
+        if self.sparse is not None:
+            flat = x.reshape(-1, x.shape[-1])
+            update = update + (self.sparse @ flat.t()).t().reshape(update.shape)
+        if self.bias is not None:
+            update = update + self.bias
+        if rows is None:
+            output += update
+        else:
+            output.index_add_(0, rows, update)
+        return output
+
+
+class EmbeddingDelta:
+    """
+    Update to an embedding lookup: rows of A @ B plus a sparse (COO) residual
+    """
+
+    def __init__(self, a: torch.Tensor, b: torch.Tensor, sparse: Optional[torch.Tensor] = None):
+        self.a = a
+        self.b = b
+        self.sparse = sparse
+
+    @property
+    def parameters(self) -> int:
+        count = self.a.numel() + self.b.numel()
+        if self.sparse is not None:
+            count += self.sparse.values().numel()
+        return count
+
+    def apply(self, ids: torch.Tensor, output: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        if rows is not None:
+            ids = ids.index_select(0, rows)
+        update = self.a[ids] @ self.b
+        if self.sparse is not None:
+            flat = ids.reshape(-1)
+            update = update + self.sparse.index_select(0, flat).to_dense().reshape(update.shape)
+        if rows is None:
+            output += update
+        else:
+            output.index_add_(0, rows, update)
+        return output
+
+
+class LayerNormDelta:
+    """
+    A variant's own LayerNorm parameters (too small to be worth factorizing)
+    """
+
+    def __init__(self, weight: torch.Tensor, bias: torch.Tensor, eps: float):
+        self.weight = weight
+        self.bias = bias
+        self.eps = eps
+
+    @property
+    def parameters(self) -> int:
+        return self.weight.numel() + self.bias.numel()
+
+    def apply(self, x: torch.Tensor, output: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        if rows is None:
+            return F.layer_norm(x, self.weight.shape, self.weight, self.bias, self.eps)
+        normed = F.layer_norm(x.index_select(0, rows), self.weight.shape, self.weight, self.bias, self.eps)
+        return output.index_copy(0, rows, normed)
+
+
+def is_delta_variant(path: str) -> bool:
+    return os.path.exists(os.path.join(path, DELTA_CONFIG))
+
+
+def read_delta_config(path: str) -> Dict:
+    with open(os.path.join(path, DELTA_CONFIG)) as f:
+        return json.load(f)
+
+
+def _coo(indices: torch.Tensor, values: torch.Tensor, shape: Tuple[int, int]) -> torch.Tensor:
+    return torch.sparse_coo_tensor(indices.long(), values, shape).coalesce()
+
+
+def load_delta_variant(path: str, model) -> Dict[str, object]:
+    """
+    Module name -> delta for a variant written by compress_deltas.py,
+    on the device and dtype of `model` (the shared base)
+    """
+    from safetensors.torch import load_file
+
+    config = read_delta_config(path)
+    tensors = load_file(os.path.join(path, DELTA_WEIGHTS))
+    modules = dict(model.named_modules())
+    parameter = next(model.parameters())
+
+    def get(key: str) -> Optional[torch.Tensor]:
+        tensor = tensors.get(key)
+        return None if tensor is None else tensor.to(parameter.device)
+
+    def cast(tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        return None if tensor is None else tensor.to(parameter.dtype)
+
+    deltas = {}
+    for name, entry in config["modules"].items():
+        if name not in modules:
+            raise ValueError(f"Variant {path} has a delta for {name}, which the base model does not have")
+        kind = entry["kind"]
+        if kind == "layernorm":
+            deltas[name] = LayerNormDelta(cast(get(f"{name}.weight")), cast(get(f"{name}.bias")), entry["eps"])
+            continue
+
+        # delta = a @ b, a: (out, rank), b: (rank, in)
+        a, b = cast(get(f"{name}.a")), cast(get(f"{name}.b"))
+        sparse = None
+        if f"{name}.sparse_values" in tensors:
+            sparse = _coo(get(f"{name}.sparse_indices"), cast(get(f"{name}.sparse_values")), tuple(entry["shape"]))
+
+        if kind == "linear":
+            csr = sparse.to_sparse_csr() if sparse is not None else None
+            deltas[name] = LowRankDelta(b, a, csr, cast(get(f"{name}.bias")))
+        elif kind == "embedding":
+            deltas[name] = EmbeddingDelta(a, b, sparse)
+            # Output head tied to this embedding: logits change by h @ delta.T
+            tied = entry.get("tied")
+            if tied:
+                csr = sparse.to_sparse_csr() if sparse is not None else None
+                deltas[tied] = LowRankDelta(b, a, csr)
+        else:
+            raise ValueError(f"Unknown delta kind {kind} for {name}")
+    return deltas
@@ -0,0 +1,136 @@
+import asyncio
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import torch
+from starlette.concurrency import run_in_threadpool
+
+from metrics import metrics
+from model_loader import LoadedModel
+
+
+class ModelHandle:
+    """
+    The checkpoint currently serving one role (primary or small), swappable
+    without a restart.
+
+    Requests lease the current model for the duration of a generation. A
+    swap loads and warms the new checkpoint in the background, replaces
+    `current` under the lock (new leases get the new model), then waits for
+    leases on the old one to drain before dropping it. Both checkpoints are
+    resident while the swap is in progress.
+    """
+
+    def __init__(self, role: str, loaded: LoadedModel, version: Optional[str] = None):
+        self.role = role
+        self._lock = threading.Lock()
+        self.current = loaded
+        self.version = version or loaded.name
+        self.loaded_at = time.time()
+        # id(LoadedModel) -> in-flight generations on it
+        self._leases: Dict[int, int] = {}
+        self.swapping: Optional[Dict] = None
+        self.last_swap: Optional[Dict] = None
+
+    @property
+    def name(self) -> str:
+        return self.current.name
+
+    @contextmanager
+    def lease(self):
+        with self._lock:
+            loaded = self.current
+            self._leases[id(loaded)] = self._leases.get(id(loaded), 0) + 1
+        try:
+            yield loaded
+        finally:
+            with self._lock:
+                remaining = self._leases[id(loaded)] - 1
+                if remaining:
+                    self._leases[id(loaded)] = remaining
+                else:
+                    del self._leases[id(loaded)]
+
+    def in_flight(self, loaded: LoadedModel) -> int:
+        with self._lock:
+            return self._leases.get(id(loaded), 0)
+
+    def _stage(self, stage: str):
+        self.swapping["stage"] = stage
+        print(f"Hot-swap {self.role}: {stage} {self.swapping['to']}")
+
+    async def swap(self, load: Callable[[], LoadedModel], warmup: Callable[[LoadedModel], None],
+                   name: str, version: Optional[str], drain_timeout: float,
+                   release: Optional[Callable[[LoadedModel], None]] = None) -> Dict:
+        """
+        Load, warm up and swap in a new checkpoint; returns the swap report.
+        release(old) drops other references to the old model once it drained.
+        """
+        if self.swapping is not None:
+            raise RuntimeError(f"Swap to {self.swapping['to']} already in progress")
+
+        started = time.perf_counter()
+        self.swapping = {"to": name, "version": version or name, "stage": "loading", "started": time.time()}
+        report = {"role": self.role, "from": self.version, "to": version or name, "model": name}
+
+        try:
+            self._stage("loading")
+            new = await run_in_threadpool(load)
+            report["load_s"] = round(time.perf_counter() - started, 2)
+
+            self._stage("warming")
+            mark = time.perf_counter()
+            await run_in_threadpool(warmup, new)
+            report["warmup_s"] = round(time.perf_counter() - mark, 2)
+
+            with self._lock:
+                old, self.current = self.current, new
+                self.version = version or name
+                self.loaded_at = time.time()
+            report["swapped_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+            self._stage("draining")
+            mark = time.perf_counter()
+            while self.in_flight(old) and time.perf_counter() - mark < drain_timeout:
+                await asyncio.sleep(0.05)
+            report["drain_s"] = round(time.perf_counter() - mark, 2)
+            # Leases that outlived the timeout still hold their reference;
+            # the old model is freed when the last of them finishes
+            report["undrained"] = self.in_flight(old)
+
+            if release is not None:
+                release(old)
+            del old
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            report["total_s"] = round(time.perf_counter() - started, 2)
+            report["status"] = "swapped"
+            metrics.incr(f"hotswap.{self.role}")
+            metrics.observe(f"hotswap.{self.role}", time.perf_counter() - started)
+            print(f"Hot-swap {self.role}: now serving {self.version} ({report['total_s']}s)")
+        except Exception as e:
+            report["status"] = "failed"
+            report["error"] = str(e)
+            report["total_s"] = round(time.perf_counter() - started, 2)
+            metrics.incr(f"hotswap.{self.role}.failed")
+            print(f"Hot-swap {self.role} failed, still serving {self.version}: {e}")
+        finally:
+            self.swapping = None
+            self.last_swap = report
+
+        return report
+
+    def status(self) -> Dict:
+        return {
+            "model": self.name,
+            "version": self.version,
+            "loaded_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.loaded_at)),
+            "in_flight": self.in_flight(self.current),
+            "swapping": dict(self.swapping) if self.swapping else None,
+            "last_swap": self.last_swap,
+        }
@@ -0,0 +1,530 @@
+import asyncio
+import glob
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+from starlette.concurrency import run_in_threadpool
+
+from cancellation import CancellationToken, GenerationCancelled
+from metrics import metrics
+from model_loader import LoadedModel
+from paged_kv import local_layers
+
+# Legacy past_key_values: ((key, value), ...) per layer, [batch, heads, seq, dim]
+Past = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+# Shorter shared prefixes are not worth the lookup
+MIN_REUSE_TOKENS = 16
+# Background prefill jobs waiting for idle capacity; oldest dropped beyond
+MAX_PENDING = 256
+# Positions local attention layers keep beyond their window, so a request
+# whose tokens diverge a little before the end of a cached prefix still fits
+WINDOW_SLACK = 64
+
+
+def past_bytes(past: Past) -> int:
+    return sum(t.numel() * t.element_size() for layer in past for t in layer)
+
+
+def window_past(past: Past, model) -> Past:
+    """
+    Keep only the last window_size + WINDOW_SLACK positions of local
+    attention layers: no later query can attend to anything older
+    """
+    local = local_layers(model)
+    if not local:
+        return past
+    keep = model.config.window_size + WINDOW_SLACK
+    return tuple(
+        tuple(t[:, :, -keep:] for t in layer) if i in local else layer
+        for i, layer in enumerate(past)
+    )
+
+
+def expand_past(past: Past, length: int, common: int) -> Past:
+    """
+    The first `common` positions of a past covering `length` tokens whose
+    local layers may hold only their last positions; the missing front is
+    zeros, which local attention masks out
+    """
+    layers = []
+    for layer in past:
+        start = length - layer[0].shape[2]
+        if start == 0:
+            layers.append(tuple(t[:, :, :common] for t in layer))
+            continue
+        expanded = []
+        for t in layer:
+            full = t.new_zeros(t.shape[0], t.shape[1], common, t.shape[3])
+            full[:, :, start:] = t[:, :, :common - start]
+            expanded.append(full)
+        layers.append(tuple(expanded))
+    return tuple(layers)
+
+
+def legacy_past(past) -> Past:
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def quantize(tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    int8 values and a float16 scale per head and token (absmax over head_dim)
+    """
+    scale = tensor.abs().amax(dim=-1, keepdim=True).float() / 127
+    scale = scale.clamp(min=1e-8).half()
+    values = (tensor.float() / scale.float()).round().clamp(-127, 127).to(torch.int8)
+    return values, scale
+
+
+class QuantizedPast:
+    """
+    A past_key_values stored as per-head int8 with scales, about a quarter
+    of fp32 (half of fp16). Dequantized into the model's dtype when a
+    request reuses it.
+    """
+
+    def __init__(self, layers: List[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]], dtype: torch.dtype):
+        self.layers = layers
+        self.dtype = dtype
+
+    @classmethod
+    def from_past(cls, past: Past) -> "QuantizedPast":
+        return cls([tuple(quantize(t) for t in layer) for layer in past], past[0][0].dtype)
+
+    @property
+    def bytes(self) -> int:
+        return sum(t.numel() * t.element_size() for layer in self.layers for pair in layer for t in pair)
+
+    def dequantize(self) -> Past:
+        return tuple(
+            tuple((values.float() * scale.float()).to(self.dtype) for values, scale in layer)
+            for layer in self.layers
+        )
+
+
+class _Entry:
+    __slots__ = ("ids", "past", "model", "bytes", "start", "used", "restored")
+
+    def __init__(self, ids: List[int], past: Union[Past, QuantizedPast], loaded: LoadedModel):
+        self.ids = ids
+        self.past = past
+        self.model = weakref.ref(loaded)
+        self.bytes = past.bytes if isinstance(past, QuantizedPast) else past_bytes(past)
+        # First position every layer still holds (> 0 once local layers are windowed)
+        if isinstance(past, QuantizedPast):
+            stored = min(keys.shape[2] for (keys, _), _ in past.layers)
+        else:
+            stored = min(keys.shape[2] for keys, _ in past)
+        self.start = len(ids) - stored
+        self.used = time.time()
+        self.restored = False
+
+
+def _to_tensors(past: Union[Past, QuantizedPast]) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    tensors = {}
+    if isinstance(past, QuantizedPast):
+        for i, ((keys, key_scale), (values, value_scale)) in enumerate(past.layers):
+            tensors.update({f"{i}.k": keys, f"{i}.k_scale": key_scale, f"{i}.v": values, f"{i}.v_scale": value_scale})
+        metadata = {"quantized": "1", "dtype": str(past.dtype).split(".")[-1]}
+    else:
+        for i, (keys, values) in enumerate(past):
+            tensors.update({f"{i}.k": keys, f"{i}.v": values})
+        metadata = {"quantized": "0"}
+    return {name: t.contiguous() for name, t in tensors.items()}, metadata
+
+
+def _from_tensors(tensors: Dict[str, torch.Tensor], metadata: Dict[str, str]) -> Union[Past, QuantizedPast]:
+    layers = len(tensors) // (4 if metadata["quantized"] == "1" else 2)
+    if metadata["quantized"] != "1":
+        return tuple((tensors[f"{i}.k"], tensors[f"{i}.v"]) for i in range(layers))
+    return QuantizedPast([
+        ((tensors[f"{i}.k"], tensors[f"{i}.k_scale"]), (tensors[f"{i}.v"], tensors[f"{i}.v_scale"]))
+        for i in range(layers)
+    ], getattr(torch, metadata["dtype"]))
+
+
+class _Spilled:
+    __slots__ = ("path", "ids", "model", "device", "bytes")
+
+    def __init__(self, path: str, entry: _Entry, device: str):
+        self.path = path
+        self.ids = entry.ids
+        self.model = entry.model
+        self.device = device
+        self.bytes = entry.bytes
+
+
+class DiskTier:
+    """
+    Second cache tier for idle sessions: one safetensors file per session
+    under `directory`, read back memory-mapped. The index (token ids, model)
+    stays in memory, so files left by a previous process are deleted at
+    startup. Least recently spilled sessions are dropped past max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        for stale in glob.glob(os.path.join(directory, "*.safetensors")):
+            os.remove(stale)
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, _Spilled]" = OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, session: str) -> bool:
+        return session in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def write(self, session: str, entry: _Entry):
+        from safetensors.torch import save_file
+
+        if entry.bytes > self.max_bytes or entry.model() is None:
+            return
+        tensors, metadata = _to_tensors(entry.past)
+        device = str(next(iter(tensors.values())).device)
+        path = os.path.join(self.directory, hashlib.sha1(session.encode()).hexdigest() + ".safetensors")
+        save_file({name: t.cpu() for name, t in tensors.items()}, path, metadata=metadata)
+
+        dropped = []
+        with self._lock:
+            previous = self._index.pop(session, None)
+            if previous is not None:
+                self.bytes -= previous.bytes
+            self._index[session] = _Spilled(path, entry, device)
+            self.bytes += entry.bytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._index.popitem(last=False)
+                self.bytes -= evicted.bytes
+                dropped.append(evicted.path)
+        for old in dropped:
+            os.remove(old)
+            metrics.incr("kv_cache.disk_evictions")
+        metrics.incr("kv_cache.spilled")
+
+    def read(self, session: str) -> Optional[_Entry]:
+        """
+        Take a session's entry off disk (None if its model is gone)
+        """
+        from safetensors import safe_open
+
+        spilled = self.discard(session, remove=False)
+        if spilled is None:
+            return None
+        try:
+            loaded = spilled.model()
+            if loaded is None:
+                return None
+            with safe_open(spilled.path, framework="pt", device=spilled.device) as f:
+                past = _from_tensors({name: f.get_tensor(name) for name in f.keys()}, f.metadata())
+            return _Entry(spilled.ids, past, loaded)
+        finally:
+            os.remove(spilled.path)
+
+    def discard(self, session: str, remove: bool = True) -> Optional[_Spilled]:
+        with self._lock:
+            spilled = self._index.pop(session, None)
+            if spilled is not None:
+                self.bytes -= spilled.bytes
+        if spilled is not None and remove:
+            os.remove(spilled.path)
+        return spilled
+
+
+class PrefixCache:
+    """
+    Per-session KV cache of the prompt prefix the next turn will start with.
+
+    One entry per session, least recently used evicted past max_bytes. A
+    lookup reuses the longest common token prefix (at least
+    MIN_REUSE_TOKENS, always leaving one token to run) so the model only
+    prefills what is new. Cached tensors are never written to: generate
+    concatenates onto legacy tuples, creating new tensors. Local attention
+    layers keep only their window (window_past). With quantize,
+    entries are kept as int8 (see QuantizedPast and check_kv_quantization.py).
+    With a disk tier, entries evicted or idle past spill_idle's limit are
+    written to disk instead of dropped, and restore() brings one back.
+    """
+
+    def __init__(self, max_bytes: int, quantize: bool = False, disk: Optional[DiskTier] = None):
+        self.max_bytes = max_bytes
+        self.quantize = quantize
+        self.disk = disk
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find(self, session: str, loaded: LoadedModel, ids: List[int], limit: int) -> Optional[Tuple[_Entry, int]]:
+        """
+        The session's entry and how much of ids[:limit] it covers, read and
+        compared under the lock so a concurrent store or restore cannot swap
+        the entry in between
+        """
+        with self._lock:
+            entry = self._entries.get(session)
+            if entry is None or entry.model() is not loaded:
+                return None
+
+            limit = min(len(entry.ids), limit)
+            common = 0
+            while common < limit and entry.ids[common] == ids[common]:
+                common += 1
+            if common < MIN_REUSE_TOKENS:
+                return None
+            # Windowed local layers must still hold the window before position common
+            if entry.start and common < entry.start + loaded.model.config.window_size - 1:
+                metrics.incr("kv_cache.outside_window")
+                return None
+
+            entry.used = time.time()
+            self._entries.move_to_end(session)
+        return entry, common
+
+    def _reuse(self, entry: _Entry, common: int) -> Tuple[Past, int]:
+        past = entry.past.dequantize() if isinstance(entry.past, QuantizedPast) else entry.past
+        return expand_past(past, len(entry.ids), common), common
+
+    def match(self, session: str, loaded: LoadedModel, ids: List[int], limit: int) -> Optional[Tuple[Past, int]]:
+        """
+        (past, length) for the longest cached prefix of ids[:limit], or None
+        """
+        found = self._find(session, loaded, ids, limit)
+        return self._reuse(*found) if found is not None else None
+
+    def lookup(self, session: str, loaded: LoadedModel, ids: List[int]) -> Optional[Tuple[Past, int]]:
+        """
+        Cached prefix for a request, leaving at least its last token to run
+        """
+        metrics.incr("kv_cache.lookups")
+        found = self._find(session, loaded, ids, len(ids) - 1)
+        if found is None:
+            return None
+        entry, common = found
+        metrics.incr("kv_cache.hits")
+        metrics.incr("kv_cache.disk_hits" if entry.restored else "kv_cache.ram_hits")
+        metrics.incr("kv_cache.tokens_reused", common)
+        return self._reuse(entry, common)
+
+    def store(self, session: str, loaded: LoadedModel, ids: List[int], past: Past):
+        if self.disk is not None:
+            self.disk.discard(session)
+        past = window_past(past, loaded.model)
+        self._insert(session, _Entry(ids, QuantizedPast.from_past(past) if self.quantize else past, loaded))
+
+    def _insert(self, session: str, entry: _Entry):
+        if entry.bytes > self.max_bytes:
+            return
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(session, None)
+            if previous is not None:
+                self.bytes -= previous.bytes
+            self._entries[session] = entry
+            self.bytes += entry.bytes
+            while self.bytes > self.max_bytes:
+                evicted.append(self._entries.popitem(last=False))
+                self.bytes -= evicted[-1][1].bytes
+        for evicted_session, evicted_entry in evicted:
+            metrics.incr("kv_cache.evictions")
+            if self.disk is not None:
+                self.disk.write(evicted_session, evicted_entry)
+
+    def drop_model(self, loaded: LoadedModel) -> int:
+        """
+        Forget every in-memory entry built on loaded (after a hot swap);
+        spilled ones are skipped on read once the model is gone
+        """
+        with self._lock:
+            sessions = [session for session, entry in self._entries.items() if entry.model() is loaded]
+            for session in sessions:
+                self.bytes -= self._entries.pop(session).bytes
+        return len(sessions)
+
+    def spilled(self, session: str) -> bool:
+        return self.disk is not None and session in self.disk
+
+    def spill_idle(self, idle_after: float):
+        """
+        Move entries unused for idle_after seconds to the disk tier
+        """
+        cutoff = time.time() - idle_after
+        with self._lock:
+            idle = [(session, entry) for session, entry in self._entries.items() if entry.used < cutoff]
+            for session, entry in idle:
+                del self._entries[session]
+                self.bytes -= entry.bytes
+        for session, entry in idle:
+            self.disk.write(session, entry)
+
+    def restore(self, session: str) -> bool:
+        """
+        Bring a spilled session back into memory; called as soon as its next
+        request arrives so the read overlaps queueing
+        """
+        started = time.perf_counter()
+        try:
+            entry = self.disk.read(session)
+        except Exception as e:
+            print(f"KV cache restore failed for {session}: {e}")
+            metrics.incr("kv_cache.restore_errors")
+            return False
+        if entry is None:
+            return False
+        entry.restored = True
+        self._insert(session, entry)
+        metrics.observe("kv_cache.restore", time.perf_counter() - started)
+        metrics.incr("kv_cache.restored")
+        return True
+
+    def snapshot(self) -> Dict:
+        everything = metrics.snapshot()
+        snapshot = everything["counters"]
+        lookups = snapshot.get("kv_cache.lookups", 0)
+        entries = len(self._entries)
+        tiers = {"ram": {"entries": entries, "mb": round(self.bytes / (1024 * 1024), 1)}}
+        if self.disk is not None:
+            tiers["disk"] = {
+                "entries": len(self.disk),
+                "mb": round(self.disk.bytes / (1024 * 1024), 1),
+                "max_mb": round(self.disk.max_bytes / (1024 * 1024), 1),
+                "spilled": snapshot.get("kv_cache.spilled", 0),
+                "restored": snapshot.get("kv_cache.restored", 0),
+                "restore_ms": everything["latency_ms"].get("kv_cache.restore", {"count": 0}),
+            }
+        for tier in tiers:
+            hits = snapshot.get(f"kv_cache.{tier}_hits", 0)
+            tiers[tier]["hit_rate"] = round(hits / lookups, 3) if lookups else None
+        return {
+            "entries": entries,
+            "quantized": self.quantize,
+            "mb": round(self.bytes / (1024 * 1024), 1),
+            "mb_per_session": round(self.bytes / entries / (1024 * 1024), 2) if entries else None,
+            "max_mb": round(self.max_bytes / (1024 * 1024), 1),
+            "hit_rate": round(snapshot.get("kv_cache.hits", 0) / lookups, 3) if lookups else None,
+            "tokens_reused": snapshot.get("kv_cache.tokens_reused", 0),
+            "tiers": tiers,
+            "prefill": {
+                key.split(".")[-1]: value for key, value in snapshot.items() if key.startswith("prefill.")
+            },
+        }
+
+
+def prefill(loaded: LoadedModel, ids: List[int], past: Optional[Past], start: int,
+            cancellation: CancellationToken, chunk: int) -> Past:
+    """
+    Run ids[start:] through the model on top of past, `chunk` tokens per
+    forward pass, checking for cancellation between chunks
+    """
+    with torch.no_grad():
+        for offset in range(start, len(ids), chunk):
+            if cancellation.cancelled:
+                raise GenerationCancelled(cancellation.reason or "cancelled", offset - start)
+            piece = torch.tensor([ids[offset:offset + chunk]], device=loaded.device)
+            outputs = loaded.model(piece, past_key_values=past, use_cache=True)
+            past = legacy_past(outputs.past_key_values)
+    return past
+
+
+class BackgroundPrefill:
+    """
+    After a reply is sent, prefill the prefix the session's next turn will
+    start with (prompt + reply + "\\n<|user|>:\\n") during the user's think
+    time.
+
+    Jobs wait until the serving schedulers are idle, run one at a time in
+    chunks, and are cancelled at the next chunk as soon as real traffic is
+    admitted or queued. A newer job for the same session replaces a pending
+    one.
+    """
+
+    def __init__(self, cache: PrefixCache, idle: Callable[[], bool], max_tokens: int, chunk: int):
+        self.cache = cache
+        self.idle = idle
+        self.max_tokens = max_tokens
+        self.chunk = chunk
+        self._pending: "OrderedDict[str, Tuple[LoadedModel, str]]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def schedule(self, session: str, loaded: LoadedModel, prompt: str, reply: str):
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        self._pending.pop(session, None)
+        self._pending[session] = (loaded, prompt + reply + "\n<|user|>:\n")
+        metrics.incr("prefill.scheduled")
+        if len(self._pending) > MAX_PENDING:
+            self._pending.popitem(last=False)
+            metrics.incr("prefill.dropped")
+        self._wakeup.set()
+
+    def drop_model(self, loaded: LoadedModel):
+        """
+        Cancel pending jobs for loaded (after a hot swap)
+        """
+        for session in [session for session, (job, _) in self._pending.items() if job is loaded]:
+            del self._pending[session]
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not self.idle():
+                await asyncio.sleep(0.05)
+                continue
+            session, (loaded, text) = self._pending.popitem(last=False)
+            try:
+                await self._prefill(session, loaded, text)
+            except Exception as e:
+                print(f"Background prefill failed: {e}")
+                metrics.incr("prefill.errors")
+
+    async def _preempt_when_busy(self, token: CancellationToken):
+        while not token.cancelled:
+            if not self.idle():
+                token.cancel("preempted")
+                return
+            await asyncio.sleep(0.02)
+
+    def _prefill_session(self, session: str, loaded: LoadedModel, text: str, token: CancellationToken):
+        ids = loaded.tokenizer(text)["input_ids"]
+        if len(ids) > self.max_tokens:
+            metrics.incr("prefill.too_long")
+            return
+
+        # Continue from this session's previous prefill where it still matches
+        past, start = None, 0
+        reusable = self.cache.match(session, loaded, ids, len(ids))
+        if reusable is not None:
+            past, start = reusable
+
+        past = prefill(loaded, ids, past, start, token, self.chunk)
+        self.cache.store(session, loaded, ids, past)
+        metrics.incr("prefill.completed")
+        metrics.incr("prefill.tokens", len(ids) - start)
+
+    async def _prefill(self, session: str, loaded: LoadedModel, text: str):
+        token = CancellationToken()
+        watcher = asyncio.create_task(self._preempt_when_busy(token))
+        started = time.perf_counter()
+        try:
+            await run_in_threadpool(self._prefill_session, session, loaded, text, token)
+            metrics.observe("prefill.background", time.perf_counter() - started)
+        except GenerationCancelled:
+            metrics.incr("prefill.preempted")
+        finally:
+            token.cancel("done")
+            watcher.cancel()
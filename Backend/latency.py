@@ -0,0 +1,96 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+from transformers import StoppingCriteria
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the remaining budget cannot fit a useful reply
+    """
+
+
+class DecodeLatencyTracker:
+    """
+    Live estimates of prefill cost per prompt token and decode cost per
+    generated token (exponential moving averages)
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self.prefill_per_token: Optional[float] = None
+        self.decode_per_token: Optional[float] = None
+        self.samples = 0
+
+    def _update(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return (1 - self.alpha) * current + self.alpha * value
+
+    def record(self, prompt_tokens: int, step_times: List[float], started: float):
+        """
+        Update from one generation: step_times[0] is the end of prefill
+        (first token), later entries are single decode steps
+        """
+        if not step_times or prompt_tokens <= 0:
+            return
+
+        with self._lock:
+            self.samples += 1
+            # The first generation pays for lazy initialisation; don't learn from it
+            if self.samples == 1:
+                return
+
+            prefill = step_times[0] - started
+            self.prefill_per_token = self._update(self.prefill_per_token, prefill / prompt_tokens)
+
+            if len(step_times) > 1:
+                decode = (step_times[-1] - step_times[0]) / (len(step_times) - 1)
+                self.decode_per_token = self._update(self.decode_per_token, decode)
+
+    def affordable_tokens(self, prompt_tokens: int, budget: float) -> Optional[int]:
+        """
+        New tokens that fit in budget seconds, or None before any measurement
+        """
+        with self._lock:
+            if self.decode_per_token is None or self.prefill_per_token is None:
+                return None
+            remaining = budget - prompt_tokens * self.prefill_per_token
+            return max(0, int(remaining / self.decode_per_token))
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            return {
+                "prefill_ms_per_token": round(self.prefill_per_token * 1000, 3) if self.prefill_per_token else None,
+                "decode_ms_per_token": round(self.decode_per_token * 1000, 3) if self.decode_per_token else None,
+            }
+
+
+class StepTimer(StoppingCriteria):
+    """
+    Records the wall time of every decode step; never stops generation
+    """
+
+    def __init__(self):
+        self.step_times: List[float] = []
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        self.step_times.append(time.perf_counter())
+        return False
+
+
+class DeadlineCriteria(StoppingCriteria):
+    """
+    Hard stop in case the estimate was optimistic: keep what has been decoded
+    """
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.triggered = False
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        if time.perf_counter() >= self.deadline:
+            self.triggered = True
+        return self.triggered
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from starlette.concurrency import run_in_threadpool
+from transformers import StoppingCriteria
+
+from cancellation import CancellationGroup
+from delta import LowRankDelta, is_delta_variant, load_delta_variant, read_delta_config
+from model_loader import LoadedModel
+from stopping import StopMarkerCriteria
+
+PEFT_PREFIX = "base_model.model."
+
+
+def parse_adapters(spec: str) -> Dict[str, str]:
+    """
+    "name=path,name2=path2" -> {name: path}
+    """
+    adapters = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, path = entry.partition("=")
+        if not path:
+            raise ValueError(f"Adapter entry {entry!r} is not name=path")
+        adapters[name.strip()] = path.strip()
+    return adapters
+
+
+def read_adapter_config(path: str) -> Dict:
+    with open(os.path.join(path, "adapter_config.json")) as f:
+        return json.load(f)
+
+
+def adapter_base(path: str) -> str:
+    """
+    Base model an adapter (LoRA or delta-compressed variant) was made from
+    """
+    if is_delta_variant(path):
+        return read_delta_config(path)["base"]
+    return read_adapter_config(path)["base_model_name_or_path"]
+
+
+def _read_adapter_weights(path: str) -> Dict[str, torch.Tensor]:
+    safetensors_path = os.path.join(path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+        return load_file(safetensors_path)
+    return torch.load(os.path.join(path, "adapter_model.bin"), map_location="cpu")
+
+
+class Adapter:
+    """
+    A peft LoRA checkpoint or a delta-compressed fine-tune: one delta per
+    module of the base model it changes
+    """
+
+    def __init__(self, name: str, path: str, kind: str, deltas: Dict[str, Any]):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.deltas = deltas
+
+    @property
+    def parameters(self) -> int:
+        return sum(delta.parameters for delta in self.deltas.values())
+
+
+class MultiLoraModel:
+    """
+    One base model serving many LoRA adapters (and delta-compressed
+    fine-tunes, see compress_deltas.py) without merging them.
+
+    A forward hook on every targeted module adds each row's own update, for
+    LoRA x @ A.T @ B.T * scaling, so rows using different adapters (or none)
+    share one forward pass. Memory per adapter is just its deltas.
+    The row -> adapter assignment is thread-local, so generations on other
+    threads (adapter-free requests on the same model) are unaffected.
+    """
+
+    def __init__(self, base: LoadedModel):
+        self.base = base
+        self.adapters: Dict[str, Adapter] = {}
+        self._hooks = {}
+        self._local = threading.local()
+
+    @property
+    def name(self) -> str:
+        return self.base.name
+
+    def add_adapter(self, name: str, path: str) -> Adapter:
+        """
+        Load an adapter directory; called at startup, before serving
+        """
+        if is_delta_variant(path):
+            deltas = load_delta_variant(path, self.base.model)
+            kind = "delta"
+        else:
+            deltas = self._load_lora(name, path)
+            kind = "lora"
+
+        modules = dict(self.base.model.named_modules())
+        for module_name in deltas:
+            if module_name not in self._hooks:
+                self._hooks[module_name] = modules[module_name].register_forward_hook(self._hook(module_name))
+
+        adapter = Adapter(name, path, kind, deltas)
+        self.adapters[name] = adapter
+        print(f"Loaded {kind} adapter {name} ({len(deltas)} modules, {adapter.parameters:,} parameters)")
+        return adapter
+
+    def _load_lora(self, name: str, path: str) -> Dict[str, LowRankDelta]:
+        config = read_adapter_config(path)
+        if config.get("peft_type", "LORA") != "LORA":
+            raise ValueError(f"Adapter {name}: only LoRA adapters are supported")
+        if config.get("modules_to_save"):
+            raise ValueError(f"Adapter {name}: modules_to_save is not supported, merge it instead")
+
+        r = config["r"]
+        alpha = config.get("lora_alpha", r)
+        scaling = alpha / math.sqrt(r) if config.get("use_rslora") else alpha / r
+
+        modules = dict(self.base.model.named_modules())
+        parameter = next(self.base.model.parameters())
+        state = _read_adapter_weights(path)
+        deltas = {}
+        for key, tensor in state.items():
+            if ".lora_A." not in key:
+                continue
+            module_name = key.split(".lora_A.")[0]
+            if module_name.startswith(PEFT_PREFIX):
+                module_name = module_name[len(PEFT_PREFIX):]
+            if module_name not in modules:
+                raise ValueError(f"Adapter {name} targets {module_name}, which {self.name} does not have")
+            lora_b = state[key.replace(".lora_A.", ".lora_B.")] * scaling
+            deltas[module_name] = LowRankDelta(
+                tensor.to(parameter.device, parameter.dtype),
+                lora_b.to(parameter.device, parameter.dtype),
+            )
+        if not deltas:
+            raise ValueError(f"Adapter {name} at {path} has no LoRA weights")
+        return deltas
+
+    def _hook(self, module_name: str):
+        def hook(module, inputs, output):
+            groups = getattr(self._local, "groups", None)
+            if not groups:
+                return None
+            x = inputs[0]
+            batch = self._local.batch
+            # Broadcast inputs (position ids of shape (1, seq)) get a row each
+            if output.shape[0] == 1 < batch:
+                x = x.expand(batch, *x.shape[1:])
+                output = output.expand(batch, *output.shape[1:]).clone()
+            for adapter, rows in groups:
+                delta = adapter.deltas.get(module_name)
+                if delta is not None:
+                    output = delta.apply(x, output, rows)
+            return output
+        return hook
+
+    @contextmanager
+    def rows(self, adapter_names: Sequence[Optional[str]]):
+        """
+        Apply adapter_names[i] to batch row i (None = base model only)
+        """
+        groups = []
+        for name in dict.fromkeys(n for n in adapter_names if n is not None):
+            indices = [i for i, n in enumerate(adapter_names) if n == name]
+            rows = None if len(indices) == len(adapter_names) else torch.tensor(indices, device=self.base.device)
+            groups.append((self.adapters[name], rows))
+        self._local.groups = groups
+        self._local.batch = len(adapter_names)
+        try:
+            yield
+        finally:
+            self._local.groups = None
+
+    def snapshot(self) -> Dict:
+        return {
+            "base": self.name,
+            "base_parameters": self.base.parameters,
+            "adapters": {
+                name: {
+                    "path": adapter.path,
+                    "kind": adapter.kind,
+                    "modules": len(adapter.deltas),
+                    "parameters": adapter.parameters,
+                }
+                for name, adapter in self.adapters.items()
+            },
+        }
+
+
+class LoraRow:
+    """
+    One request in a mixed-adapter batch
+    """
+
+    def __init__(self, adapter: Optional[str], prompt: str, messages, max_tokens: int,
+                 temperature: float, cancellation: CancellationGroup,
+                 deadline: Optional[float], stats: dict):
+        self.adapter = adapter
+        self.prompt = prompt
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.cancellation = cancellation
+        self.deadline = deadline
+        self.stats = stats
+
+
+class BatchRowCriteria(StoppingCriteria):
+    """
+    Per-row stop conditions for a batched generate: a row is done at its own
+    max_tokens, stop marker, deadline or cancellation; the batch stops once
+    every row is done. (generate's own criteria stop the whole batch.)
+    """
+
+    def __init__(self, rows: List[LoraRow], token_texts: List[str], prompt_length: int,
+                 eos_token_id: Optional[int]):
+        self.rows = rows
+        self.prompt_length = prompt_length
+        self.eos_token_id = eos_token_id
+        self.markers = [StopMarkerCriteria(token_texts, prompt_length, row=i) for i in range(len(rows))]
+        self.done = [False] * len(rows)
+        self.deadline_hit = [False] * len(rows)
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        generated = input_ids.shape[-1] - self.prompt_length
+        now = None
+        for i, row in enumerate(self.rows):
+            if self.done[i]:
+                continue
+            if (generated >= row.max_tokens
+                    or row.cancellation.cancelled
+                    or input_ids[i, -1].item() == self.eos_token_id
+                    or self.markers[i](input_ids, scores)):
+                self.done[i] = True
+            elif row.deadline is not None:
+                now = now or time.perf_counter()
+                if now >= row.deadline:
+                    self.done[i] = self.deadline_hit[i] = True
+        return all(self.done)
+
+
+class AdapterBatcher:
+    """
+    Groups adapter requests that arrive within `window` seconds (up to
+    max_batch, same temperature) into one generate call. run_batch(rows)
+    runs in the threadpool and returns one result or exception per row.
+    """
+
+    def __init__(self, run_batch: Callable[[List[LoraRow]], List[Any]], window: float, max_batch: int):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[float, List[Tuple[LoraRow, asyncio.Future]]] = {}
+        self._timers: Dict[float, asyncio.TimerHandle] = {}
+
+    async def submit(self, row: LoraRow):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = round(row.temperature, 4)
+        batch = self._pending.setdefault(key, [])
+        batch.append((row, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: float):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[LoraRow, asyncio.Future]]):
+        try:
+            results = await run_in_threadpool(self.run_batch, [row for row, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,177 @@
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # Not Linux: fall back to the peak, the best we have
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """
+    High-water mark of the resident set size
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _mb(value: float) -> float:
+    return round(value / (1024 * 1024), 2)
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+
+class _StageStats:
+    __slots__ = ("count", "rss_delta_total", "rss_delta_max", "rss_after", "cuda_peak_max")
+
+    def __init__(self):
+        self.count = 0
+        self.rss_delta_total = 0
+        self.rss_delta_max = 0
+        self.rss_after = 0
+        self.cuda_peak_max = 0
+
+    def summary(self) -> Dict:
+        summary = {
+            "count": self.count,
+            "rss_delta_mb_mean": _mb(self.rss_delta_total / self.count) if self.count else 0.0,
+            "rss_delta_mb_max": _mb(self.rss_delta_max),
+            "rss_after_mb": _mb(self.rss_after),
+        }
+        if self.cuda_peak_max:
+            summary["cuda_peak_allocated_mb"] = _mb(self.cuda_peak_max)
+        return summary
+
+
+class MemoryTracker:
+    """
+    RSS (and CUDA peak allocation) around each pipeline stage, plus optional
+    tracemalloc snapshots diffed every N requests.
+
+    RSS is process-wide, so with concurrent requests a stage's delta also
+    includes whatever ran alongside it; the max and trend are what matter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, _StageStats] = defaultdict(_StageStats)
+        self.requests = 0
+        self.trace_every = 0
+        self.trace_top = 20
+        self._previous_snapshot = None
+        self.last_diff: Optional[Dict] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+        before = rss_bytes()
+
+        try:
+            yield
+        finally:
+            after = rss_bytes()
+            cuda_peak = torch.cuda.max_memory_allocated() if cuda else 0
+            delta = after - before
+            with self._lock:
+                stats = self.stages[name]
+                stats.count += 1
+                stats.rss_delta_total += delta
+                stats.rss_delta_max = max(stats.rss_delta_max, delta)
+                stats.rss_after = after
+                stats.cuda_peak_max = max(stats.cuda_peak_max, cuda_peak)
+
+    def start_tracing(self, every: int, top: int = 20):
+        """
+        Snapshot Python allocations every `every` requests (0 stops tracing)
+        """
+        with self._lock:
+            self.trace_every = every
+            self.trace_top = top
+            self._previous_snapshot = None
+            if every > 0:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(10)
+                self._previous_snapshot = _take_snapshot()
+            elif tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def request_done(self):
+        with self._lock:
+            self.requests += 1
+            if not self.trace_every or self.requests % self.trace_every:
+                return
+            previous = self._previous_snapshot
+
+        snapshot = _take_snapshot()
+        diff = self._diff(previous, snapshot) if previous is not None else []
+
+        with self._lock:
+            self._previous_snapshot = snapshot
+            self.last_diff = {
+                "at_request": self.requests,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "traced_mb": _mb(tracemalloc.get_traced_memory()[0]),
+                "top": diff,
+            }
+
+    def _diff(self, previous, snapshot) -> List[Dict]:
+        stats = snapshot.compare_to(previous, "lineno")[:self.trace_top]
+        return [
+            {
+                "location": str(stat.traceback[0]),
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "count_diff": stat.count_diff,
+                "size_kb": round(stat.size / 1024, 1),
+            }
+            for stat in stats
+        ]
+
+    def summary(self) -> Dict:
+        with self._lock:
+            stages = {name: stats.summary() for name, stats in self.stages.items()}
+        return {
+            "rss_mb": _mb(rss_bytes()),
+            "peak_rss_mb": _mb(peak_rss_bytes()),
+            "stages": stages,
+        }
+
+    def debug(self) -> Dict:
+        summary = self.summary()
+        with self._lock:
+            summary["tracemalloc"] = {
+                "every": self.trace_every,
+                "requests": self.requests,
+                "last_diff": self.last_diff,
+            }
+        return summary
@@ -0,0 +1,63 @@
+import threading
+from collections import defaultdict, deque
+from typing import Dict
+
+
+class Metrics:
+    """
+    In-process counters and latency windows, exposed by GET /metrics
+    """
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self.counters = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=self._window))
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def ratio(self, numerator: str, denominator: str) -> float:
+        with self._lock:
+            total = self.counters.get(denominator, 0)
+            return self.counters.get(numerator, 0) / total if total else 0.0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+            latencies = {name: list(values) for name, values in self.latencies.items()}
+
+        return {
+            "counters": counters,
+            "latency_ms": {name: summarize(values) for name, values in latencies.items()},
+        }
+
+
+def summarize(values) -> Dict[str, float]:
+    """
+    Count, mean and tail percentiles (ms) of a latency window
+    """
+    if not values:
+        return {"count": 0}
+
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+    }
+
+
+metrics = Metrics()
@@ -0,0 +1,73 @@
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from chat_template import ChatTemplate
+from latency import DecodeLatencyTracker
+from stopping import build_token_texts
+
+
+class LoadedModel:
+    """
+    A checkpoint ready to serve: tokenizer, model, per-token texts for stop
+    marker detection, /chat template fragments, its live latency estimates
+    and, when enabled, a static-cache decoder (static_decode.py)
+    """
+
+    def __init__(self, name: str, tokenizer, model, device: str):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.token_texts = build_token_texts(tokenizer)
+        self.chat = ChatTemplate(tokenizer)
+        self.latency = DecodeLatencyTracker()
+        self.static = None
+
+    @property
+    def parameters(self) -> int:
+        return sum(p.numel() for p in self.model.parameters())
+
+
+def load_model(name: str, device: str, trust_remote_code: bool = True) -> LoadedModel:
+    print(f"Loading model: {name}")
+    print(f"Device: {device}")
+
+    print("Step 1: Loading tokenizer...")
+
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(
+            name,
+            use_fast=False,
+            trust_remote_code=trust_remote_code
+        )
+        print("Loaded slow tokenizer successfully")
+    except Exception as e:
+        print(f"Slow tokenizer failed: {e}")
+        print("Trying fast tokenizer...")
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            name,
+            use_fast=True,
+            trust_remote_code=trust_remote_code
+        )
+        print("Loaded fast tokenizer successfully")
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+        print("Set pad_token = eos_token")
+
+    print("\nStep 2: Loading model...")
+    model = AutoModelForCausalLM.from_pretrained(
+        name,
+        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+        low_cpu_mem_usage=True,
+        trust_remote_code=trust_remote_code
+    )
+
+    model.to(device)
+    model.eval()
+
+    loaded = LoadedModel(name, tokenizer, model, device)
+    print("Model loaded successfully!")
+    print(f"Model parameters: {loaded.parameters:,}")
+    return loaded
@@ -0,0 +1,498 @@
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict, deque
+from typing import Callable, ContextManager, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import StoppingCriteria
+
+from metrics import metrics
+from sampling import Sampler
+
+
+MB = 1024 * 1024
+# Most of the paged budget the local-layer window pool may take
+LOCAL_SHARE = 0.5
+
+
+def prefix_digest(previous: bytes, tokens: Sequence[int]) -> bytes:
+    """
+    Index key of a full block, chained from the previous block's key. A
+    digest rather than hash(): a collision would reuse another prompt's KV
+    """
+    return hashlib.blake2b(previous + array("q", tokens).tobytes(), digest_size=16).digest()
+
+
+class KVCacheFull(RuntimeError):
+    pass
+
+
+def supports(model) -> bool:
+    return getattr(model.config, "model_type", None) == "gpt_neo"
+
+
+def local_layers(model) -> List[int]:
+    """
+    Indices of GPT-Neo's local (sliding window) attention layers
+    """
+    layers = getattr(model.config, "attention_layers", None) or []
+    return [i for i, kind in enumerate(layers) if kind == "local"]
+
+
+class BlockPool:
+    """
+    Key/value storage for `layers` layers, preallocated (max_bytes) and
+    carved into blocks of block_size token slots.
+
+    Blocks are reference counted so sequences with a common prefix share
+    them. A full block is indexed by a digest of its namespace (adapter) and
+    every token up to its end; when no sequence uses it any more it stays
+    cached (least recently released evicted first) until its slots are
+    needed, so the next batch with the same system prompt reuses it too.
+    """
+
+    def __init__(self, model, layers: int, max_bytes: int, block_size: int):
+        config = model.config
+        parameter = next(model.parameters())
+        self.block_size = block_size
+        self.layers = layers
+        self.heads = config.num_heads
+        self.head_dim = config.hidden_size // config.num_heads
+        self.block_bytes = 2 * self.layers * block_size * config.hidden_size * parameter.element_size()
+        self.num_blocks = max_bytes // self.block_bytes
+        if self.num_blocks < 1:
+            raise ValueError(f"{max_bytes} bytes is less than one KV block ({self.block_bytes} bytes)")
+
+        shape = (self.num_blocks * block_size, self.heads, self.head_dim)
+        self.keys = [torch.zeros(shape, dtype=parameter.dtype, device=parameter.device) for _ in range(self.layers)]
+        self.values = [torch.zeros(shape, dtype=parameter.dtype, device=parameter.device) for _ in range(self.layers)]
+
+        self._lock = threading.Lock()
+        self.refcount = [0] * self.num_blocks
+        self._free = deque(range(self.num_blocks))
+        self._cached: "OrderedDict[int, bytes]" = OrderedDict()  # unused indexed block -> prefix digest
+        self._index: Dict[bytes, int] = {}  # prefix digest -> block
+        self._hash: Dict[int, bytes] = {}  # indexed block -> prefix digest
+
+    def allocate(self) -> int:
+        with self._lock:
+            if self._free:
+                block = self._free.popleft()
+            elif self._cached:
+                block, prefix = self._cached.popitem(last=False)
+                del self._index[prefix]
+                del self._hash[block]
+                metrics.incr("paged_kv.evictions")
+            else:
+                raise KVCacheFull(f"All {self.num_blocks} KV blocks are in use")
+            self.refcount[block] = 1
+            return block
+
+    def lookup(self, prefix: bytes) -> Optional[int]:
+        """
+        Take a reference to the indexed block for prefix, if there is one
+        """
+        with self._lock:
+            block = self._index.get(prefix)
+            if block is not None:
+                if self.refcount[block] == 0:
+                    del self._cached[block]
+                self.refcount[block] += 1
+            return block
+
+    def publish(self, block: int, prefix: bytes):
+        with self._lock:
+            if prefix not in self._index and block not in self._hash:
+                self._index[prefix] = block
+                self._hash[block] = prefix
+
+    def release(self, block: int):
+        with self._lock:
+            self.refcount[block] -= 1
+            if self.refcount[block] == 0:
+                if block in self._hash:
+                    self._cached[block] = self._hash[block]
+                else:
+                    self._free.append(block)
+
+    def contains(self, prefix: bytes) -> bool:
+        with self._lock:
+            return prefix in self._index
+
+    def writable(self, block: int) -> bool:
+        """
+        Only a block nobody else references (and that is not indexed, so no
+        later sequence will) may be written in place
+        """
+        with self._lock:
+            return self.refcount[block] == 1 and block not in self._hash
+
+    def copy(self, block: int) -> int:
+        """
+        Copy-on-write: a private copy of block, dropping this reference to it
+        """
+        new = self.allocate()
+        source = slice(block * self.block_size, (block + 1) * self.block_size)
+        target = slice(new * self.block_size, (new + 1) * self.block_size)
+        for layer in range(self.layers):
+            self.keys[layer][target] = self.keys[layer][source]
+            self.values[layer][target] = self.values[layer][source]
+        self.release(block)
+        metrics.incr("paged_kv.copy_on_write")
+        return new
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            in_use = sum(1 for count in self.refcount if count)
+            shared = sum(1 for count in self.refcount if count > 1)
+            cached = len(self._cached)
+        return {
+            "blocks": self.num_blocks,
+            "block_size": self.block_size,
+            "mb": round(self.num_blocks * self.block_bytes / (1024 * 1024), 1),
+            "in_use": in_use,
+            "shared": shared,
+            "cached": cached,
+            "free": self.num_blocks - in_use - cached,
+        }
+
+
+class PagedSequence:
+    """
+    One sequence's block tables: token i's keys and values live in slot
+    i % block_size of block i // block_size. Global layers keep every block;
+    local layers keep only the blocks inside the attention window (a ring
+    of blocks: older ones go back to the local pool as the sequence grows).
+    """
+
+    def __init__(self, pool: BlockPool, local_pool: Optional[BlockPool], window: int, namespace: Optional[str]):
+        self.pool = pool
+        self.local_pool = local_pool
+        self.window = window
+        self.blocks: List[int] = []
+        self.local: Dict[int, int] = {}  # block index -> local pool block
+        self.tokens: List[int] = []
+        # Prefix digest of every full block, chained from the namespace
+        self._root = prefix_digest(repr(namespace).encode(), [])
+        self._hashes: List[bytes] = []
+
+    @property
+    def length(self) -> int:
+        return len(self.tokens)
+
+    def first_local(self, position: int) -> int:
+        """
+        First block a local layer query at position (or later) attends to
+        """
+        return max(0, position - self.window + 1) // self.pool.block_size
+
+    def reuse_prefix(self, ids: List[int]) -> int:
+        """
+        Share indexed blocks for the longest block-aligned prefix of ids (and,
+        for local layers, the blocks in the window at its end); returns how
+        many tokens are covered. The last token always runs (its logits are
+        needed), copying its block if that was shared.
+        """
+        size = self.pool.block_size
+        hashes = []
+        for start in range(0, len(ids) - size + 1, size):
+            hashes.append(prefix_digest(hashes[-1] if hashes else self._root, ids[start:start + size]))
+
+        count = 0
+        while count < len(hashes) and self.pool.contains(hashes[count]):
+            count += 1
+        while count and self.local_pool is not None:
+            missing = [j for j in range(self.first_local(min(count * size, len(ids) - 1)), count)
+                       if not self.local_pool.contains(hashes[j])]
+            if not missing:
+                break
+            count = missing[0]
+
+        for j in range(count):
+            block = self.pool.lookup(hashes[j])
+            if block is None:
+                count = j
+                break
+            self.blocks.append(block)
+        if self.local_pool is not None:
+            for j in range(self.first_local(min(count * size, len(ids) - 1)), count):
+                block = self.local_pool.lookup(hashes[j])
+                if block is None:
+                    self.free()
+                    return 0
+                self.local[j] = block
+
+        self._hashes = hashes[:count]
+        self.tokens = list(ids[:count * size])
+        if self.tokens and self.length == len(ids):
+            self.tokens.pop()
+            self._hashes.pop()
+        return self.length
+
+    def reserve(self, count: int) -> Tuple[List[int], List[int]]:
+        """
+        Global and local slots for the next count tokens, allocating (or
+        copying shared) blocks as needed and releasing local blocks no later
+        query can see; calling it again for the same tokens is a no-op
+        """
+        size = self.pool.block_size
+        slots, local_slots = [], []
+        for position in range(self.length, self.length + count):
+            index, offset = divmod(position, size)
+            if index == len(self.blocks):
+                self.blocks.append(self.pool.allocate())
+            elif not self.pool.writable(self.blocks[index]):
+                self.blocks[index] = self.pool.copy(self.blocks[index])
+            slots.append(self.blocks[index] * size + offset)
+
+            if self.local_pool is not None:
+                block = self.local.get(index)
+                if block is None:
+                    block = self.local_pool.allocate()
+                elif not self.local_pool.writable(block):
+                    block = self.local_pool.copy(block)
+                self.local[index] = block
+                local_slots.append(block * size + offset)
+
+        if self.local_pool is not None:
+            for index in [index for index in self.local if index < self.first_local(self.length)]:
+                self.local_pool.release(self.local.pop(index))
+        return slots, local_slots
+
+    def advance(self, ids: List[int]):
+        size = self.pool.block_size
+        for token in ids:
+            self.tokens.append(token)
+            if self.length % size == 0:
+                prefix = prefix_digest(self._hashes[-1] if self._hashes else self._root, self.tokens[-size:])
+                index = len(self._hashes)
+                self._hashes.append(prefix)
+                self.pool.publish(self.blocks[index], prefix)
+                if index in self.local:
+                    self.local_pool.publish(self.local[index], prefix)
+
+    def free(self):
+        for block in self.blocks:
+            self.pool.release(block)
+        for block in self.local.values():
+            self.local_pool.release(block)
+        self.blocks = []
+        self.local = {}
+        self.tokens = []
+        self._hashes = []
+
+
+class PagedGPTNeo:
+    """
+    GPT-Neo forward pass and sampling loop over block pools instead of
+    per-batch contiguous past_key_values.
+
+    Attention gathers each row's keys and values through its block table,
+    so rows of different lengths need no padding in the cache, finished
+    rows give their blocks back immediately and a shared prompt prefix is
+    stored once. Local layers have their own pool and only ever hold (and
+    attend over) the last window_size tokens, so long sequences take about
+    half the memory. The model's own submodules are called, so forward
+    hooks (LoRA and delta adapters) apply unchanged.
+    """
+
+    def __init__(self, model, max_bytes: int, block_size: int, max_sequences: int):
+        if not supports(model):
+            raise ValueError(f"Paged KV attention is implemented for GPT-Neo, not {model.config.model_type}")
+        config = model.config
+        self.model = model
+        self.transformer = model.transformer
+        self.window = config.window_size
+        local = local_layers(model)
+
+        # Per sequence, local layers hold the window plus one prefill chunk
+        # (prefill runs window tokens at a time); at most LOCAL_SHARE of the
+        # budget goes to them, which caps the sequences decoded at once
+        self.local_pool = None
+        self.max_sequences = max_sequences
+        local_bytes = 0
+        if local:
+            per_sequence = ((2 * self.window + 2 * block_size) * 2 * len(local) * config.hidden_size
+                            * next(model.parameters()).element_size())
+            self.max_sequences = min(max_sequences, int(max_bytes * LOCAL_SHARE) // per_sequence)
+            if self.max_sequences < 1:
+                raise ValueError(
+                    f"Paged KV budget of {max_bytes / MB:.0f} MB cannot hold one sequence's local attention "
+                    f"window ({per_sequence / MB:.1f} MB, at most {LOCAL_SHARE:.0%} of the budget); "
+                    f"raise FREUD_PAGED_KV_MB or set it to 0"
+                )
+            if self.max_sequences < max_sequences:
+                print(f"Paged KV: local windows for {self.max_sequences} of {max_sequences} sequences "
+                      f"fit in {LOCAL_SHARE:.0%} of {max_bytes / MB:.0f} MB")
+            local_bytes = self.max_sequences * per_sequence
+            self.local_pool = BlockPool(model, len(local), local_bytes, block_size)
+        self.pool = BlockPool(model, config.num_layers - len(local), max_bytes - local_bytes, block_size)
+
+        # Model layer -> (its pool, index in that pool)
+        self.layout = []
+        for layer in range(config.num_layers):
+            if layer in local:
+                self.layout.append((self.local_pool, local.index(layer)))
+            else:
+                self.layout.append((self.pool, layer - sum(1 for i in local if i < layer)))
+
+    def sequence(self, namespace: Optional[str]) -> PagedSequence:
+        return PagedSequence(self.pool, self.local_pool, self.window, namespace)
+
+    def snapshot(self) -> Dict:
+        snapshot = {"global": self.pool.snapshot()}
+        if self.local_pool is not None:
+            snapshot["local"] = self.local_pool.snapshot()
+            snapshot["window"] = self.window
+        return snapshot
+
+    def _key_slots(self, tables: List[List[int]], first: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        """
+        Pool slot of every key position per row, where tables[row][0] holds
+        block first[row]; positions outside the table map somewhere harmless
+        and must be masked
+        """
+        size = self.pool.block_size
+        columns = max(len(blocks) for blocks in tables)
+        table = torch.zeros((len(tables), columns), dtype=torch.long)
+        for row, blocks in enumerate(tables):
+            table[row, :len(blocks)] = torch.tensor(blocks)
+        clamped = positions.clamp(min=0)
+        column = (clamped // size - first[:, None]).clamp(0, columns - 1)
+        return torch.gather(table.to(positions.device), 1, column) * size + clamped % size
+
+    def forward(self, sequences: Sequence[PagedSequence], ids: Sequence[List[int]]) -> torch.Tensor:
+        """
+        Run ids[i] (the same count per row) on top of sequences[i]'s cache;
+        returns the logits after each row's last token
+        """
+        pool = self.pool
+        device = pool.keys[0].device
+        batch, count = len(ids), len(ids[0])
+
+        reserved = [sequence.reserve(count) for sequence in sequences]
+        starts = torch.tensor([sequence.length for sequence in sequences], device=device)
+        positions = starts[:, None] + torch.arange(count, device=device)
+        width = int(positions[:, -1].max()) + 1
+
+        # Global layers: every position so far
+        slots = {pool: torch.tensor([r[0] for r in reserved], device=device).reshape(-1)}
+        key_positions = torch.arange(width, device=device).expand(batch, width)
+        key_slots = {pool: self._key_slots([s.blocks for s in sequences], torch.zeros_like(starts), key_positions)}
+        masks = {pool: key_positions[:, None, :] <= positions[:, :, None]}
+
+        # Local layers: only the window before each row's first new token
+        if self.local_pool is not None:
+            local_positions = starts[:, None] - self.window + 1 \
+                + torch.arange(self.window + count - 1, device=device)
+            first = [s.first_local(s.length) for s in sequences]
+            last = [(s.length + count - 1) // pool.block_size for s in sequences]
+            tables = [[s.local[j] for j in range(a, b + 1)] for s, a, b in zip(sequences, first, last)]
+            slots[self.local_pool] = torch.tensor([r[1] for r in reserved], device=device).reshape(-1)
+            key_slots[self.local_pool] = self._key_slots(tables, torch.tensor(first, device=device), local_positions)
+            keys, queries = local_positions[:, None, :], positions[:, :, None]
+            masks[self.local_pool] = (keys >= 0) & (keys <= queries) & (keys > queries - self.window)
+
+        hidden = self.transformer.wte(torch.tensor(ids, device=device)) + self.transformer.wpe(positions)
+        hidden = self.transformer.drop(hidden)
+        for block, (layer_pool, index) in zip(self.transformer.h, self.layout):
+            attention = block.attn.attention
+            residual = hidden
+            hidden = block.ln_1(hidden)
+
+            query = attention.q_proj(hidden).view(batch, count, pool.heads, pool.head_dim).transpose(1, 2)
+            layer_pool.keys[index][slots[layer_pool]] = attention.k_proj(hidden).reshape(-1, pool.heads, pool.head_dim)
+            layer_pool.values[index][slots[layer_pool]] = attention.v_proj(hidden).reshape(-1, pool.heads, pool.head_dim)
+            key = layer_pool.keys[index][key_slots[layer_pool]].transpose(1, 2)
+            value = layer_pool.values[index][key_slots[layer_pool]].transpose(1, 2)
+
+            # Same as GPTNeoSelfAttention: fp32 scores, no 1/sqrt(d) scaling
+            weights = torch.matmul(query.float(), key.float().transpose(-1, -2))
+            weights = weights.masked_fill(~masks[layer_pool][:, None], torch.finfo(weights.dtype).min)
+            weights = weights.softmax(dim=-1).to(value.dtype)
+            output = torch.matmul(weights, value).transpose(1, 2).reshape(batch, count, -1)
+
+            hidden = residual + attention.out_proj(output)
+            hidden = hidden + block.mlp(block.ln_2(hidden))
+
+        hidden = self.transformer.ln_f(hidden[:, -1:])
+        logits = self.model.lm_head(hidden)[:, -1]
+        for sequence, row in zip(sequences, ids):
+            sequence.advance(row)
+        return logits
+
+    def generate(self, prompts: List[List[int]], namespaces: List[Optional[str]], max_new_tokens: int,
+                 temperature: float, pad_token_id: int, criteria, stopping: Sequence[StoppingCriteria],
+                 rows: Callable[[List[Optional[str]]], ContextManager]) -> List[Union[List[int], KVCacheFull]]:
+        """
+        Sample up to max_new_tokens per prompt. criteria is a BatchRowCriteria
+        (its per-row done flags drop rows from the batch); rows(namespaces)
+        applies the adapters for the rows of the next forward pass. Returns
+        each row's generated ids, or KVCacheFull if its prompt did not fit.
+        """
+        sequences = [self.sequence(namespace) for namespace in namespaces]
+        generated: List[Union[List[int], KVCacheFull]] = [[] for _ in prompts]
+        sampler = Sampler(temperature)
+        width = max(len(ids) for ids in prompts)
+        input_ids = torch.full((len(prompts), width), pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(prompts):
+            input_ids[i, width - len(ids):] = torch.tensor(ids)
+
+        try:
+            with torch.no_grad():
+                live, logits = [], []
+                for i, (sequence, ids) in enumerate(zip(sequences, prompts)):
+                    reused = sequence.reuse_prefix(ids)
+                    try:
+                        with rows([namespaces[i]]):
+                            for start in range(reused, len(ids), self.window):
+                                last = self.forward([sequence], [ids[start:start + self.window]])
+                        logits.append(last)
+                    except KVCacheFull as e:
+                        sequence.free()
+                        generated[i] = e
+                        criteria.done[i] = True
+                        metrics.incr("paged_kv.rejected")
+                        continue
+                    live.append(i)
+                    metrics.incr("paged_kv.prefix_tokens_reused", reused)
+                if not live:
+                    return generated
+                logits = torch.cat(logits)
+                device = logits.device
+
+                for _ in range(max_new_tokens):
+                    tokens = sampler.sample(input_ids[live].to(device), logits, live).tolist()
+                    column = torch.full((len(prompts), 1), pad_token_id, dtype=torch.long)
+                    for i, token in zip(live, tokens):
+                        column[i, 0] = token
+                        generated[i].append(token)
+                    input_ids = torch.cat([input_ids, column], dim=-1)
+
+                    criteria(input_ids, None)
+                    for criterion in stopping:
+                        criterion(input_ids, None)
+                    for i in live:
+                        if criteria.done[i]:
+                            sequences[i].free()
+                    live = [i for i in live if not criteria.done[i]]
+
+                    # A row the pool has no room for stops here, keeping its text
+                    for i in list(live):
+                        try:
+                            sequences[i].reserve(1)
+                        except KVCacheFull:
+                            sequences[i].free()
+                            criteria.done[i] = True
+                            live.remove(i)
+                            metrics.incr("paged_kv.truncated")
+                    if not live:
+                        break
+
+                    with rows([namespaces[i] for i in live]):
+                        logits = self.forward([sequences[i] for i in live], [[generated[i][-1]] for i in live])
+        finally:
+            for sequence in sequences:
+                sequence.free()
+        return generated
@@ -0,0 +1,202 @@
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional
+
+import torch
+
+_NULL = nullcontext()
+
+
+class StackSampler:
+    """
+    Minimal Python sampling profiler: snapshots every thread's stack at a
+    fixed interval and aggregates them as folded stacks (flamegraph.pl /
+    speedscope input)
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    def __init__(self, directory: str, requests: Optional[int], seconds: Optional[float]):
+        self.directory = directory
+        self.stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.remaining = requests
+        self.until = time.monotonic() + seconds if seconds else None
+        self.captured = 0
+        self.paths: List[str] = []
+        self.done = threading.Event()
+        self.sampler = StackSampler()
+        self.lock = threading.Lock()
+
+    def expired(self) -> bool:
+        if self.until is not None and time.monotonic() >= self.until:
+            return True
+        return self.remaining is not None and self.remaining <= 0
+
+    def status(self) -> Dict:
+        return {
+            "directory": self.directory,
+            "captured_requests": self.captured,
+            "remaining_requests": self.remaining,
+            "seconds_left": round(max(0.0, self.until - time.monotonic()), 1) if self.until else None,
+            "finished": self.done.is_set(),
+            "paths": list(self.paths),
+        }
+
+
+class Profiler:
+    """
+    On-demand profiling of the next N requests or T seconds.
+
+    Each captured request gets a torch.profiler chrome trace (one request at
+    a time: requests overlapping a capture are not captured); a stack
+    sampler runs for the whole session and writes one folded-stack file.
+    When no session is active, capture() and section() return a shared
+    no-op context.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.session: Optional[ProfileSession] = None
+        self.last: Optional[ProfileSession] = None
+        self._lock = threading.Lock()
+        self._tracing = threading.Lock()
+
+    def start(self, requests: Optional[int] = None, seconds: Optional[float] = None) -> ProfileSession:
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError("A profiling session is already running")
+            os.makedirs(self.directory, exist_ok=True)
+            session = ProfileSession(self.directory, requests, seconds)
+            session.sampler.start()
+            self.session = session
+            print(f"Profiling started: requests={requests} seconds={seconds}")
+
+        if seconds:
+            threading.Timer(seconds, self._expire, args=(session,)).start()
+        return session
+
+    def _expire(self, session: ProfileSession):
+        with self._lock:
+            if self.session is session and session.expired():
+                self._finish(session)
+
+    def _finish(self, session: ProfileSession):
+        # Caller holds self._lock
+        self.session = None
+        self.last = session
+        session.sampler.stop()
+        path = os.path.join(session.directory, f"{session.stamp}-samples.folded")
+        session.sampler.write(path)
+        session.paths.append(path)
+        session.done.set()
+        print(f"Profiling finished: {len(session.paths)} files in {session.directory}")
+
+    def _claim(self) -> Optional[ProfileSession]:
+        with self._lock:
+            session = self.session
+            if session is None:
+                return None
+            if session.expired():
+                self._finish(session)
+                return None
+            if session.remaining is not None:
+                session.remaining -= 1
+            session.captured += 1
+            return session
+
+    @contextmanager
+    def _capture(self, label: str):
+        # torch.profiler runs one session at a time: with several decode
+        # slots, a request that overlaps a capture runs unprofiled
+        if not self._tracing.acquire(blocking=False):
+            yield
+            return
+        try:
+            session = self._claim()
+            if session is None:
+                yield
+                return
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+            with session.lock:
+                index = session.captured
+            path = os.path.join(session.directory, f"{session.stamp}-{label}-{index}.trace.json")
+
+            # No with_stack: torch's Python tracer asserts on stop when another
+            # thread (the session's sampler) returns from frames entered before
+            # the capture; the folded stacks cover Python call paths instead
+            with torch.profiler.profile(activities=activities) as prof:
+                yield
+        finally:
+            self._tracing.release()
+        prof.export_chrome_trace(path)
+
+        with self._lock:
+            session.paths.append(path)
+            if self.session is session and session.expired():
+                self._finish(session)
+
+    def capture(self, label: str = "request"):
+        """
+        Profile one request if a session is active and no other request is
+        being captured
+        """
+        if self.session is None:
+            return _NULL
+        return self._capture(label)
+
+    def section(self, name: str):
+        """
+        Named range inside a captured request (tokenize, generate, ...)
+        """
+        if self.session is None:
+            return _NULL
+        return torch.profiler.record_function(name)
+
+    def status(self) -> Dict:
+        session = self.session or self.last
+        return {"active": self.session is not None, "session": session.status() if session else None}
@@ -0,0 +1,72 @@
+import re
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+# Prompt layout produced by the Flutter client (AIService._buildPrompt):
+#   <|system|>: ...
+#   <|user|>:
+#   [emotion: sad]
+#   message
+#   <|assistant|>:
+#   reply
+SYSTEM_PROMPT = (
+    "<|system|>: You are Freud, a calm, empathetic therapeutic AI assistant. "
+    "You respond thoughtfully, kindly, and supportively. "
+    "You ask gentle follow-up questions and never judge the user. "
+    "Respond in 1-3 sentences only. Do not continue the conversation or add user responses."
+)
+EMOTIONS = ("sad", "anxious", "stressed", "angry", "happy", "neutral")
+
+# (role, content, emotion) as sent to /chat
+ChatMessage = Tuple[str, str, Optional[str]]
+
+USER_TURN_PATTERN = re.compile(
+    r'<\|user\|>:[ \t]*\n(?:\[emotion:\s*\w+\][ \t]*\n)?(.*?)(?=\n?<\|(?:user|assistant|system)\|>:|\Z)',
+    re.DOTALL
+)
+
+
+def extract_user_messages(prompt: str) -> List[str]:
+    """
+    Return the free-text content of every user turn in a formatted prompt
+    """
+    return [m.strip() for m in USER_TURN_PATTERN.findall(prompt) if m.strip()]
+
+
+def extract_last_user_message(prompt: str) -> str:
+    """
+    Latest user turn, or the whole prompt if it is not in the chat format
+    """
+    messages = extract_user_messages(prompt)
+    if messages:
+        return messages[-1]
+    return prompt.strip()
+
+
+def user_header(emotion: Optional[str]) -> str:
+    return f"\n<|user|>:\n[emotion: {emotion or 'neutral'}]"
+
+
+ASSISTANT_HEADER = "\n<|assistant|>:"
+GENERATION_HEADER = "\n<|assistant|>:\n"
+
+
+def chat_segments(messages: Sequence[ChatMessage]) -> Iterator[Tuple[bool, str]]:
+    """
+    The _buildPrompt layout as (is_template, text) pieces.
+
+    Every piece after the first starts with the newline that precedes a
+    template marker or a message, so BPE pre-tokenization never merges
+    across a boundary and the pieces can be tokenized independently.
+    """
+    yield True, SYSTEM_PROMPT
+    for role, content, emotion in messages:
+        yield True, user_header(emotion) if role == "user" else ASSISTANT_HEADER
+        yield False, "\n" + content
+    yield True, GENERATION_HEADER
+
+
+def format_chat(messages: Sequence[ChatMessage]) -> str:
+    """
+    The prompt string the Flutter client would have built
+    """
+    return "".join(text for _, text in chat_segments(messages))
@@ -0,0 +1,145 @@
+"""
+Replay traffic captured with FREUD_CAPTURE_PATH against a running backend,
+keeping the original inter-arrival times.
+
+    python replay.py capture.jsonl --target http://localhost:7860 --output results.jsonl
+
+Entries captured in "hash" mode have no prompt text; they are replayed with
+a synthetic chat prompt of the same length so load and token counts match.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+import httpx
+
+from metrics import summarize
+
+SYNTHETIC_SYSTEM = "<|system|>: You are Freud, a calm, empathetic therapeutic AI assistant.\n"
+SYNTHETIC_FILLER = "I have been thinking about how things are going lately and what I could change. "
+
+
+def load_capture(path: str, limit: int = 0) -> List[Dict]:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries[:limit] if limit else entries
+
+
+def synthetic_prompt(chars: int) -> str:
+    """
+    Chat-formatted prompt of roughly `chars` characters
+    """
+    header = SYNTHETIC_SYSTEM + "<|user|>:\n[emotion: neutral]\n"
+    footer = "\n<|assistant|>:\n"
+    body_chars = max(1, chars - len(header) - len(footer))
+    body = (SYNTHETIC_FILLER * (body_chars // len(SYNTHETIC_FILLER) + 1))[:body_chars]
+    return header + body + footer
+
+
+def build_request(entry: Dict) -> Dict:
+    params = entry.get("params", {})
+    body = {
+        "prompt": entry.get("prompt") or synthetic_prompt(entry["prompt_chars"]),
+        "max_tokens": params.get("max_tokens", 150),
+        "temperature": params.get("temperature", 0.7),
+        "coalesce": params.get("coalesce", True),
+    }
+    if params.get("deadline_ms") is not None:
+        body["deadline_ms"] = params["deadline_ms"]
+    if params.get("adapter") is not None:
+        body["adapter"] = params["adapter"]
+    if entry.get("session"):
+        body["session_id"] = entry["session"]
+    return body
+
+
+async def send(client: httpx.AsyncClient, target: str, entry: Dict, offset: float) -> Dict:
+    started = time.perf_counter()
+    result = {"ts": entry["ts"], "prompt_hash": entry["prompt_hash"], "offset": round(offset, 4)}
+    try:
+        response = await client.post(f"{target}/generate", json=build_request(entry))
+        result["status"] = response.status_code
+        if response.status_code == 200:
+            result["route"] = response.json().get("route")
+    except httpx.HTTPError as e:
+        result["status"] = None
+        result["error"] = type(e).__name__
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    result["captured_latency_ms"] = entry.get("latency_ms")
+    result["captured_route"] = entry.get("route")
+    return result
+
+
+async def replay(entries: List[Dict], target: str, speed: float, timeout: float) -> List[Dict]:
+    if not entries:
+        return []
+
+    origin = entries[0]["ts"]
+    started = time.perf_counter()
+    tasks = []
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        for entry in entries:
+            offset = (entry["ts"] - origin) / speed
+            delay = offset - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, target, entry, offset)))
+        return await asyncio.gather(*tasks)
+
+
+def report(results: List[Dict]) -> Dict:
+    routes = Counter(result.get("route") or f"status_{result.get('status')}" for result in results)
+    latencies = defaultdict(list)
+    captured = defaultdict(list)
+    for result in results:
+        route = result.get("route") or "failed"
+        latencies[route].append(result["latency_ms"] / 1000)
+        if result.get("captured_latency_ms") is not None:
+            captured[result.get("captured_route") or "unknown"].append(result["captured_latency_ms"] / 1000)
+
+    valid = sum(1 for result in results if result.get("route") in ("model", "retrieval", "crisis"))
+    return {
+        "requests": len(results),
+        "routes": dict(routes),
+        "valid_rate": valid / len(results) if results else 0.0,
+        "latency_ms": {route: summarize(values) for route, values in latencies.items()},
+        "captured_latency_ms": {route: summarize(values) for route, values in captured.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured Freud traffic")
+    parser.add_argument("capture", help="JSON-lines file written by FREUD_CAPTURE_PATH")
+    parser.add_argument("--target", default="http://localhost:7860", help="Backend base URL")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression factor (2 = twice as fast)")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--output", help="Write per-request results as JSON lines")
+    args = parser.parse_args()
+
+    entries = load_capture(args.capture, args.limit)
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0
+    print(f"Replaying {len(entries)} requests over {span / args.speed:.1f}s against {args.target}")
+
+    results = asyncio.run(replay(entries, args.target.rstrip("/"), args.speed, args.timeout))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, separators=(",", ":")) + "\n")
+        print(f"Results written to {args.output}")
+
+    print(json.dumps(report(results), indent=2))
+
+
+if __name__ == "__main__":
+    main()
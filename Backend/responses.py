@@ -0,0 +1,133 @@
+import re
+
+
+def clean_response(text: str) -> str:
+    """
+    ULTRA-AGGRESSIVE cleaning to remove ALL tags and artifacts.
+    
+    text is the decoded reply only (generated ids, already cut at the first
+    stop marker), so no prompt matching is needed here.
+    """
+    
+    # Step 1: STOP at ANY indication of user tag (safety net for markers
+    # split in ways find_stop does not see)
+    stop_patterns = [
+        r'<\|user\|>',
+        r'<\^user\|>',
+        r'<user>',
+        r'<\/\|user\|>',
+        r'\n<\|',
+        r'<\|user',
+        r'\[emotion:',
+    ]
+    
+    for pattern in stop_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            text = re.split(pattern, text, maxsplit=1)[0].strip()
+            break
+    
+    # Step 2: Remove ALL special markers
+    text = re.sub(r'\[emotion:\s*\w+\]', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'<\|[^>]*\|>:?', '', text)
+    text = re.sub(r'<\^[^>]*\|>:?', '', text)
+    text = re.sub(r'<\/\|[^>]*\|>:?', '', text)
+    text = re.sub(r'\*\|[a-z0-9]+\|', '', text)
+    text = re.sub(r'</?[a-zA-Z][^>]*>', '', text)
+    text = re.sub(r'^(User:|Assistant:|Human:|AI:|System:|Freud:)\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'(User:|Assistant:|Human:|AI:|System:|Freud:)', '', text)
+    
+    # Step 3: Remove arrow annotations
+    text = re.sub(r'←[^.!?]*[.!?]', '', text)
+    text = re.sub(r'→[^.!?]*[.!?]', '', text)
+    text = re.sub(r'<-[^.!?]*[.!?]', '', text)
+    text = re.sub(r'->[^.!?]*[.!?]', '', text)
+    
+    # Step 4: Clean formatting artifacts
+    text = re.sub(r'[<>]{2,}', '', text)
+    text = re.sub(r'[#*]{3,}', '', text)
+    text = re.sub(r'!{4,}', '!', text)
+    text = re.sub(r'\*{2,}', '', text)
+    
+    # Step 5: Remove "Your Name:" artifacts
+    text = re.sub(r'Your Name:\s*\w*', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'Name:\s*\w*', '', text)
+    
+    # Step 6: Clean whitespace
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = re.sub(r'\n+', '\n', text).strip()
+    
+    # Step 7: Remove leading/trailing punctuation artifacts
+    text = re.sub(r'^[.,;:!?\s]+', '', text)
+    text = re.sub(r'[.,;:\s]+$', '', text)
+    
+    # Step 8: Limit to 2-3 sentences
+    sentences = re.split(r'[.!?]+\s+', text)
+    sentences = [s.strip() for s in sentences if s.strip() and len(s.strip()) > 3]
+    
+    if len(sentences) > 3:
+        text = '. '.join(sentences[:3])
+        if not text.endswith(('.', '!', '?')):
+            text += '.'
+    elif sentences:
+        text = '. '.join(sentences)
+        if not text.endswith(('.', '!', '?')):
+            text += '.'
+    
+    return text.strip()
+
+
+def is_valid_response(response: str) -> bool:
+    """
+    STRICT validation - reject anything suspicious
+    """
+    if not response or len(response.strip()) < 10:
+        print(f"Too short: {len(response)} chars")
+        return False
+    
+    tag_patterns = [
+        r'<\|.*?\|>',
+        r'<\^.*?\|>',
+        r'</?user>',
+        r'</?assistant>',
+        r'</?system>',
+        r'\[emotion:',
+        r'\*\|[a-z]+\d*\|',
+        r'←',
+        r'→',
+        r'Your Name:',
+    ]
+    
+    for pattern in tag_patterns:
+        if re.search(pattern, response, re.IGNORECASE):
+            print(f"Tag leakage: Found {pattern}")
+            return False
+    
+    if response.lower().startswith('error'):
+        print(f"Error message")
+        return False
+    
+    special_chars = len(re.findall(r'[^a-zA-Z0-9\s.,!?\'-]', response))
+    if special_chars > len(response) * 0.2:
+        print(f"Too many special characters: {special_chars}")
+        return False
+    
+    if response.count('!') > 5 or response.count('?') > 3:
+        print(f"Excessive punctuation")
+        return False
+    
+    words = response.split()
+    for i in range(len(words) - 3):
+        if len(words) > i+3 and words[i] == words[i+1] == words[i+2] == words[i+3]:
+            print(f"Repetition detected: {words[i]}")
+            return False
+    
+    word_count = len(words)
+    if word_count < 5:
+        print(f"Too few words: {word_count}")
+        return False
+    
+    if len(set(response.replace(' ', ''))) < 8:
+        print(f"Not enough unique characters")
+        return False
+    
+    return True
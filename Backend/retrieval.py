@@ -0,0 +1,186 @@
+import json
+import math
+import os
+import random
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Intents whose curated responses are good enough to send as-is
+DEFAULT_ANSWER_INTENTS = [
+    "greeting",
+    "morning",
+    "afternoon",
+    "evening",
+    "thanks",
+    "name",
+]
+
+# Sign-offs are never answered from the dataset, whatever
+# FREUD_RETRIEVAL_INTENTS says: farewell phrasing ("goodbye forever", "my
+# final goodbye") can be a crisis signal that detect_crisis misses, and a
+# canned "See you later." is the worst possible reply to it
+FAREWELL_INTENTS = {"goodbye", "night"}
+
+# The dataset was written for an earlier assistant persona; responses that
+# introduce it are never sent
+FOREIGN_PERSONA = re.compile(r"\bPandora\b", re.IGNORECASE)
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD_PATTERN.findall(text.lower())
+
+
+def normalize(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+class IntentIndex:
+    """
+    TF-IDF index over every pattern in Dataset.json.
+
+    All intents are indexed so that a message closer to e.g. "sad" than to
+    "greeting" is never answered from the greeting responses; only intents in
+    answer_intents are allowed to short-circuit generation. A pattern listed
+    under several intents ("good night" is both evening and night) is not an
+    exact match for any of them.
+    """
+
+    def __init__(self, intents: List[Dict], answer_intents: Optional[List[str]] = None,
+                 threshold: float = 0.7, margin: float = 0.1):
+        self.answer_intents = set(answer_intents or DEFAULT_ANSWER_INTENTS) - FAREWELL_INTENTS
+        self.threshold = threshold
+        self.margin = margin
+
+        self.responses = {}
+        self.exact = {}
+        ambiguous = set()
+        self.pattern_tags = []
+        documents = []
+
+        for intent in intents:
+            tag = intent.get("tag")
+            responses = [r for r in intent.get("responses", []) if not FOREIGN_PERSONA.search(r)]
+            if not tag:
+                continue
+            self.responses[tag] = responses
+
+            for pattern in intent.get("patterns", []):
+                terms = tokenize(pattern)
+                if not terms:
+                    continue
+                key = " ".join(terms)
+                if self.exact.setdefault(key, tag) != tag:
+                    ambiguous.add(key)
+                self.pattern_tags.append(tag)
+                documents.append(terms)
+
+        for key in ambiguous:
+            del self.exact[key]
+
+        document_frequency = defaultdict(int)
+        for terms in documents:
+            for term in set(terms):
+                document_frequency[term] += 1
+
+        total = len(documents)
+        self.idf = {term: math.log((1 + total) / (1 + df)) + 1 for term, df in document_frequency.items()}
+
+        # Inverted index: term -> [(pattern id, normalized weight)]
+        self.postings = defaultdict(list)
+        for pattern_id, terms in enumerate(documents):
+            vector = self._vectorize(terms)
+            for term, weight in vector.items():
+                self.postings[term].append((pattern_id, weight))
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "IntentIndex":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data.get("intents", []), **kwargs)
+
+    def _vectorize(self, terms: List[str]) -> Dict[str, float]:
+        counts = defaultdict(int)
+        for term in terms:
+            counts[term] += 1
+
+        vector = {term: count * self.idf.get(term, 0.0) for term, count in counts.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        if norm == 0:
+            return {}
+        return {term: w / norm for term, w in vector.items()}
+
+    def classify(self, text: str) -> Tuple[Optional[str], float, float]:
+        """
+        Return (intent, score, margin over the best other intent)
+        """
+        terms = tokenize(text)
+        if not terms:
+            return None, 0.0, 0.0
+
+        exact_tag = self.exact.get(" ".join(terms))
+        if exact_tag:
+            return exact_tag, 1.0, 1.0
+
+        scores = defaultdict(float)
+        for term, weight in self._vectorize(terms).items():
+            for pattern_id, pattern_weight in self.postings.get(term, ()):
+                scores[pattern_id] += weight * pattern_weight
+
+        best_by_intent = {}
+        for pattern_id, score in scores.items():
+            tag = self.pattern_tags[pattern_id]
+            if score > best_by_intent.get(tag, 0.0):
+                best_by_intent[tag] = score
+
+        if not best_by_intent:
+            return None, 0.0, 0.0
+
+        ranked = sorted(best_by_intent.items(), key=lambda item: item[1], reverse=True)
+        top_tag, top_score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return top_tag, top_score, top_score - runner_up
+
+    def answer(self, text: str) -> Optional[Tuple[str, str]]:
+        """
+        Curated (intent, response) when the match is confident, else None
+        """
+        tag, score, margin = self.classify(text)
+
+        if tag not in self.answer_intents or not self.responses.get(tag):
+            return None
+        if score < self.threshold or margin < self.margin:
+            return None
+
+        return tag, random.choice(self.responses[tag])
+
+
+def load_intent_index() -> Optional[IntentIndex]:
+    """
+    Build the index at startup; retrieval is disabled if no dataset is found.
+    The Docker image copies tokenizer/Dataset.json to the same relative path.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidates = [
+        os.environ.get("FREUD_DATASET_PATH"),
+        os.path.join(here, "Dataset.json"),
+        os.path.join(here, "..", "tokenizer", "Dataset.json"),
+    ]
+
+    answer_intents = os.environ.get("FREUD_RETRIEVAL_INTENTS")
+    kwargs = {
+        "answer_intents": answer_intents.split(",") if answer_intents else None,
+        "threshold": float(os.environ.get("FREUD_RETRIEVAL_THRESHOLD", 0.7)),
+        "margin": float(os.environ.get("FREUD_RETRIEVAL_MARGIN", 0.1)),
+    }
+
+    for path in candidates:
+        if path and os.path.exists(path):
+            index = IntentIndex.from_file(path, **kwargs)
+            print(f"Retrieval index built from {path}: {len(index.pattern_tags)} patterns, {len(index.responses)} intents")
+            return index
+
+    print("Dataset.json not found, retrieval answers disabled")
+    return None
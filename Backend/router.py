@@ -0,0 +1,323 @@
+"""
+Session-affinity router for several app.py replicas.
+
+Consecutive turns of a conversation (by session id, else client address)
+are consistent-hashed onto the same replica so its prompt/KV caches stay
+warm; /generate and /chat are proxied. Dead replicas are skipped on the
+ring (their sessions move to the next replica), and when a replica returns
+only its own sessions move back. POST/DELETE /replicas change the set at
+runtime and need FREUD_ADMIN_TOKEN (X-Admin-Token).
+
+    FREUD_REPLICAS=http://10.0.0.1:7860,http://10.0.0.2:7860 python router.py
+"""
+import asyncio
+import bisect
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+
+REPLICAS = [r.strip().rstrip("/") for r in os.environ.get("FREUD_REPLICAS", "").split(",") if r.strip()]
+VIRTUAL_NODES = int(os.environ.get("FREUD_ROUTER_VNODES", 128))
+HEALTH_INTERVAL = float(os.environ.get("FREUD_ROUTER_HEALTH_S", 5))
+REQUEST_TIMEOUT = float(os.environ.get("FREUD_ROUTER_TIMEOUT_S", 120))
+# Affinity keys remembered to measure how often a session stays put
+AFFINITY_MEMORY = int(os.environ.get("FREUD_ROUTER_AFFINITY_KEYS", 50000))
+FORWARDED_HEADERS = ("content-type", "x-deadline-ms")
+# Shared secret for adding and removing replicas (X-Admin-Token); unset =
+# the replica set is fixed to FREUD_REPLICAS
+ADMIN_TOKEN = os.environ.get("FREUD_ADMIN_TOKEN")
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes
+    """
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = 128):
+        self.virtual_nodes = virtual_nodes
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        for i in range(self.virtual_nodes):
+            point = _hash(f"{node}#{i}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node: str):
+        for i in range(self.virtual_nodes):
+            point = _hash(f"{node}#{i}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def candidates(self, key: str) -> List[str]:
+        """
+        Distinct nodes in ring order starting at the key's position
+        """
+        if not self._points:
+            return []
+
+        start = bisect.bisect(self._points, _hash(key))
+        seen = []
+        for i in range(len(self._points)):
+            node = self._owners[self._points[(start + i) % len(self._points)]]
+            if node not in seen:
+                seen.append(node)
+        return seen
+
+
+class ReplicaState:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+        self.affinity_hits = 0
+        self.errors = 0
+        self.last_check: Optional[float] = None
+        # Cache section of the replica's own /metrics, if it reports one
+        self.cache: Optional[Dict] = None
+
+    def snapshot(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "errors": self.errors,
+            "affinity_hit_rate": self.affinity_hits / self.requests if self.requests else 0.0,
+            "cache": self.cache,
+        }
+
+
+app = FastAPI()
+ring = HashRing(REPLICAS, VIRTUAL_NODES)
+replicas: Dict[str, ReplicaState] = {url: ReplicaState(url) for url in REPLICAS}
+last_replica: "OrderedDict[str, str]" = OrderedDict()
+counters = defaultdict(int)
+client: Optional[httpx.AsyncClient] = None
+
+
+def client_address(http_request: Request) -> str:
+    """The original client: first X-Forwarded-For hop if a proxy set one, else the peer"""
+    forwarded = http_request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return http_request.client.host if http_request.client else "anonymous"
+
+
+def affinity_key(body: Dict, http_request: Request) -> str:
+    """
+    The session id if the client sends one, else the client address. Nothing
+    in the prompt is stable: clients send a sliding window of recent turns
+    """
+    session = body.get("session_id") or http_request.headers.get("x-session-id")
+    if session:
+        return f"session:{session}"
+    return f"client:{client_address(http_request)}"
+
+
+def upstream_headers(http_request: Request, key: str) -> Dict[str, str]:
+    """
+    Replicas only see the router's address, so the affinity key goes along
+    as their session (KV cache) and the client address, appended to
+    X-Forwarded-For, keys their quotas and fair queueing (the replicas list
+    the router in FREUD_TRUSTED_PROXIES)
+    """
+    headers = {k: v for k, v in http_request.headers.items() if k.lower() in FORWARDED_HEADERS}
+    headers["x-session-id"] = key
+    hops = [http_request.headers.get("x-forwarded-for"), http_request.client.host if http_request.client else None]
+    headers["x-forwarded-for"] = ", ".join(hop for hop in hops if hop)
+    return headers
+
+
+def remember(key: str, url: str) -> bool:
+    """
+    Record where key went; True if it went to the same replica as last time
+    """
+    previous = last_replica.pop(key, None)
+    last_replica[key] = url
+    if len(last_replica) > AFFINITY_MEMORY:
+        last_replica.popitem(last=False)
+    return previous == url
+
+
+async def check_replica(state: ReplicaState):
+    try:
+        response = await client.get(f"{state.url}/metrics", timeout=5)
+        response.raise_for_status()
+        state.cache = response.json().get("cache")
+        if not state.healthy:
+            print(f"Replica back: {state.url}")
+        state.healthy = True
+        state.failures = 0
+    except Exception as e:
+        state.failures += 1
+        if state.healthy:
+            print(f"Replica down: {state.url} ({e})")
+        state.healthy = False
+    state.last_check = time.time()
+
+
+async def health_loop():
+    while True:
+        await asyncio.gather(*(check_replica(state) for state in replicas.values()))
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+@app.on_event("startup")
+async def startup():
+    global client
+    client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+    asyncio.create_task(health_loop())
+    print(f"Router started with {len(replicas)} replicas")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await client.aclose()
+
+
+@app.get("/health")
+def health_check():
+    healthy = [url for url, state in replicas.items() if state.healthy]
+    return {
+        "status": "healthy" if healthy else "degraded",
+        "healthy_replicas": len(healthy),
+        "replicas": len(replicas),
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Routing counters and per-replica affinity / cache hit rates"""
+    return {
+        "counters": dict(counters),
+        "replicas": {url: state.snapshot() for url, state in replicas.items()},
+    }
+
+
+def require_admin(http_request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(http_request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.post("/replicas")
+def add_replica(url: str, http_request: Request):
+    """Add a replica; only the sessions it now owns on the ring move"""
+    require_admin(http_request)
+    url = url.rstrip("/")
+    if url not in replicas:
+        replicas[url] = ReplicaState(url)
+        ring.add(url)
+    return {"replicas": list(replicas)}
+
+
+@app.delete("/replicas")
+def remove_replica(url: str, http_request: Request):
+    """Remove a replica; its sessions move to their next ring neighbour"""
+    require_admin(http_request)
+    url = url.rstrip("/")
+    if url in replicas:
+        ring.remove(url)
+        del replicas[url]
+    return {"replicas": list(replicas)}
+
+
+async def forward(url: str, path: str, body: Dict, headers: Dict, http_request: Request) -> Optional[httpx.Response]:
+    """
+    Proxy to one replica; returns None if our client hung up, after closing
+    the upstream connection so the replica cancels the generation
+    """
+    upstream = asyncio.create_task(client.post(f"{url}{path}", json=body, headers=headers))
+
+    while not upstream.done():
+        if await http_request.is_disconnected():
+            upstream.cancel()
+            counters["client_disconnects"] += 1
+            return None
+        await asyncio.wait({upstream}, timeout=0.25)
+
+    return upstream.result()
+
+
+@app.post("/generate")
+async def generate(http_request: Request):
+    return await proxy("/generate", http_request)
+
+
+@app.post("/chat")
+async def chat(http_request: Request):
+    return await proxy("/chat", http_request)
+
+
+async def proxy(path: str, http_request: Request):
+    body = await http_request.json()
+    key = affinity_key(body, http_request)
+    headers = upstream_headers(http_request, key)
+
+    candidates = [url for url in ring.candidates(key) if replicas[url].healthy]
+    if not candidates:
+        counters["no_replica"] += 1
+        raise HTTPException(status_code=503, detail="No healthy replicas")
+
+    for attempt, url in enumerate(candidates):
+        state = replicas[url]
+        try:
+            response = await forward(url, path, body, headers, http_request)
+        except httpx.TransportError as e:
+            # Replica died or hung (connect/read errors and timeouts): take
+            # it out of rotation and fail over to the next one on the ring
+            print(f"Replica {url} failed ({e}), failing over")
+            state.healthy = False
+            state.errors += 1
+            counters["failovers"] += 1
+            continue
+
+        if response is None:
+            return Response(status_code=499)
+
+        state.requests += 1
+        if remember(key, url):
+            state.affinity_hits += 1
+        counters["routed"] += 1
+        if attempt:
+            counters["routed_after_failover"] += 1
+
+        headers = {k: v for k, v in response.headers.items() if k.lower() == "retry-after"}
+        try:
+            content = response.json()
+        except ValueError:
+            # Not from app.py (e.g. a proxy's error page): pass it through as is
+            return Response(status_code=response.status_code, content=response.content, headers=headers,
+                            media_type=response.headers.get("content-type"))
+        return JSONResponse(status_code=response.status_code, content=content, headers=headers)
+
+    counters["no_replica"] += 1
+    raise HTTPException(status_code=503, detail="All replicas failed")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("ROUTER_PORT", 7870))
+
+    print(f"Starting Freud router on port {port}")
+    print(f"Replicas: {REPLICAS}")
+
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
@@ -0,0 +1,122 @@
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+# The backend's sampling settings
+REPETITION_PENALTY = 1.2
+NO_REPEAT_NGRAM_SIZE = 3
+TOP_K = 50
+TOP_P = 0.9
+
+
+class NGramIndex:
+    """
+    Tokens seen after each (n-1)-gram of one row's ids, extended with the
+    tokens added since the last step instead of rebuilt from the whole row
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        self.ids: List[int] = []
+        self.following: Dict[Tuple[int, ...], Set[int]] = {}
+
+    def extend(self, ids: List[int]):
+        start = len(self.ids)
+        self.ids.extend(ids)
+        for end in range(max(start, self.n - 1), len(self.ids)):
+            self.following.setdefault(tuple(self.ids[end - self.n + 1:end]), set()).add(self.ids[end])
+
+    def banned(self) -> Set[int]:
+        """Next tokens that would repeat an n-gram of the row"""
+        if len(self.ids) < self.n - 1:
+            return set()
+        return self.following.get(tuple(self.ids[len(self.ids) - self.n + 1:]), set())
+
+
+class Sampler(LogitsProcessor):
+    """
+    Repetition penalty, no-repeat n-gram ban, temperature, top-k and top-p
+    in one pass, equivalent to generate()'s processors for the same
+    settings.
+
+    The penalty is one gather/scatter over the row's ids, banned tokens come
+    from a per-row NGramIndex updated with each new token, and top-p runs on
+    the top_k survivors instead of sorting the whole vocabulary. One Sampler
+    per generation: it keeps state per row, so a row's ids may only grow.
+    Pass `rows` when rows leave the batch, to keep each row's index.
+    """
+
+    def __init__(self, temperature: float, repetition_penalty: float = REPETITION_PENALTY,
+                 no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE, top_k: int = TOP_K, top_p: float = TOP_P):
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.top_k = top_k
+        self.top_p = top_p
+        self._indexes: Dict[int, NGramIndex] = {}
+
+    def _banned(self, input_ids: torch.Tensor, rows: Sequence[int]) -> Tuple[List[int], List[int]]:
+        """(batch positions, token ids) to ban"""
+        positions, tokens = [], []
+        for position, (row, ids) in enumerate(zip(rows, input_ids)):
+            index = self._indexes.get(row)
+            if index is None:
+                index = self._indexes[row] = NGramIndex(self.no_repeat_ngram_size)
+            index.extend(ids[len(index.ids):].tolist())
+            banned = index.banned()
+            positions.extend([position] * len(banned))
+            tokens.extend(banned)
+        return positions, tokens
+
+    def filter(self, input_ids: torch.Tensor, logits: torch.Tensor,
+               rows: Optional[Sequence[int]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        (scores, token ids), both (batch, top_k), highest first; scores
+        outside top-p are -inf
+        """
+        scores = logits.float()
+        if self.repetition_penalty != 1.0:
+            seen = scores.gather(1, input_ids)
+            seen = torch.where(seen < 0, seen * self.repetition_penalty, seen / self.repetition_penalty)
+            scores = scores.scatter(1, input_ids, seen)
+        if self.no_repeat_ngram_size > 0:
+            positions, tokens = self._banned(input_ids, range(len(input_ids)) if rows is None else rows)
+            if tokens:
+                scores = scores.index_put((torch.tensor(positions, device=scores.device),
+                                           torch.tensor(tokens, device=scores.device)),
+                                          torch.tensor(float("-inf"), device=scores.device))
+
+        values, indices = (scores / self.temperature).topk(min(self.top_k, scores.shape[-1]), dim=-1)
+        if self.top_p < 1.0:
+            # Drop tokens once the higher-ranked ones already hold top_p of
+            # the mass; the first one always stays
+            probs = values.softmax(dim=-1)
+            remove = probs.cumsum(dim=-1) - probs >= self.top_p
+            values = values.masked_fill(remove, float("-inf"))
+        return values, indices
+
+    def sample(self, input_ids: torch.Tensor, logits: torch.Tensor,
+               rows: Optional[Sequence[int]] = None) -> torch.Tensor:
+        """Next token per row, (batch,)"""
+        values, indices = self.filter(input_ids, logits, rows)
+        choice = torch.multinomial(values.softmax(dim=-1), num_samples=1)
+        return indices.gather(1, choice).squeeze(1)
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+        """As a generate() logits processor: full-vocabulary scores, -inf where filtered"""
+        values, indices = self.filter(input_ids, scores)
+        return torch.full_like(scores, float("-inf"), dtype=values.dtype).scatter(1, indices, values)
+
+
+def generate_kwargs(temperature: float) -> Dict:
+    """generate() arguments that sample through a Sampler instead of its own processors"""
+    return {
+        "do_sample": True,
+        "logits_processor": LogitsProcessorList([Sampler(temperature)]),
+        "temperature": 1.0,
+        "top_k": 0,
+        "top_p": 1.0,
+        "repetition_penalty": 1.0,
+        "no_repeat_ngram_size": 0,
+    }
@@ -0,0 +1,267 @@
+import asyncio
+import itertools
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+from cancellation import CancellationGroup, GenerationCancelled
+from metrics import metrics
+
+# Lower value is served first
+PRIORITY_CLASSES = {
+    "crisis": 0,
+    "normal": 1,
+}
+
+
+class QuotaExceeded(Exception):
+    """
+    Session has used up its token bucket; retry_after is in seconds
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"quota exceeded, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("priority_class", "priority", "session", "cost", "enqueued", "seq", "future", "cancellation")
+
+    def __init__(self, priority_class: str, session: str, cost: int, seq: int,
+                 future: asyncio.Future, cancellation: Optional[CancellationGroup]):
+        self.priority_class = priority_class
+        self.priority = PRIORITY_CLASSES[priority_class]
+        self.session = session
+        self.cost = cost
+        self.enqueued = time.perf_counter()
+        self.seq = seq
+        self.future = future
+        self.cancellation = cancellation
+
+
+class _FairQueue:
+    """
+    Deficit round robin across sessions, charged in tokens: each visit tops a
+    session up by `quantum` tokens, and a waiter is served once its session's
+    deficit covers the waiter's cost.
+    """
+
+    def __init__(self, quantum: int):
+        self.quantum = quantum
+        self.sessions: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self.deficit: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.sessions.values())
+
+    def oldest(self) -> _Waiter:
+        return min((queue[0] for queue in self.sessions.values()), key=lambda w: w.seq)
+
+    def push(self, waiter: _Waiter):
+        if waiter.session not in self.sessions:
+            self.sessions[waiter.session] = deque()
+            self.deficit[waiter.session] = 0.0
+        self.sessions[waiter.session].append(waiter)
+
+    def remove(self, waiter: _Waiter) -> bool:
+        queue = self.sessions.get(waiter.session)
+        if queue is None or waiter not in queue:
+            return False
+        queue.remove(waiter)
+        if not queue:
+            self._drop(waiter.session)
+        return True
+
+    def _drop(self, session: str):
+        # Idle sessions do not bank credit (standard DRR)
+        del self.sessions[session]
+        del self.deficit[session]
+
+    def pop(self) -> _Waiter:
+        # Jump straight to the visit where a head's cost is covered rather
+        # than topping up one quantum per visit: costs are client-controlled
+        sessions = list(self.sessions)
+        rounds = [max(0, math.ceil((self.sessions[session][0].cost - self.deficit[session]) / self.quantum))
+                  for session in sessions]
+        winner = min(range(len(sessions)), key=lambda i: rounds[i] * len(sessions) + i)
+
+        # Every session before the winner in this round is visited once more
+        # than the full rounds, and moves behind it
+        for i, session in enumerate(sessions):
+            self.deficit[session] += (rounds[winner] + (i < winner)) * self.quantum
+            if i < winner:
+                self.sessions.move_to_end(session)
+
+        session = sessions[winner]
+        queue = self.sessions[session]
+        head = queue.popleft()
+        self.deficit[session] -= head.cost
+        if not queue:
+            self._drop(session)
+        return head
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount: float) -> float:
+        """
+        Take amount tokens; returns 0 on success, else seconds until it fits
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # A single request larger than the bucket is charged the full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class SessionQuotas:
+    """
+    Optional per-session token buckets (tokens per minute, with burst)
+    """
+
+    def __init__(self, tokens_per_minute: float, burst: Optional[float] = None, max_sessions: int = 10000):
+        self.rate = tokens_per_minute / 60
+        self.capacity = burst or tokens_per_minute
+        self.max_sessions = max_sessions
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def charge(self, session: str, tokens: int):
+        if not self.enabled:
+            return
+
+        bucket = self._buckets.get(session)
+        if bucket is None:
+            bucket = self._buckets[session] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session)
+
+        retry_after = bucket.consume(tokens)
+        if retry_after:
+            raise QuotaExceeded(retry_after)
+
+
+class InferenceScheduler:
+    """
+    Admission control for the model: at most `slots` generations run at once,
+    waiters are served by priority class, and within a class fairly across
+    sessions (deficit round robin weighted by tokens).
+
+    Starvation protection: a class's effective priority improves by one class
+    for every `aging` seconds its oldest waiter has been queued, so normal
+    traffic still drains under a steady stream of crisis requests.
+    """
+
+    def __init__(self, slots: int = 1, aging: float = 10.0, quantum: int = 256):
+        self.slots = slots
+        self.aging = aging
+        self.active = 0
+        self.active_by_class = defaultdict(int)
+        self._queues = {name: _FairQueue(quantum) for name in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+
+    def has_capacity(self) -> bool:
+        """
+        A request arriving now would start immediately
+        """
+        return self.active < self.slots and not self._has_waiters()
+
+    def idle(self) -> bool:
+        """
+        Nothing running or queued
+        """
+        return self.active == 0 and not self._has_waiters()
+
+    def _has_waiters(self) -> bool:
+        return any(self._queues[name].sessions for name in self._queues)
+
+    def _effective_priority(self, waiter: _Waiter, now: float) -> float:
+        return waiter.priority - (now - waiter.enqueued) / self.aging
+
+    def _next_waiter(self) -> _Waiter:
+        now = time.perf_counter()
+        candidates = [queue.oldest() for queue in self._queues.values() if queue.sessions]
+        oldest = min(candidates, key=lambda w: (self._effective_priority(w, now), w.seq))
+        return self._queues[oldest.priority_class].pop()
+
+    def _dispatch(self):
+        while self.active < self.slots and self._has_waiters():
+            waiter = self._next_waiter()
+
+            if waiter.future.done():
+                continue
+
+            # Client already gone: drop it instead of handing it a slot
+            if waiter.cancellation is not None and waiter.cancellation.cancelled:
+                waiter.future.set_exception(GenerationCancelled(waiter.cancellation.reason or "cancelled"))
+                continue
+
+            self.active += 1
+            self.active_by_class[waiter.priority_class] += 1
+            waiter.future.set_result(None)
+
+    async def acquire(self, priority_class: str = "normal", session: str = "",
+                      cost: int = 1, cancellation: Optional[CancellationGroup] = None):
+        if self.has_capacity():
+            self.active += 1
+            self.active_by_class[priority_class] += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(priority_class, session, cost, next(self._seq), future, cancellation)
+        self._queues[priority_class].push(waiter)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            removed = self._queues[priority_class].remove(waiter)
+            if not removed and future.done() and not future.cancelled() and future.exception() is None:
+                # Granted just before the cancellation landed: give it back
+                self.release(priority_class)
+            raise
+
+    def release(self, priority_class: str = "normal"):
+        self.active -= 1
+        self.active_by_class[priority_class] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str = "normal", session: str = "", cost: int = 1,
+                   cancellation: Optional[CancellationGroup] = None):
+        queued = time.perf_counter()
+        await self.acquire(priority_class, session, cost, cancellation)
+        metrics.observe(f"queue_wait.{priority_class}", time.perf_counter() - queued)
+        metrics.incr(f"scheduler.admitted.{priority_class}")
+
+        try:
+            yield
+        finally:
+            self.release(priority_class)
+
+    def snapshot(self) -> Dict:
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "active_by_class": dict(self.active_by_class),
+            "queued": {name: len(queue) for name, queue in self._queues.items()},
+            "queued_sessions": {name: len(queue.sessions) for name, queue in self._queues.items()},
+        }
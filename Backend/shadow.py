@@ -0,0 +1,128 @@
+import asyncio
+import random
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from cancellation import CancellationGroup, CancellationToken, GenerationCancelled
+from hotswap import ModelHandle
+from metrics import metrics, summarize
+from scheduler import InferenceScheduler
+
+
+class _ModelSamples:
+    """
+    Generation time, throughput and validity of one model on mirrored prompts
+    """
+
+    def __init__(self, window: int):
+        self.generate_s = deque(maxlen=window)
+        self.tokens_per_s = deque(maxlen=window)
+        self.valid = deque(maxlen=window)
+
+    def add(self, stats: dict, route: str):
+        seconds = stats.get("generate_s") or 0.0
+        self.generate_s.append(seconds)
+        if seconds > 0:
+            self.tokens_per_s.append(stats.get("generated_tokens", 0) / seconds)
+        self.valid.append(route == "model")
+
+    def summary(self) -> Dict:
+        rates = sorted(self.tokens_per_s)
+        return {
+            "generate_latency": summarize(list(self.generate_s)),
+            "tokens_per_s_mean": round(sum(rates) / len(rates), 1) if rates else None,
+            "tokens_per_s_p50": round(rates[len(rates) // 2], 1) if rates else None,
+            "valid_rate": round(sum(self.valid) / len(self.valid), 3) if self.valid else None,
+        }
+
+
+class ShadowEvaluator:
+    """
+    Mirrors a fraction of answered /generate requests to a candidate model.
+
+    A shadow generation only starts once the serving schedulers are idle,
+    runs one at a time, and is cancelled at the next decode step as soon as
+    real traffic is admitted or queued, so it never holds up a response.
+    Both sides are recorded only for prompts the candidate finished.
+    """
+
+    def __init__(self, candidate: ModelHandle, run: Callable, schedulers: List[InferenceScheduler],
+                 fraction: float, window: int = 1000):
+        self.candidate = candidate
+        # run(loaded, prompt, max_tokens, temperature, cancellation, deadline, stats) -> (text, route)
+        self.run = run
+        self.schedulers = schedulers
+        self.fraction = fraction
+        self.window = window
+        self.samples: Dict[str, _ModelSamples] = {}
+        self.active: Optional[asyncio.Task] = None
+
+    def idle(self) -> bool:
+        return all(scheduler.idle() for scheduler in self.schedulers)
+
+    def mirror(self, prompt: str, max_tokens: int, temperature: float,
+               model_used: str, route: str, stats: dict):
+        """
+        Called after a response was generated; maybe starts its shadow
+        """
+        if self.fraction <= 0 or random.random() >= self.fraction:
+            return
+        metrics.incr("shadow.sampled")
+        if self.active is not None or not self.idle():
+            metrics.incr("shadow.skipped_busy")
+            return
+
+        primary = {"generate_s": stats.get("generate_s"), "generated_tokens": stats.get("generated_tokens", 0)}
+        self.active = asyncio.create_task(
+            self._shadow(prompt, max_tokens, temperature, model_used, route, primary)
+        )
+
+    async def _preempt_when_busy(self, token: CancellationToken):
+        while not token.cancelled:
+            if not self.idle():
+                token.cancel("preempted")
+                return
+            await asyncio.sleep(0.02)
+
+    async def _shadow(self, prompt: str, max_tokens: int, temperature: float,
+                      model_used: str, route: str, primary: dict):
+        token = CancellationToken()
+        watcher = asyncio.create_task(self._preempt_when_busy(token))
+        stats = {}
+        try:
+            with self.candidate.lease() as loaded:
+                _, shadow_route = await run_in_threadpool(
+                    self.run, loaded, prompt, max_tokens, temperature,
+                    CancellationGroup(token), None, stats
+                )
+                candidate_name = loaded.name
+        except GenerationCancelled:
+            metrics.incr("shadow.preempted")
+            return
+        except Exception as e:
+            print(f"Shadow generation failed: {e}")
+            metrics.incr("shadow.errors")
+            return
+        finally:
+            token.cancel("done")
+            watcher.cancel()
+            self.active = None
+
+        metrics.incr("shadow.completed")
+        self._samples(model_used).add(primary, route)
+        self._samples(candidate_name).add(stats, shadow_route)
+
+    def _samples(self, name: str) -> _ModelSamples:
+        if name not in self.samples:
+            self.samples[name] = _ModelSamples(self.window)
+        return self.samples[name]
+
+    def snapshot(self) -> Dict:
+        return {
+            "candidate": self.candidate.name,
+            "fraction": self.fraction,
+            "running": self.active is not None,
+            "models": {name: samples.summary() for name, samples in self.samples.items()},
+        }
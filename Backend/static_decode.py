@@ -0,0 +1,165 @@
+import queue
+import time
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteriaList
+
+from kv_cache import Past
+from metrics import metrics
+from paged_kv import local_layers, supports
+from sampling import Sampler
+
+
+class StaticCache:
+    """
+    Preallocated key/value buffers for one sequence of up to max_length tokens
+    """
+
+    def __init__(self, model, max_length: int):
+        config = model.config
+        parameter = next(model.parameters())
+        shape = (1, config.num_heads, max_length, config.hidden_size // config.num_heads)
+        self.keys = [torch.zeros(shape, dtype=parameter.dtype, device=parameter.device)
+                     for _ in range(config.num_layers)]
+        self.values = [torch.zeros(shape, dtype=parameter.dtype, device=parameter.device)
+                       for _ in range(config.num_layers)]
+
+
+class StaticDecoder:
+    """
+    GPT-Neo generation from static KV buffers with torch.compile'd steps.
+
+    Every tensor shape is fixed: the cache is max_length long (attention
+    masks out positions not written yet), prompts are right-padded to one
+    of a few bucket lengths, and each decode step is one token. So the
+    compiled prefill (one graph per bucket) and decode step graphs are built
+    once, at startup by warm_up(), and reused for every request instead of
+    eager PyTorch re-dispatching each op and growing the cache by
+    concatenation. One StaticCache per concurrent generation; a request
+    that does not fit (no free cache, too long) returns None so the caller
+    falls back to generate().
+    """
+
+    def __init__(self, model, buckets: List[int], max_length: int, caches: int, compile: bool = True):
+        if not supports(model):
+            raise ValueError(f"Static decoding is implemented for GPT-Neo, not {model.config.model_type}")
+        self.model = model
+        self.transformer = model.transformer
+        self.buckets = sorted(buckets)
+        self.max_length = max_length
+        self.window = model.config.window_size
+        self.local = set(local_layers(model))
+        self.device = next(model.parameters()).device
+        self.key_positions = torch.arange(max_length, device=self.device)
+
+        self._caches: "queue.Queue[StaticCache]" = queue.Queue()
+        for _ in range(caches):
+            self._caches.put(StaticCache(model, max_length))
+
+        if compile:
+            mode = "reduce-overhead" if self.device.type == "cuda" else None
+            self._forward = torch.compile(self._forward, mode=mode, dynamic=False)
+
+    def _forward(self, keys: List[torch.Tensor], values: List[torch.Tensor], ids: torch.Tensor,
+                 start: torch.Tensor, last: torch.Tensor) -> torch.Tensor:
+        """
+        Run ids (1, count) at positions start.. writing their keys and values
+        into the cache; returns the logits after ids[:, last]
+        """
+        count = ids.shape[1]
+        positions = start + torch.arange(count, device=ids.device)
+        causal = self.key_positions[None, :] <= positions[:, None]
+        local = causal & (self.key_positions[None, :] > positions[:, None] - self.window)
+
+        hidden = self.transformer.wte(ids) + self.transformer.wpe(positions[None])
+        hidden = self.transformer.drop(hidden)
+        for layer, block in enumerate(self.transformer.h):
+            attention = block.attn.attention
+            heads, head_dim = attention.num_heads, attention.head_dim
+            residual = hidden
+            hidden = block.ln_1(hidden)
+
+            query = attention.q_proj(hidden).view(1, count, heads, head_dim).transpose(1, 2)
+            keys[layer].index_copy_(2, positions, attention.k_proj(hidden).view(1, count, heads, head_dim).transpose(1, 2))
+            values[layer].index_copy_(2, positions, attention.v_proj(hidden).view(1, count, heads, head_dim).transpose(1, 2))
+
+            # Same as GPTNeoSelfAttention: fp32 scores, no 1/sqrt(d) scaling
+            weights = torch.matmul(query.float(), keys[layer].float().transpose(-1, -2))
+            mask = local if layer in self.local else causal
+            weights = weights.masked_fill(~mask, torch.finfo(weights.dtype).min)
+            weights = weights.softmax(dim=-1).to(values[layer].dtype)
+            output = torch.matmul(weights, values[layer]).transpose(1, 2).reshape(1, count, -1)
+
+            hidden = residual + attention.out_proj(output)
+            hidden = hidden + block.mlp(block.ln_2(hidden))
+
+        hidden = self.transformer.ln_f(hidden.index_select(1, last))
+        return self.model.lm_head(hidden)[:, -1]
+
+    def bucket(self, length: int) -> Optional[int]:
+        return next((bucket for bucket in self.buckets if bucket >= length), None)
+
+    def warm_up(self):
+        """
+        Compile the prefill graph for every bucket and the decode step graph
+        """
+        cache = self._caches.get()
+        try:
+            with torch.no_grad():
+                for length in self.buckets + [1]:
+                    started = time.perf_counter()
+                    ids = torch.zeros((1, length), dtype=torch.long, device=self.device)
+                    for _ in range(2):
+                        self._forward(cache.keys, cache.values, ids, torch.zeros(1, dtype=torch.long, device=self.device),
+                                      torch.tensor([length - 1], device=self.device))
+                    print(f"Static decode: {'step' if length == 1 else f'prefill {length}'} ready "
+                          f"in {time.perf_counter() - started:.1f}s")
+        finally:
+            self._caches.put(cache)
+
+    def generate(self, input_ids: torch.Tensor, past: Optional[Past], cached: int, max_new_tokens: int,
+                 temperature: float, pad_token_id: int, eos_token_id: Optional[int],
+                 stopping_criteria: StoppingCriteriaList) -> Optional[torch.Tensor]:
+        """
+        Same sampling and stopping as the backend's generate() call (past
+        covering the first `cached` prompt tokens); None if the request
+        does not fit a bucket, the cache length or a free cache
+        """
+        prompt_tokens = input_ids.shape[-1]
+        bucket = self.bucket(prompt_tokens - cached)
+        if bucket is None or cached + bucket > self.max_length or prompt_tokens + max_new_tokens > self.max_length:
+            metrics.incr("static_decode.too_long")
+            return None
+        try:
+            cache = self._caches.get_nowait()
+        except queue.Empty:
+            metrics.incr("static_decode.busy")
+            return None
+
+        try:
+            if past is not None:
+                for layer, (keys, values) in enumerate(past):
+                    cache.keys[layer][:, :, :cached] = keys
+                    cache.values[layer][:, :, :cached] = values
+
+            rest = input_ids[:, cached:]
+            padded = torch.full((1, bucket), pad_token_id, dtype=torch.long, device=self.device)
+            padded[:, :rest.shape[1]] = rest
+            logits = self._forward(cache.keys, cache.values, padded, torch.tensor([cached], device=self.device),
+                                   torch.tensor([rest.shape[1] - 1], device=self.device))
+
+            sampler = Sampler(temperature)
+            ids = input_ids
+            for step in range(max_new_tokens):
+                token = sampler.sample(ids, logits)[:, None]
+                ids = torch.cat([ids, token], dim=-1)
+                if token.item() == eos_token_id or stopping_criteria(ids, None) or step == max_new_tokens - 1:
+                    break
+                logits = self._forward(cache.keys, cache.values, token,
+                                       torch.tensor([ids.shape[-1] - 1], device=self.device),
+                                       torch.zeros(1, dtype=torch.long, device=self.device))
+            metrics.incr("static_decode.generations")
+            return ids
+        finally:
+            self._caches.put(cache)
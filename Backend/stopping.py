@@ -0,0 +1,63 @@
+import re
+from bisect import bisect_right
+from typing import List
+
+from transformers import StoppingCriteria
+
+# Start of anything that is not part of the reply: a role tag (<|user|>,
+# <^user|>, </|user|>, <user>) or an emotion annotation
+STOP_MARKER_PATTERN = re.compile(r'<\||<\^|</\||</?user>|\[emotion:', re.IGNORECASE)
+
+# Longest marker is "[emotion:"; the tokens it spans are well within this
+TAIL_TOKENS = 8
+
+
+def build_token_texts(tokenizer) -> List[str]:
+    """
+    Decoded text of every token id, computed once per tokenizer so stop
+    markers can be found without decoding whole sequences
+    """
+    return [tokenizer.decode([i]) for i in range(len(tokenizer))]
+
+
+def _text(token_texts: List[str], token_id: int) -> str:
+    return token_texts[token_id] if token_id < len(token_texts) else ""
+
+
+def find_stop(token_ids: List[int], token_texts: List[str]) -> int:
+    """
+    Index of the first generated token that starts a stop marker, or
+    len(token_ids) if there is none; token_ids[:index] is the reply
+    """
+    offsets = []
+    pieces = []
+    length = 0
+    for token_id in token_ids:
+        offsets.append(length)
+        piece = _text(token_texts, token_id)
+        pieces.append(piece)
+        length += len(piece)
+
+    match = STOP_MARKER_PATTERN.search("".join(pieces))
+    if match is None:
+        return len(token_ids)
+
+    # Token containing the first character of the marker
+    return bisect_right(offsets, match.start()) - 1
+
+
+class StopMarkerCriteria(StoppingCriteria):
+    """
+    End generation as soon as the model starts writing the next turn,
+    instead of decoding a user message that would be thrown away
+    """
+
+    def __init__(self, token_texts: List[str], prompt_length: int, row: int = 0):
+        self.token_texts = token_texts
+        self.prompt_length = prompt_length
+        self.row = row
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        start = max(self.prompt_length, input_ids.shape[-1] - TAIL_TOKENS)
+        tail = "".join(_text(self.token_texts, i) for i in input_ids[self.row, start:].tolist())
+        return STOP_MARKER_PATTERN.search(tail) is not None
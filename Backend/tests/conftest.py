@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Backend modules import each other by name (uvicorn runs from Backend/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,44 @@
+import pytest
+from starlette.requests import Request
+
+from clients import TrustedProxies
+from scheduler import QuotaExceeded, SessionQuotas
+
+ROUTER = "10.0.0.5"
+
+
+def request_from(peer: str, headers: dict) -> Request:
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/generate",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": (peer, 50000),
+    })
+
+
+def test_rotating_ids_do_not_bypass_the_bucket():
+    proxies = TrustedProxies([])
+    quotas = SessionQuotas(tokens_per_minute=60, burst=300)
+    with pytest.raises(QuotaExceeded):
+        for i in range(5):
+            http_request = request_from("203.0.113.7", {"x-session-id": f"id-{i}", "x-forwarded-for": f"198.51.100.{i}"})
+            assert proxies.forwarded_session(http_request) is None
+            quotas.charge(proxies.client_address(http_request), 100)
+    assert i == 3
+
+
+def test_trusted_proxy_forwards_the_last_hop_it_saw():
+    proxies = TrustedProxies(["10.0.0.0/24"])
+    # The client prepended its own X-Forwarded-For; the router appended the real peer
+    http_request = request_from(ROUTER, {"x-session-id": "session:abc", "x-forwarded-for": "1.2.3.4, 203.0.113.7"})
+    assert proxies.client_address(http_request) == "203.0.113.7"
+    assert proxies.forwarded_session(http_request) == "session:abc"
+
+
+def test_headers_from_untrusted_peers_are_ignored():
+    proxies = TrustedProxies([ROUTER])
+    http_request = request_from("203.0.113.7", {"x-forwarded-for": ROUTER, "x-session-id": "s"})
+    assert proxies.client_address(http_request) == "203.0.113.7"
+    assert proxies.forwarded_session(http_request) is None
+    assert not proxies.trusted("testclient")
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import torch
+
+from kv_cache import MIN_REUSE_TOKENS, PrefixCache, _Entry
+from metrics import metrics
+
+
+class FakeLoaded:
+    model = SimpleNamespace(config=SimpleNamespace(window_size=256))
+
+
+def past_for(length: int):
+    return tuple((torch.zeros(1, 2, length, 4), torch.zeros(1, 2, length, 4)) for _ in range(2))
+
+
+def test_lookup_reports_the_entry_it_matched():
+    loaded = FakeLoaded()
+    cache = PrefixCache(1024 * 1024)
+    ids = list(range(2 * MIN_REUSE_TOKENS))
+    entry = _Entry(ids, past_for(len(ids)), loaded)
+    entry.restored = True
+    cache._insert("s", entry)
+    before = metrics.snapshot()["counters"].get("kv_cache.disk_hits", 0)
+
+    past, common = cache.lookup("s", loaded, ids + [99])
+    assert common == len(ids)
+    assert past[0][0].shape[2] == common
+    assert metrics.snapshot()["counters"]["kv_cache.disk_hits"] == before + 1
+
+
+def test_lookup_misses_other_models_and_short_prefixes():
+    loaded = FakeLoaded()
+    cache = PrefixCache(1024 * 1024)
+    ids = list(range(2 * MIN_REUSE_TOKENS))
+    cache._insert("s", _Entry(ids, past_for(len(ids)), loaded))
+
+    assert cache.lookup("s", FakeLoaded(), ids + [99]) is None
+    assert cache.lookup("s", loaded, ids[:MIN_REUSE_TOKENS - 1] + [99] * MIN_REUSE_TOKENS) is None
+    assert cache.lookup("other", loaded, ids + [99]) is None
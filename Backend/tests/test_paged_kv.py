@@ -0,0 +1,65 @@
+import pytest
+import torch
+from transformers import GPTNeoConfig, GPTNeoForCausalLM
+
+from paged_kv import LOCAL_SHARE, MB, PagedGPTNeo
+
+# app.py defaults: FREUD_PAGED_KV_MB, FREUD_PAGED_KV_BLOCK, 2 * FREUD_LORA_MAX_BATCH
+PAGED_KV_MB = 256
+PAGED_KV_BLOCK = 16
+MAX_SEQUENCES = 2 * 8
+
+
+def neo_125m():
+    """GPT-Neo 125M's attention layout (the served base) with a small vocabulary"""
+    config = GPTNeoConfig(
+        vocab_size=128,
+        max_position_embeddings=2048,
+        hidden_size=768,
+        num_layers=12,
+        num_heads=12,
+        attention_types=[[["global", "local"], 6]],
+        window_size=256,
+    )
+    with torch.device("meta"):
+        model = GPTNeoForCausalLM(config)
+    # The pools only need the config and the parameters' dtype and device
+    return model.to_empty(device="cpu")
+
+
+def test_default_budget_builds_both_pools():
+    paged = PagedGPTNeo(neo_125m(), PAGED_KV_MB * MB, PAGED_KV_BLOCK, MAX_SEQUENCES)
+
+    local_bytes = paged.local_pool.num_blocks * paged.local_pool.block_bytes
+    global_bytes = paged.pool.num_blocks * paged.pool.block_bytes
+    assert 1 <= paged.max_sequences <= MAX_SEQUENCES
+    assert local_bytes <= PAGED_KV_MB * MB * LOCAL_SHARE
+    assert local_bytes + global_bytes <= PAGED_KV_MB * MB
+    assert paged.pool.num_blocks > 0
+
+
+def test_budget_below_one_window_is_a_config_error():
+    with pytest.raises(ValueError, match="FREUD_PAGED_KV_MB"):
+        PagedGPTNeo(neo_125m(), 8 * MB, PAGED_KV_BLOCK, MAX_SEQUENCES)
+
+
+def run_prompt(paged, namespace, ids):
+    sequence = paged.sequence(namespace)
+    sequence.reserve(len(ids))
+    sequence.advance(ids)
+    return sequence
+
+
+def test_prefix_reuse_requires_identical_tokens_and_namespace():
+    paged = PagedGPTNeo(neo_125m(), PAGED_KV_MB * MB, PAGED_KV_BLOCK, MAX_SEQUENCES)
+    prompt = list(range(3 * PAGED_KV_BLOCK))
+    first = run_prompt(paged, None, prompt)
+
+    same = paged.sequence(None)
+    assert same.reuse_prefix(prompt + [1]) == len(prompt)
+    assert same.blocks == first.blocks
+
+    changed = prompt.copy()
+    changed[PAGED_KV_BLOCK + 1] += 1
+    assert paged.sequence(None).reuse_prefix(changed + [1]) == PAGED_KV_BLOCK
+    assert paged.sequence("adapter").reuse_prefix(prompt + [1]) == 0
@@ -0,0 +1,41 @@
+import threading
+
+import torch
+
+from profiling import Profiler
+
+
+def test_overlapping_captures_do_not_raise(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    session = profiler.start(requests=3)
+    inside, release = threading.Event(), threading.Event()
+    errors = []
+
+    def first():
+        try:
+            with profiler.capture():
+                inside.set()
+                release.wait(5)
+                torch.ones(4) + 1
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    assert inside.wait(5)
+
+    # A second request while the first is traced runs unprofiled
+    with profiler.capture():
+        torch.ones(4) * 2
+    release.set()
+    thread.join()
+
+    assert not errors
+    traces = [path for path in session.paths if path.endswith(".trace.json")]
+    assert len(traces) == 1
+    assert session.captured == 1
+
+    # The next request after it is captured again
+    with profiler.capture():
+        torch.ones(4) - 1
+    assert session.captured == 2
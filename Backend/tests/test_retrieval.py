@@ -0,0 +1,37 @@
+from retrieval import IntentIndex
+
+INTENTS = [
+    {"tag": "greeting", "patterns": ["hello", "hi there"], "responses": ["Hello there. How are you feeling today?"]},
+    {"tag": "about", "patterns": ["who are you"], "responses": ["I'm Pandora, your assistant.", "Call me Pandora."]},
+    {"tag": "sad", "patterns": ["i feel sad"], "responses": ["I'm sorry to hear that."]},
+    {"tag": "goodbye", "patterns": ["bye", "goodbye", "see you later"], "responses": ["Take it easy! See you soon."]},
+    {"tag": "evening", "patterns": ["good evening", "good night"], "responses": ["Good evening. How has your day been?"]},
+    {"tag": "night", "patterns": ["good night", "night"], "responses": ["Good night. Sweet dreams."]},
+]
+
+
+def test_small_talk_is_answered():
+    assert IntentIndex(INTENTS).answer("hello") == ("greeting", "Hello there. How are you feeling today?")
+
+
+def test_about_is_not_answered_by_default():
+    assert IntentIndex(INTENTS).answer("who are you") is None
+
+
+def test_other_persona_responses_are_never_sent():
+    index = IntentIndex(INTENTS, answer_intents=["about"])
+    assert index.responses["about"] == []
+    assert index.answer("who are you") is None
+
+
+def test_farewells_are_never_answered():
+    index = IntentIndex(INTENTS, answer_intents=["goodbye", "night", "greeting"])
+    for text in ["goodbye cruel world", "this is my final goodbye", "goodbye forever", "bye"]:
+        assert index.answer(text) is None
+
+
+def test_pattern_in_several_intents_is_not_an_exact_match():
+    index = IntentIndex(INTENTS)
+    assert "good night" not in index.exact
+    assert index.answer("good night") is None
+    assert index.answer("good evening") == ("evening", "Good evening. How has your day been?")
@@ -0,0 +1,62 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import router
+
+HUNG, PAGE, GOOD = "http://hung:7860", "http://page:7860", "http://good:7860"
+
+
+@pytest.fixture
+def replicas(monkeypatch):
+    """Three replicas behind a mock transport: one times out, one returns an HTML error page"""
+    def upstream(request: httpx.Request) -> httpx.Response:
+        origin = f"{request.url.scheme}://{request.url.host}:{request.url.port}"
+        if origin == HUNG:
+            raise httpx.ReadTimeout("timed out", request=request)
+        if origin == PAGE:
+            return httpx.Response(502, text="<html>Bad Gateway</html>", headers={"content-type": "text/html"})
+        return httpx.Response(200, json={"response": "hi", "route": "model"})
+
+    ring = router.HashRing([], router.VIRTUAL_NODES)
+    states = {}
+    for url in (HUNG, PAGE, GOOD):
+        ring.add(url)
+        states[url] = router.ReplicaState(url)
+    monkeypatch.setattr(router, "ring", ring)
+    monkeypatch.setattr(router, "replicas", states)
+    monkeypatch.setattr(router, "client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    return states
+
+
+def session_owned_by(url: str) -> str:
+    return next(f"s{i}" for i in range(1000) if router.ring.candidates(f"session:s{i}")[0] == url)
+
+
+def test_timed_out_replica_fails_over(replicas):
+    replicas[PAGE].healthy = False
+    response = TestClient(router.app).post("/generate", json={"prompt": "x", "session_id": session_owned_by(HUNG)})
+    assert response.status_code == 200
+    assert not replicas[HUNG].healthy
+    assert router.counters["failovers"] >= 1
+
+
+def test_non_json_upstream_body_is_passed_through(replicas):
+    response = TestClient(router.app).post("/generate", json={"prompt": "x", "session_id": session_owned_by(PAGE)})
+    assert response.status_code == 502
+    assert response.text == "<html>Bad Gateway</html>"
+    assert response.headers["content-type"].startswith("text/html")
+
+
+def test_replica_changes_need_the_admin_token(replicas, monkeypatch):
+    client = TestClient(router.app)
+    monkeypatch.setattr(router, "ADMIN_TOKEN", None)
+    assert client.post("/replicas", params={"url": "http://evil:1"}).status_code == 404
+    monkeypatch.setattr(router, "ADMIN_TOKEN", "secret")
+    assert client.post("/replicas", params={"url": "http://evil:1"}).status_code == 403
+    assert client.delete("/replicas", params={"url": GOOD}, headers={"x-admin-token": "wrong"}).status_code == 403
+    assert "http://evil:1" not in router.replicas and GOOD in router.replicas
+
+    response = client.post("/replicas", params={"url": "http://new:1"}, headers={"x-admin-token": "secret"})
+    assert response.status_code == 200
+    assert "http://new:1" in router.replicas
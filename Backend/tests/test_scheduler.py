@@ -0,0 +1,51 @@
+import random
+import time
+
+from scheduler import _FairQueue, _Waiter
+
+
+def waiter(session: str, cost: int, seq: int) -> _Waiter:
+    return _Waiter("normal", session, cost, seq, None, None)
+
+
+def pop_one_quantum_at_a_time(queue: _FairQueue) -> _Waiter:
+    """Textbook DRR: top up the front session by one quantum per visit"""
+    while True:
+        session, waiters = next(iter(queue.sessions.items()))
+        head = waiters[0]
+        if queue.deficit[session] >= head.cost:
+            queue.deficit[session] -= head.cost
+            waiters.popleft()
+            if not waiters:
+                queue._drop(session)
+            return head
+        queue.deficit[session] += queue.quantum
+        queue.sessions.move_to_end(session)
+
+
+def test_pop_serves_in_drr_order():
+    rng = random.Random(0)
+    for _ in range(200):
+        fast, slow = _FairQueue(quantum=256), _FairQueue(quantum=256)
+        for seq in range(rng.randint(1, 30)):
+            session, cost = f"s{rng.randint(0, 4)}", rng.randint(1, 2000)
+            fast.push(waiter(session, cost, seq))
+            slow.push(waiter(session, cost, seq))
+            # Interleave pops with pushes, as the scheduler does
+            if rng.random() < 0.3:
+                assert fast.pop().seq == pop_one_quantum_at_a_time(slow).seq
+                assert fast.deficit == slow.deficit
+                assert list(fast.sessions) == list(slow.sessions)
+        while len(slow):
+            assert fast.pop().seq == pop_one_quantum_at_a_time(slow).seq
+            assert fast.deficit == slow.deficit
+
+
+def test_huge_cost_does_not_spin():
+    queue = _FairQueue(quantum=256)
+    queue.push(waiter("greedy", 10 ** 12, 0))
+    queue.push(waiter("polite", 100, 1))
+    started = time.perf_counter()
+    assert queue.pop().session == "polite"
+    assert queue.pop().session == "greedy"
+    assert time.perf_counter() - started < 0.1
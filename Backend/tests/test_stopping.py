@@ -0,0 +1,70 @@
+import torch
+
+from cancellation import CancellationGroup
+from lora import BatchRowCriteria, LoraRow
+from stopping import StopMarkerCriteria, find_stop
+
+# Fake vocabulary: id -> decoded text
+TOKEN_TEXTS = ["Hello", " there", ".", "\n", "<", "|", "user", "|>", "[", "emotion", ":", " fine", "<|", "PAD"]
+ID = {text: i for i, text in enumerate(TOKEN_TEXTS)}
+PAD = ID["PAD"]
+
+
+def ids(*texts: str) -> list:
+    return [ID[text] for text in texts]
+
+
+def test_marker_split_across_tokens():
+    generated = ids("Hello", " there", ".", "\n", "<", "|", "user", "|>")
+    assert find_stop(generated, TOKEN_TEXTS) == 4
+
+    generated = ids("Hello", "\n", "[", "emotion", ":", " fine")
+    assert find_stop(generated, TOKEN_TEXTS) == 2
+
+
+def test_marker_at_first_token():
+    assert find_stop(ids("<|", "user", "|>", "Hello"), TOKEN_TEXTS) == 0
+    assert find_stop(ids("<", "|", "user"), TOKEN_TEXTS) == 0
+
+
+def test_no_marker_keeps_everything():
+    generated = ids("Hello", " there", ".")
+    assert find_stop(generated, TOKEN_TEXTS) == len(generated)
+
+
+def test_criteria_fires_once_split_marker_completes():
+    prompt = ids("Hello", "\n")
+    criteria = StopMarkerCriteria(TOKEN_TEXTS, len(prompt))
+    sequence = prompt + ids(" there", ".")
+    assert not criteria(torch.tensor([sequence]), None)
+    sequence += ids("\n", "<")
+    assert not criteria(torch.tensor([sequence]), None)
+    sequence += ids("|")
+    assert criteria(torch.tensor([sequence]), None)
+
+
+def test_criteria_ignores_markers_in_the_prompt():
+    prompt = ids("<|", "user", "|>", "Hello", "\n")
+    criteria = StopMarkerCriteria(TOKEN_TEXTS, len(prompt))
+    assert not criteria(torch.tensor([prompt + ids(" there")]), None)
+
+
+def row(max_tokens: int = 100) -> LoraRow:
+    return LoraRow(None, "", None, max_tokens, 0.7, CancellationGroup(), None, {})
+
+
+def test_batch_rows_stop_independently():
+    prompt_length = 2
+    criteria = BatchRowCriteria([row(), row()], TOKEN_TEXTS, prompt_length, eos_token_id=None)
+    batch = torch.tensor([
+        ids("Hello", "\n") + ids(" there", "<", "|"),
+        ids("Hello", "\n") + ids(" there", ".", "\n"),
+    ])
+
+    assert not criteria(batch, None)
+    assert criteria.done == [True, False]
+
+    # Row 0 stays done while row 1 keeps going until its own marker
+    batch = torch.cat([batch, torch.tensor([[PAD], [ID["<|"]]])], dim=-1)
+    assert criteria(batch, None)
+    assert criteria.done == [True, True]